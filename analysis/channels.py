@@ -193,4 +193,64 @@ class channel():
         return ch_hv_to_num(self.ch_h, self.ch_v)
 
 
+class channel_layout():
+    """Compact layout of a selection of channels, f.ex. the channels used by the analysis tasks.
+
+    A reader that fetches only the selected channels returns one row per channel, ordered by
+    their linear index. idx maps a channel to its row in this compact array, like channel.idx
+    does for the array with all channels.
+
+    >>> layout = channel_layout.union([channel_range.from_str("L0101-0104"), channel_range.from_str("L2201-2208")])
+    >>> data = reader.Get(layout.channels)        # 12 rows
+    >>> layout.idx(channel("L", 22, 1))           # 4
+    """
+
+    def __init__(self, channels):
+        """
+        Input:
+        ======
+        channels: iterable of channel objects. Duplicates are removed and the channels are ordered by their linear index.
+        """
+        unique = {}
+        for ch in channels:
+            unique.setdefault(ch.idx(), ch)
+        # The selected channels, in the order of the rows of the compact array
+        self.channels = [unique[i] for i in sorted(unique.keys())]
+        # Maps the linear index of a channel to its row
+        self.rows = {ch.idx(): row for row, ch in enumerate(self.channels)}
+
+
+    @classmethod
+    def union(cls, channel_iterables):
+        """Generates the layout of the union of several channel lists or channel_ranges."""
+        return(cls([ch for channels in channel_iterables for ch in channels]))
+
+
+    def __iter__(self):
+        return(iter(self.channels))
+
+
+    def __len__(self):
+        return(len(self.channels))
+
+
+    def idx(self, ch):
+        """Returns the row of a channel in the compact array. Raises a ValueError if it is not selected."""
+        try:
+            return(self.rows[ch.idx()])
+        except KeyError:
+            raise ValueError("Channel {0:s} is not in the channel layout".format(str(ch)))
+
+
+    def to_str(self):
+        """Formats the layout as a list of channel ranges, f.ex. L0101-0104,L2201-2208"""
+        ranges = []
+        for ch in self.channels:
+            if len(ranges) > 0 and ch.dev == ranges[-1][1].dev and ch.idx() == ranges[-1][1].idx() + 1:
+                ranges[-1][1] = ch
+            else:
+                ranges.append([ch, ch])
+        return(",".join([channel_range(ch_i, ch_f).to_str() for ch_i, ch_f in ranges]))
+
+
 # End of file channels.py
\ No newline at end of file
@@ -0,0 +1,310 @@
+# Coding: UTF-8 -*-
+
+"""
+Cross-spectral density engine for the spectral tasks.
+
+Cross-power, cross-phase and coherence between two channels are all derived from
+the bin-averaged product of their fourier coefficients, S_ij(f) = <X_i(f) X_j(f)*>.
+Instead of computing X * Y.conj() separately for every channel pair, the routines
+here compute S_ij for whole channel blocks with one batched matrix product over the
+STFT-bin axis. The individual diagnostics are then cheap elementwise views of S.
+
+The fourier-transformed data is expected in the layout used by task_fft:
+dim0: channel, dim1: Fourier Coefficients, dim2: STFT (bins in fluctana code)
+
+csd_accumulator keeps running sums of these spectra across time steps, so that
+estimates over many steps, or the whole shot so far, are available without keeping
+the fourier-transformed data of past steps.
+"""
+
+from collections import deque
+import numpy as np
+
+
+def csd_matrix(fft_data, ref_idx, x_idx, normalize=False):
+    """Calculates the cross-spectral density tensor S_ij(f) = <X_i(f) X_j(f)*>.
+
+    The average is taken over the STFT bins. For each frequency this is a matrix product
+    of the (ref channels x bins) and (bins x cross channels) coefficient matrices, so
+    the whole tensor is evaluated with a single batched matmul.
+
+    Input:
+    ======
+    fft_data: ndarray, complex. dim0: channel, dim1: Fourier Coefficients, dim2: STFT (bins)
+    ref_idx: array-like, int. Indices of the reference channels i
+    x_idx: array-like, int. Indices of the cross channels j
+    normalize: bool. If true, scale each fourier coefficient to unit magnitude before averaging.
+               This gives the bin-wise normalized spectrum used by the coherence.
+
+    Returns:
+    ========
+    S: ndarray, complex. dim0: reference channel, dim1: cross channel, dim2: Fourier Coefficients
+    """
+
+    X = fft_data[np.asarray(ref_idx), :, :]
+    Y = fft_data[np.asarray(x_idx), :, :]
+    if normalize:
+        X = X / np.abs(X)
+        Y = Y / np.abs(Y)
+
+    nbins = fft_data.shape[-1]
+    # (freq, ref, bins) @ (freq, bins, cross) -> (freq, ref, cross)
+    S = np.matmul(X.transpose(1, 0, 2), Y.conj().transpose(1, 2, 0)) / nbins
+
+    return(S.transpose(1, 2, 0))
+
+
+def csd_pairs(fft_data, ch0, ch1, normalize=False):
+    """Calculates S_ij(f) for a list of channel pairs (ch0[p], ch1[p]).
+
+    The tensor is computed once for all first channels times all second channels that
+    appear in the pair list, and the requested pairs are gathered from it. For a tile of
+    consecutive pairs from the dispatch sequence this block is only a few rows high.
+
+    Input:
+    ======
+    fft_data: ndarray, complex. dim0: channel, dim1: Fourier Coefficients, dim2: STFT (bins)
+    ch0: ndarray, int. Index of the first channel of each pair
+    ch1: ndarray, int. Index of the second channel of each pair
+    normalize: bool. See csd_matrix
+
+    Returns:
+    ========
+    Sxy: ndarray, complex. dim0: channel pair, dim1: Fourier Coefficients
+    """
+
+    ch0_unique, pos0 = np.unique(ch0, return_inverse=True)
+    ch1_unique, pos1 = np.unique(ch1, return_inverse=True)
+
+    S = csd_matrix(fft_data, ch0_unique, ch1_unique, normalize=normalize)
+
+    return(S[pos0.ravel(), pos1.ravel(), :])
+
+
+def csd_sums(fft_data, ch0, ch1):
+    """Calculates the bin-sums of the spectra of a list of channel pairs for one time step.
+    These are the inputs of csd_accumulator.update.
+
+    Input:
+    ======
+    fft_data: ndarray, complex. dim0: channel, dim1: Fourier Coefficients, dim2: STFT (bins)
+    ch0: ndarray, int. Index of the first channel of each pair
+    ch1: ndarray, int. Index of the second channel of each pair
+
+    Returns:
+    ========
+    Sxy: ndarray, complex. Sum over bins of X Y*. dim0: channel pair, dim1: Fourier Coefficients
+    Sxy_norm: ndarray, complex. Sum over bins of X Y* / (|X| |Y|)
+    Pxx: ndarray, float. Sum over bins of |X|^2
+    Pyy: ndarray, float. Sum over bins of |Y|^2
+    nbins: int, number of bins in the sums
+    """
+
+    nbins = fft_data.shape[-1]
+    Sxy = csd_pairs(fft_data, ch0, ch1) * nbins
+    Sxy_norm = csd_pairs(fft_data, ch0, ch1, normalize=True) * nbins
+
+    ch_unique, pos = np.unique(np.concatenate([ch0, ch1]), return_inverse=True)
+    pos = pos.ravel()
+    P = np.sum(np.abs(fft_data[ch_unique, :, :])**2, axis=-1)
+
+    return(Sxy, Sxy_norm, P[pos[:len(ch0)], :], P[pos[len(ch0):], :], nbins)
+
+
+def merge_csd_sums(sums_list):
+    """Concatenates the sums from csd_sums of consecutive tiles of channel pairs."""
+    return([np.concatenate([sums[i] for sums in sums_list]) for i in range(4)] + [sums_list[0][4]])
+
+
+def cross_power(Sxy, win_factor=1.0):
+    """Cross-power |<X Y*>| / win_factor. See specs.cross_power."""
+    return(np.abs(Sxy) / win_factor)
+
+
+def cross_phase(Sxy):
+    """Cross-phase arg <X Y*>. See specs.cross_phase."""
+    return(np.arctan2(Sxy.imag, Sxy.real))
+
+
+def coherence(Sxy_norm):
+    """Coherence |<X Y* / (|X| |Y|)>| from the normalized spectrum. See specs.coherence."""
+    return(np.abs(Sxy_norm))
+
+
+def cross_correlation(Sxy, fft_params):
+    """Cross-correlation as the inverse FFT of <X Y*> / win_factor, centered on zero lag.
+
+    The inverse FFT is linear, so transforming the bin-averaged spectrum gives the same
+    result as averaging the transforms of the individual bins.
+
+    Input:
+    ======
+    Sxy: ndarray, complex. dim0: channel pair, dim1: Fourier Coefficients
+    fft_params: dict, parameters of the fourier-transformed data. Uses nfft and win_factor.
+                If layout is 'shifted', the coefficients are ordered -fN...0...fN and are shifted
+                back to FFT order first, as in fluctana.
+
+    Returns:
+    ========
+    cross-correlation, ndarray, float. dim0: channel pair, dim1: time lag
+    """
+    nfft = fft_params["nfft"]
+    if fft_params.get("layout", "fft") == "shifted":
+        Sxy = np.fft.ifftshift(Sxy, axes=-1)
+    res = np.fft.ifft(Sxy / fft_params["win_factor"], n=nfft, axis=-1) * nfft
+    return(np.fft.fftshift(res, axes=-1).real)
+
+
+def cross_spectrogram(fft_data, ch0, ch1, win_factor=1.0, freq_idx=None, decimate=1):
+    """Time-resolved cross-power |X Y*| / win_factor for a list of channel pairs. See specs.xspec.
+
+    Only the requested frequencies are multiplied. With decimate > 1, the cross-power is
+    averaged over blocks of decimate consecutive STFT bins. Trailing bins that do not fill
+    a whole block are dropped.
+
+    Input:
+    ======
+    fft_data: ndarray, complex. dim0: channel, dim1: Fourier Coefficients, dim2: STFT (bins)
+    ch0: ndarray, int. Index of the first channel of each pair
+    ch1: ndarray, int. Index of the second channel of each pair
+    win_factor: float, window factor of the STFT
+    freq_idx: None or ndarray, int. Indices of the Fourier Coefficients to keep. None keeps all
+    decimate: int, number of STFT bins averaged into one time bin of the result
+
+    Returns:
+    ========
+    xspec: ndarray, float. dim0: channel pair, dim1: Fourier Coefficients, dim2: time bin
+    """
+
+    if freq_idx is None:
+        freq_idx = np.arange(fft_data.shape[1])
+    # Gather channels and frequencies in one step, so that cropped frequencies are never copied
+    freq_idx = np.asarray(freq_idx)[np.newaxis, :]
+    X = fft_data[np.asarray(ch0)[:, np.newaxis], freq_idx, :]
+    Y = fft_data[np.asarray(ch1)[:, np.newaxis], freq_idx, :]
+
+    val = np.abs(X * Y.conj()) / win_factor
+
+    if decimate > 1:
+        num_t = val.shape[-1] // decimate
+        val = val[:, :, :num_t * decimate].reshape(val.shape[0], val.shape[1], num_t, decimate).mean(axis=-1)
+
+    return(val)
+
+
+class csd_accumulator():
+    """Accumulates the spectra of a list of channel pairs across time steps.
+
+    Only the bin-sums from csd_sums are kept, never the fourier-transformed data.
+    Three modes of accumulation are supported:
+    * 'cumulative': Sums over all steps seen so far, i.e. the whole shot.
+    * 'exponential': Sums with exponential forgetting, S <- alpha * S + S_step.
+    * 'window': Sums over the last nsteps steps.
+
+    With keep_history=True, the sums of each step are stored as well. Estimates over any
+    range of steps are then available by passing steps=(first, last) to the estimators.
+
+    >>> acc = csd_accumulator(mode="window", nsteps=10)
+    >>> acc.update(*csd_sums(fft_data, ch0, ch1))
+    >>> acc.coherence()
+    """
+
+    def __init__(self, mode="cumulative", alpha=0.9, nsteps=10, keep_history=False):
+        """
+        Input:
+        ======
+        mode: string, either 'cumulative', 'exponential' or 'window'
+        alpha: float, forgetting factor per step for mode='exponential'
+        nsteps: int, number of steps in the sliding window for mode='window'
+        keep_history: bool, If true, store the sums of each step
+        """
+
+        assert(mode in ["cumulative", "exponential", "window"])
+        self.mode = mode
+        self.alpha = alpha
+        self.nsteps = nsteps
+        self.keep_history = keep_history
+
+        # Current sums Sxy, Sxy_norm, Pxx, Pyy, nbins
+        self.sums = None
+        # Per-step sums in the sliding window
+        self.window = deque()
+        # Per-step sums of all steps, if keep_history
+        self.history = []
+        # Number of steps passed to update
+        self.num_steps = 0
+
+
+    def update(self, Sxy, Sxy_norm, Pxx, Pyy, nbins):
+        """Adds the sums of a new step. See csd_sums for the input."""
+
+        step_sums = [Sxy, Sxy_norm, Pxx, Pyy, nbins]
+
+        if self.sums is None:
+            self.sums = step_sums
+            if self.mode == "window":
+                self.window.append(step_sums)
+
+        elif self.mode == "cumulative":
+            self.sums = [s + s_new for s, s_new in zip(self.sums, step_sums)]
+
+        elif self.mode == "exponential":
+            self.sums = [self.alpha * s + s_new for s, s_new in zip(self.sums, step_sums)]
+
+        elif self.mode == "window":
+            self.window.append(step_sums)
+            if len(self.window) > self.nsteps:
+                self.window.popleft()
+            # Re-sum the window instead of subtracting the oldest step so that round-off does not accumulate
+            self.sums = [sum(s) for s in zip(*self.window)]
+
+        if self.keep_history:
+            self.history.append(step_sums)
+        self.num_steps += 1
+
+
+    def get_sums(self, steps=None):
+        """Returns the sums Sxy, Sxy_norm, Pxx, Pyy, nbins.
+
+        Input:
+        ======
+        steps: None or tuple (first, last). If None, return the sums of the accumulation mode.
+               Otherwise return the sums over steps first...last-1, counted from the first
+               call to update. Requires keep_history.
+        """
+
+        if steps is None:
+            assert(self.sums is not None)
+            return(self.sums)
+
+        assert(self.keep_history)
+        step_sums = self.history[steps[0]:steps[1]]
+        assert(len(step_sums) > 0)
+        return([sum(s) for s in zip(*step_sums)])
+
+
+    def cross_power(self, win_factor=1.0, steps=None):
+        """Cross-power from the accumulated spectra. See get_sums for steps."""
+        Sxy, _, _, _, nbins = self.get_sums(steps)
+        return(cross_power(Sxy / nbins, win_factor))
+
+
+    def cross_phase(self, steps=None):
+        """Cross-phase from the accumulated spectra. See get_sums for steps."""
+        Sxy, _, _, _, _ = self.get_sums(steps)
+        return(cross_phase(Sxy))
+
+
+    def coherence(self, binwise=True, steps=None):
+        """Coherence from the accumulated spectra. See get_sums for steps.
+
+        If binwise is true, use the bin-wise normalization of specs.coherence, |<X Y* / (|X| |Y|)>|.
+        Otherwise return the magnitude coherence |<X Y*>| / sqrt(<|X|^2> <|Y|^2>).
+        """
+        Sxy, Sxy_norm, Pxx, Pyy, nbins = self.get_sums(steps)
+        if binwise:
+            return(coherence(Sxy_norm / nbins))
+        return(np.abs(Sxy) / np.sqrt(Pxx * Pyy))
+
+
+# End of file cross_spectra.py
@@ -0,0 +1,106 @@
+# Coding: UTF-8 -*-
+
+"""
+Fuses the analysis tasks of a time step that work on the same data.
+
+Cross-phase, cross-power and coherence on the same channel pairs are all derived from
+the same spectra X Y*, |X|^2, |Y|^2. Instead of letting every task compute them, the
+execution plan groups the tasks by channel pairs and FFT parameters, computes these
+spectra once per group (cross_spectra.csd_sums) and derives the result of each task
+from them. The futures_list and storage_scheme of each task are the same as when
+calling task.calculate, so downstream consumers do not change.
+"""
+
+from analysis.kernels import run_kernel
+from analysis.task_spectral import apply_to_tile
+from analysis.sharding import submit_pairs
+
+
+class execution_plan():
+    """Compiles a list of analysis tasks into groups that share intermediate results.
+
+    >>> plan = execution_plan(task_list)
+    >>> plan.calculate(dask_client, fft_future)
+    >>> for task in task_list:
+    >>>     task.get_results()
+    """
+
+    def __init__(self, task_list):
+        """
+        Input:
+        ======
+        task_list: list of task_spectral objects.
+        """
+
+        self.task_list = task_list
+
+        # Tasks that can derive their result from csd_sums, grouped by channel pairs and fft parameters
+        self.groups = {}
+        # Tasks that need the fourier coefficients
+        self.single_tasks = []
+
+        for task in task_list:
+            if task.from_sums is None:
+                self.single_tasks.append(task)
+                continue
+
+            ch0, ch1 = task.get_pair_indices()
+            key = (tuple(ch0), tuple(ch1), tuple(sorted(task.fft_config.items())), task.tile_size)
+            self.groups.setdefault(key, []).append(task)
+
+        # Fusing only pays off if the intermediates are used more than once.
+        for key in list(self.groups.keys()):
+            if len(self.groups[key]) == 1:
+                self.single_tasks.append(self.groups.pop(key)[0])
+
+
+    def calculate(self, dask_client, fft_future, skip=()):
+        """Dispatches all tasks of the plan. Sets futures_list of each task.
+
+        Input:
+        ======
+        dask_client: dask client
+        fft_future: A future to the fourier-transformed data.
+        skip: list of task descriptions that are not dispatched at this step, see scheduling.py.
+              futures_list and accumulator_futures of these tasks are left unchanged.
+
+        Returns:
+        ========
+        None
+        """
+
+        for tasks in self.groups.values():
+            tasks = [task for task in tasks if task.description not in skip]
+            if len(tasks) == 0:
+                continue
+            # Calculate the spectra for the channel pairs of this group once, tile by tile
+            tiles = tasks[0].get_dispatch_tiles()
+            sums_futures = [submit_pairs(dask_client, run_kernel, fft_future, ch0, ch1, pre_args=("csd_sums",))
+                            for _, ch0, ch1 in tiles]
+
+            for task in tasks:
+                task.futures_list = [dask_client.submit(apply_to_tile, task.from_sums, pair_idx, sums_future, task.fft_config)
+                                     for (pair_idx, _, _), sums_future in zip(tiles, sums_futures)]
+                # Accumulators are updated from the same sums
+                task.accumulator_futures = sums_futures
+
+        for task in self.single_tasks:
+            if task.description not in skip:
+                task.calculate(dask_client, fft_future)
+
+        return None
+
+
+    def describe(self):
+        """Returns a string that describes the groups of the plan."""
+
+        lines = []
+        for (ch0, _, _, _), tasks in self.groups.items():
+            lines.append("Fused {0:d} pairs: ".format(len(ch0)) + ", ".join([t.description for t in tasks]))
+        for task in self.single_tasks:
+            lines.append("Single: {0:s}".format(task.description))
+
+        return("\n".join(lines))
+
+
+# End of file execution_plan.py
@@ -0,0 +1,142 @@
+# Coding: UTF-8 -*-
+
+"""
+Defines the setup of the short-time fourier transformations, shared by all spectral code paths.
+
+Window functions, window factor and frequency axis only depend on the parameters of the
+STFT. get_fft_setup builds them once for each set of parameters and caches them, so that
+they are not re-calculated for every channel, bin or time step. The transform itself is a
+call to scipy.fft with a configurable number of threads.
+
+The fluctana code paths use the symmetric windows of KSTAR/specs.py. The scipy engine uses
+the periodic windows that scipy's stft builds from a window name, see build_window.
+"""
+
+import functools
+
+import numpy as np
+import scipy.fft
+from scipy.signal import get_window
+
+
+# Names of the windows in scipy.signal.get_window
+scipy_windows = {"rectwin": "boxcar", "hann": "hann", "hamm": "hamming", "kaiser": ("kaiser", 30)}
+
+
+def build_window(nfft, window, periodic=False):
+    """Calculates a window function, as in KSTAR/specs.py
+
+    Input:
+    ======
+    nfft: int, number of data points per FFT
+    window: string, name of the window: 'rectwin', 'hann', 'hamm', 'kaiser' or 'HFT248D'
+    periodic: bool, if true, return the periodic window, as used by scipy's stft for a window name.
+              Otherwise return the symmetric window of specs.py. HFT248D is always periodic.
+
+    Returns:
+    ========
+    win: ndarray, float. The window function
+    """
+
+    if periodic and window in scipy_windows:
+        win = get_window(scipy_windows[window], nfft, fftbins=True)
+    elif window == 'rectwin':  # overlap = 0.5
+        win = np.ones(nfft)
+    elif window == 'hann':  # overlap = 0.5
+        win = np.hanning(nfft)
+    elif window == 'hamm':  # overlap = 0.5
+        win = np.hamming(nfft)
+    elif window == 'kaiser':  # overlap = 0.62
+        win = np.kaiser(nfft, beta=30)
+    elif window == 'HFT248D':  # overlap = 0.84
+        z = 2*np.pi/nfft*np.arange(0,nfft)
+        win = 1 - 1.985844164102*np.cos(z) + 1.791176438506*np.cos(2*z) - 1.282075284005*np.cos(3*z) + \
+            0.667777530266*np.cos(4*z) - 0.240160796576*np.cos(5*z) + 0.056656381764*np.cos(6*z) - \
+            0.008134974479*np.cos(7*z) + 0.000624544650*np.cos(8*z) - 0.000019808998*np.cos(9*z) + \
+            0.000000132974*np.cos(10*z)
+    else:
+        raise ValueError("Unknown window {0:s}".format(window))
+
+    return(win)
+
+
+def build_freq_axis(nfft, dt, full):
+    """Creates the frequencies of the fourier coefficients in the fluctana convention.
+    For even nfft the Nyquist frequency appears at both ends of the axis.
+
+    Input:
+    ======
+    nfft: int, number of data points per FFT
+    dt: float, sampling time in s
+    full: bool, if True, then we want the DFT from -fN...0...fN. If false, we do a half-DFT from 0...fN
+
+    Returns:
+    ========
+    ax: ndarray, float. Frequencies of the fourier coefficients
+    """
+
+    ax = np.fft.fftfreq(nfft, d=dt) # full 0~fN -fN~-f1
+    if np.mod(nfft, 2) == 0:  # even nfft
+        ax = np.hstack([ax[0:int(nfft/2)], -(ax[int(nfft/2)]), ax[int(nfft/2):nfft]])
+    if full == 1: # full shift to -fN ~ 0 ~ fN
+        ax = np.fft.fftshift(ax)
+    else: # half 0~fN
+        ax = ax[0:int(nfft/2+1)]
+
+    return(ax)
+
+
+class fft_setup():
+    """Holds window, window factor and frequency axis for a set of STFT parameters.
+    Do not instantiate directly, use get_fft_setup. The arrays are shared and read-only."""
+
+    def __init__(self, nfft, window, overlap, full, dt, workers, periodic=False):
+        """
+        Input:
+        ======
+        nfft: int, number of data points per FFT
+        window: string, name of the window function
+        overlap: float, overlap between successive FFTs, relative to nfft
+        full: bool, If true, calculate frequencies -fN...fN. Otherwise 0...fN
+        dt: float, sampling time in s
+        workers: int, number of threads used by each FFT call. -1 uses all cores.
+        periodic: bool, use the periodic window of scipy's stft. See build_window
+        """
+
+        self.nfft = nfft
+        self.window = window
+        self.overlap = overlap
+        self.full = full
+        self.dt = dt
+        self.workers = workers
+        self.periodic = periodic
+
+        self.win = build_window(nfft, window, periodic)
+        self.win.setflags(write=False)
+        self.win_factor = np.mean(self.win**2)
+
+        # Offset between the starting points of successive FFTs
+        self.step = int(np.fix(nfft * (1.0 - overlap)))
+
+        self.ax = build_freq_axis(nfft, dt, full)
+        self.ax.setflags(write=False)
+
+
+    def get_bins(self, tnum):
+        """Returns the number of overlapping FFTs for a time series of length tnum."""
+        return(int(np.fix((int(tnum/self.nfft) - self.overlap)/(1.0 - self.overlap))))
+
+
+    def fft(self, x, axis=-1):
+        """Transforms x along axis with nfft points, using scipy.fft with self.workers threads.
+        Keeps single precision for float32 input."""
+        return(scipy.fft.fft(x, n=self.nfft, axis=axis, workers=self.workers))
+
+
+@functools.lru_cache(maxsize=32)
+def get_fft_setup(nfft, window, overlap, full=1, dt=1.0, workers=1, periodic=False):
+    """Returns the cached fft_setup for a set of STFT parameters. See fft_setup."""
+    return(fft_setup(nfft, window, overlap, full, dt, workers, periodic))
+
+
+# End of file fft_setup.py
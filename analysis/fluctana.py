@@ -251,20 +251,8 @@ class FluctAna(object):
             D.detrend = detrend
             D.bins = bins
 
-            # make fft data
-            cnum = len(D.data)
-            if full == 1: # full shift to -fN ~ 0 ~ fN
-                if np.mod(nfft, 2) == 0:  # even nfft
-                    D.spdata = np.zeros((cnum, bins, nfft+1), dtype=np.complex_)
-                else:  # odd nfft
-                    D.spdata = np.zeros((cnum, bins, nfft), dtype=np.complex_)
-            else: # half 0 ~ fN
-                D.spdata = np.zeros((cnum, bins, int(nfft/2+1)), dtype=np.complex_)
-
-            for c in range(cnum):
-                print(c, cnum)
-                x = D.data[c,:]
-                D.ax, D.spdata[c,:,:], D.win_factor = sp.fftbins(x, dt, nfft, window, overlap, detrend, full)
+            # make fft data for all channels at once
+            D.ax, D.spdata, D.win_factor = sp.fftbins_batch(D.data, dt, nfft, window, overlap, detrend, full)
 
             # update attributes
             if np.mod(nfft, 2) == 0:
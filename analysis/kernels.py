@@ -0,0 +1,263 @@
+# Coding: UTF-8 -*-
+
+"""
+Registry of the kernels that run on the workers.
+
+The FFT and analysis tasks submit kernels by name instead of passing a function. A name
+is a short string, while a closure defined inside calculate() or do_fft() is pickled by
+value for every task, together with everything it references, f.ex. the task object with
+its window function. Kernels are plain module-level functions and get all parameters as
+arguments, so they do not depend on the state of the driver.
+
+The workers import this module once, see worker_setup.py. Kernels are looked up in the
+registry when a task runs:
+
+>>> dask_client.submit(run_kernel, "stft_scipy", data_future, 0, 32, fft_params)
+>>> dask_client.submit(apply_to_tile, "coherence", pair_idx, fft_future, ch0, ch1)
+
+To add a kernel, decorate it with @register_kernel("name").
+"""
+
+import numpy as np
+import scipy.fft
+from scipy.signal import stft
+
+from analysis import cross_spectra as cs
+from analysis import specs
+from analysis.fft_setup import get_fft_setup
+from analysis.precision import get_dtypes
+
+
+# Maps kernel names to functions
+kernel_registry = {}
+
+
+def register_kernel(name):
+    """Decorator that adds a function to the kernel registry under name."""
+    def decorator(fn):
+        kernel_registry[name] = fn
+        return(fn)
+    return(decorator)
+
+
+def get_kernel(kernel):
+    """Returns a kernel.
+
+    Input:
+    ======
+    kernel: string, name of a registered kernel. Callables are returned as they are.
+
+    Returns:
+    ========
+    fn: callable
+    """
+    if callable(kernel):
+        return(kernel)
+
+    try:
+        return(kernel_registry[kernel])
+    except KeyError:
+        raise ValueError("Unknown kernel {0:s}. Registered kernels: {1}".format(str(kernel), sorted(kernel_registry.keys())))
+
+
+def run_kernel(kernel, *args):
+    """Calls the kernel with name kernel on args. Runs on the workers."""
+    return(get_kernel(kernel)(*args))
+
+
+def get_setup(fft_params):
+    """Returns the cached fft_setup for the parameters returned by task_fft_*.get_fft_params."""
+    return(get_fft_setup(fft_params["nfft"], fft_params["window"], fft_params["overlap"], fft_params["full"],
+                         1. / fft_params["fs"], fft_params.get("fft_workers", 1), fft_params.get("periodic_window", False)))
+
+
+############################################# FFT kernels ###############################################
+
+
+@register_kernel("stft_scipy")
+def stft_scipy(data_in, ch_start, ch_end, fft_params):
+    """ Calculates short-time fourier transformations using scipy.signal.stft
+    Inputs
+    ======
+    data_in: ndarray, float. Time-data to be Fourier-Transformed. dim0: channel, dim1: time
+    ch_start: int, Index of the first channel of the block.
+    ch_end: int, Index after the last channel of the block.
+    fft_params: dict, see task_fft_scipy.get_fft_params
+
+    Returns:
+    ========
+    res[2]: The third element of the return-tuple from stft.
+            ndarray, complex dim0: channel, dim1: Fourier Coefficients. dim2: index of the n-th stft.
+    """
+    setup = get_setup(fft_params)
+    dtype, _ = get_dtypes(fft_params["precision"])
+
+    # stft returns complex64 for float32 input and complex128 for float64 input.
+    # It uses scipy.fft internally, so set_workers sets the number of threads of its FFTs.
+    with scipy.fft.set_workers(setup.workers):
+        res = stft(data_in[ch_start:ch_end, :].astype(dtype, copy=False), fs=fft_params["fs"], nperseg=fft_params["nfft"],
+                   window=setup.win, detrend="linear" if fft_params["detrend"] == 1 else "constant",
+                   noverlap=fft_params["noverlap"], padded=False, return_onesided=False, boundary=None, axis=-1)
+
+    return res[2]
+
+
+@register_kernel("fftbins_kstar")
+def fftbins_kstar(data_in, ch_start, ch_end, fft_params):
+    """Calculates short-time fourier transformations using specs.fftbins_batch
+    Inputs
+    ======
+    data_in: ndarray, float. Time-data to be Fourier-Transformed. dim0: channel, dim1: time
+    ch_start: int, Index of the first channel of the block.
+    ch_end: int, Index after the last channel of the block.
+    fft_params: dict, see task_fft_kstar.get_fft_params
+
+    Returns:
+    ========
+    fft_data: ndarray, complex dim0: channel, dim1: Fourier Coefficients. dim2: index of the n-th stft.
+    """
+    dtype, _ = get_dtypes(fft_params["precision"])
+    _, SX, _ = specs.fftbins_batch(data_in[ch_start:ch_end, :].astype(dtype, copy=False), 1. / fft_params["fs"],
+                                   fft_params["nfft"], fft_params["window"], fft_params["overlap"],
+                                   fft_params["detrend"], fft_params["full"], fft_params.get("fft_workers", 1))
+    # fftbins_batch returns channel, bins, Fourier Coefficients.
+    return(np.ascontiguousarray(SX.transpose(0, 2, 1)))
+
+
+@register_kernel("decimate_bins")
+def decimate_bins(fft_data, ch_start, ch_end, decimate):
+    """Keeps every decimate-th STFT bin of a block of channels. Used to shed load, see scheduling.py.
+
+    Returns:
+    ========
+    fft_data: ndarray, complex. dim0: channel, dim1: Fourier Coefficients, dim2: STFT (every decimate-th bin)
+    """
+    return(np.ascontiguousarray(fft_data[ch_start:ch_end, :, ::decimate]))
+
+
+########################################### Spectral kernels ############################################
+# fft_data: ndarray, complex: Contains the fourier-transformed data.
+#           dim0: channel, dim1: Fourier Coefficients, dim2: STFT (bins in fluctana code)
+# ch0: ndarray, int: indices of the first channel of each pair
+# ch1: ndarray, int: indices of the second channel of each pair
+# All kernels return an array with one row per channel pair.
+
+
+@register_kernel("cross_phase")
+def cross_phase(fft_data, ch0, ch1):
+    """Kernel that calculates the cross-phase for a list of channel pairs.
+
+    Returns:
+    ========
+    cp: ndarray, float. dim0: channel pair, dim1: Fourier Coefficients
+    """
+    return(cs.cross_phase(cs.csd_pairs(fft_data, ch0, ch1)))
+
+
+@register_kernel("cross_power")
+def cross_power(fft_data, ch0, ch1, win_factor):
+    """Kernel that calculates the cross-power for a list of channel pairs.
+    win_factor: float, window factor of the STFT
+
+    Returns:
+    ========
+    cross_power, ndarray, float. dim0: channel pair, dim1: Fourier Coefficients
+    """
+    return(cs.cross_power(cs.csd_pairs(fft_data, ch0, ch1), win_factor))
+
+
+@register_kernel("coherence")
+def coherence(fft_data, ch0, ch1):
+    """Kernel that calculates the coherence for a list of channel pairs.
+
+    Returns:
+    ========
+    coherence, ndarray, float. dim0: channel pair, dim1: Fourier Coefficients
+    """
+    return(cs.coherence(cs.csd_pairs(fft_data, ch0, ch1, normalize=True)))
+
+
+@register_kernel("xspec")
+def xspec(fft_data, ch0, ch1, win_factor, freq_idx, decimate):
+    """Kernel that calculates the cross-spectrogram for a list of channel pairs.
+    win_factor: float, window factor of the STFT
+    freq_idx: None or ndarray, int: indices of the Fourier Coefficients to keep
+    decimate: int, number of STFT bins averaged into one time bin
+
+    Returns:
+    ========
+    xspec, ndarray, float. dim0: channel pair, dim1: Fourier Coefficients, dim2: time bin
+    """
+    return(cs.cross_spectrogram(fft_data, ch0, ch1, win_factor, freq_idx, decimate))
+
+
+@register_kernel("cross_correlation")
+def cross_correlation(fft_data, ch0, ch1, fft_params):
+    """Kernel that calculates the cross-correlation for a list of channel pairs.
+    fft_params: dict, parameters of the fourier-transformed data
+
+    Returns:
+    ========
+    cross-correlation, ndarray, float. dim0: channel pair, dim1: time lag
+    """
+    return(cs.cross_correlation(cs.csd_pairs(fft_data, ch0, ch1), fft_params))
+
+
+@register_kernel("bicoherence")
+def bicoherence(fft_data, ch0, ch1, is_shifted):
+    """Kernel that calculates the bi-coherence for a list of channel pairs.
+    is_shifted: bool, If true, the Fourier Coefficients are already ordered -fN...0...fN
+
+    Returns:
+    ========
+    sum_val, ndarray, float. Summed bicoherence, see specs.bicoherence. dim0: channel pair
+    """
+    # Transpose to make array layout compatible with code from specs.py
+    res = []
+    for c0, c1 in zip(ch0, ch1):
+        XX = fft_data[c0, :, :].T
+        YY = fft_data[c1, :, :].T
+        if not is_shifted:
+            XX = np.fft.fftshift(XX, axes=1)
+            YY = np.fft.fftshift(YY, axes=1)
+        res.append(specs.bicoherence(XX, YY)[1])
+
+    return(np.array(res))
+
+
+######################################### Kernels on csd_sums ###########################################
+# Calculate the result of an analysis from the per-step sums of cross_spectra.csd_sums.
+# Used when several analyses share the same channel pairs, see execution_plan.
+
+
+@register_kernel("csd_sums")
+def csd_sums(fft_data, ch0, ch1):
+    """Kernel that calculates the per-step sums of the spectra, see cross_spectra.csd_sums."""
+    return(cs.csd_sums(fft_data, ch0, ch1))
+
+
+@register_kernel("cross_phase_from_sums")
+def cross_phase_from_sums(sums, fft_config):
+    Sxy, _, _, _, _ = sums
+    return(cs.cross_phase(Sxy))
+
+
+@register_kernel("cross_power_from_sums")
+def cross_power_from_sums(sums, fft_config):
+    Sxy, _, _, _, nbins = sums
+    return(cs.cross_power(Sxy / nbins, fft_config["win_factor"]))
+
+
+@register_kernel("coherence_from_sums")
+def coherence_from_sums(sums, fft_config):
+    _, Sxy_norm, _, _, nbins = sums
+    return(cs.coherence(Sxy_norm / nbins))
+
+
+@register_kernel("cross_correlation_from_sums")
+def cross_correlation_from_sums(sums, fft_config):
+    Sxy, _, _, _, nbins = sums
+    return(cs.cross_correlation(Sxy / nbins, fft_config))
+
+
+# End of file kernels.py
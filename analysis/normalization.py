@@ -0,0 +1,150 @@
+# Coding: UTF-8 -*-
+
+"""
+Streaming normalization of the ECEI data.
+
+The ECEI data is normalized to an offset level, the median of each channel in the time
+interval t_norm at the beginning of the stream, see kstarecei.py. In the stream, this
+interval can be split over several chunks. ecei_normalization collects the samples that
+fall into t_norm, chunk by chunk, and calculates the offset once the stream has passed
+t_norm. Until then, the data is passed on raw.
+
+Once the offset is known, each chunk is normalized in place:
+    data = (data - offset_lvl) / mean(data - offset_lvl) - 1
+which is evaluated as data * a - b, with a and b per channel. This takes two in-place
+passes over the data and does not allocate a copy of it.
+
+For long intervals, only every n-th sample in t_norm is kept, so that at most max_samples
+samples per channel are stored. The median of the kept samples is an estimate of the median
+of all samples.
+
+>>> norm = ecei_normalization(ecei_cfg["t_norm"], fs)
+>>> norm.update(data, tb)
+>>> if norm.is_ready:
+>>>     norm.apply(data)
+>>> norm.get_state()
+"""
+
+import numpy as np
+
+
+class ecei_normalization():
+    """Collects offset statistics over the chunks of a stream and normalizes the data in place."""
+
+    def __init__(self, t_norm, fs, min_samples=100, max_samples=65536):
+        """
+        Input:
+        ======
+        t_norm: list of two floats, time interval of the offset, in s. The bounds may be given in either order.
+        fs: float, sampling frequency, in Hz
+        min_samples: int, minimum number of samples in t_norm needed to calculate the offset
+        max_samples: int, maximum number of samples per channel that are stored
+        """
+        self.t_lo, self.t_hi = sorted(t_norm)
+        self.fs = fs
+        self.min_samples = min_samples
+
+        # Keep every stride-th sample in t_norm, so that at most max_samples are stored
+        expected = int(np.ceil((self.t_hi - self.t_lo) * fs)) + 1
+        self.stride = max(1, int(np.ceil(expected / max_samples)))
+        self.capacity = expected // self.stride + 1
+
+        # Samples in t_norm, dim0: channel, dim1: sample. Allocated with the first chunk.
+        self.samples = None
+        self.num_samples = 0
+        # Number of samples in t_norm that were seen, including the ones that were not stored
+        self.num_seen = 0
+
+        # One of 'waiting' (t_norm not reached), 'accumulating', 'ready' or
+        # 'failed' (t_norm passed with less than min_samples)
+        self.state = "waiting"
+        self.offset_lvl = None
+        self.offset_std = None
+
+
+    @property
+    def is_ready(self):
+        """True if the offset is known and apply can be called."""
+        return(self.state == "ready")
+
+
+    def update(self, data, tb):
+        """Adds the samples of a chunk that fall into t_norm. Calculates the offset once t_norm is passed.
+        Does nothing once the offset is known.
+
+        Input:
+        ======
+        data: ndarray, float. dim0: channel, dim1: time
+        tb: ndarray, float. Time base of the chunk, in s
+
+        Returns:
+        ========
+        is_ready: bool
+        """
+        if self.state in ["ready", "failed"]:
+            return(self.is_ready)
+
+        idx = np.nonzero((tb >= self.t_lo) & (tb <= self.t_hi))[0]
+        if idx.size > 0:
+            self.state = "accumulating"
+            # Keep every stride-th sample of the interval, counted from its start
+            num_in = idx.size
+            idx = idx[(self.num_seen + np.arange(num_in)) % self.stride == 0]
+            self.num_seen += num_in
+
+            if self.samples is None:
+                self.samples = np.empty((data.shape[0], self.capacity), dtype=data.dtype)
+            num_new = min(idx.size, self.capacity - self.num_samples)
+            self.samples[:, self.num_samples:self.num_samples + num_new] = data[:, idx[:num_new]]
+            self.num_samples += num_new
+
+        if tb[-1] >= self.t_hi:
+            self.finalize()
+
+        return(self.is_ready)
+
+
+    def finalize(self):
+        """Calculates the offset from the collected samples. Called by update once t_norm is passed."""
+        if self.num_seen < self.min_samples:
+            print("*** ecei_normalization: Only {0:d} samples in t_norm = [{1:f}, {2:f}]. Data is not normalized.".format(
+                  self.num_seen, self.t_lo, self.t_hi))
+            self.state = "failed"
+        else:
+            samples = self.samples[:, :self.num_samples]
+            self.offset_lvl = np.median(samples, axis=1, keepdims=True)
+            self.offset_std = samples.std(axis=1)
+            self.state = "ready"
+
+        # The samples are not needed anymore
+        self.samples = None
+
+
+    def apply(self, data):
+        """Normalizes data in place: data = (data - offset_lvl) / mean(data - offset_lvl) - 1
+
+        Input:
+        ======
+        data: ndarray, float. dim0: channel, dim1: time. Overwritten with the normalized data.
+
+        Returns:
+        ========
+        data: The same array
+        """
+        assert(self.is_ready)
+        # mean(data - offset) = mean(data) - offset
+        scale = 1.0 / (data.mean(axis=1, keepdims=True) - self.offset_lvl)
+        shift = self.offset_lvl * scale + 1.0
+
+        np.multiply(data, scale.astype(data.dtype), out=data)
+        np.subtract(data, shift.astype(data.dtype), out=data)
+        return(data)
+
+
+    def get_state(self):
+        """Returns the state of the normalization, f.ex. to store it with the results of a step."""
+        return({"state": self.state, "t_norm": [self.t_lo, self.t_hi], "num_seen": self.num_seen,
+                "num_samples": self.num_samples, "stride": self.stride})
+
+
+# End of file normalization.py
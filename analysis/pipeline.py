@@ -0,0 +1,253 @@
+# Coding: UTF-8 -*-
+
+"""
+Pipelines the time steps of the dask processor.
+
+The stages of a time step are read, dispatch (scatter, FFT and analysis tasks) and store.
+Dispatching only submits work to the cluster, so the driver can read the next step while
+the cluster computes the current one. Storing happens in the background, as the results
+come in, see result_sink.py. step_pipeline keeps track of the steps that are dispatched but
+not yet stored. Once max_in_flight steps are in flight, no new step is read until one of
+them is stored, and until the results queued for the writer of the sink are below its
+max_queue. This back-pressure bounds the memory used on the cluster and on the driver.
+
+The stages above are timed on the driver. The work on the cluster is timed with done
+callbacks on the futures of a step, see pipeline_step.watch: "fft" is the time at which the
+fourier-transformed data of the step is complete, "analysis" the time at which its last
+tile is complete. step_pipeline.summary reports how long the cluster computed each step and
+how much of this time overlaps with other steps.
+
+>>> pipe = step_pipeline(max_in_flight=2, sink=result_sink(write_fn))
+>>> while reader.BeginStep():
+>>>     pipe.wait_for_slot()
+>>>     step = pipeline_step(s)
+>>>     ...read, dispatch...
+>>>     step.watch("fft", fft_futures)
+>>>     step.snapshot(task_list)
+>>>     step.watch("analysis", step.get_futures())
+>>>     pipe.push(step)
+>>> pipe.drain()
+"""
+
+from collections import deque
+import threading
+import timeit
+
+import numpy as np
+
+
+class pipeline_step():
+    """Holds the futures and stage timings of a single time step."""
+
+    def __init__(self, step):
+        """
+        Input:
+        ======
+        step: int, index of the time step
+        """
+        self.step = step
+        # Time stamps of the beginning and end of each stage, f.ex. {"read": [t0, t1]}
+        self.timing = {}
+        # List of (task, futures_list, accumulator_futures) of the analysis tasks
+        self.task_futures = []
+        # Other metrics of the step, f.ex. {"transfer_MB": 12.3}. Reported by describe
+        self.metrics = {}
+        # Time at which all futures of a watched stage are complete, f.ex. {"fft": t}. See watch
+        self.completed = {}
+        # Number of futures that are not yet complete, for each watched stage
+        self.num_pending = {}
+        # Done callbacks run in other threads
+        self.lock = threading.Lock()
+
+
+    def start(self, stage):
+        """Records the beginning of a stage."""
+        self.timing[stage] = [timeit.default_timer(), None]
+
+
+    def stop(self, stage):
+        """Records the end of a stage."""
+        self.timing[stage][1] = timeit.default_timer()
+
+
+    def watch(self, stage, futures):
+        """Records the time at which the last of futures is complete, in self.completed[stage].
+        Uses done callbacks and does not block.
+
+        Input:
+        ======
+        stage: string, f.ex. 'fft' or 'analysis'
+        futures: list of futures
+        """
+        futures = list(futures)
+        with self.lock:
+            self.num_pending[stage] = len(futures)
+            if len(futures) == 0:
+                self.completed[stage] = timeit.default_timer()
+        for f in futures:
+            f.add_done_callback(lambda f, stage=stage: self.on_done(stage))
+
+
+    def on_done(self, stage):
+        """Done callback of the futures of a watched stage."""
+        t_done = timeit.default_timer()
+        with self.lock:
+            self.num_pending[stage] -= 1
+            if self.num_pending[stage] == 0:
+                self.completed[stage] = t_done
+
+
+    def get_futures(self):
+        """Returns the futures of all analysis tasks of this step, including the accumulator futures."""
+        return([f for _, futures_list, accumulator_futures in self.task_futures for f in futures_list + accumulator_futures])
+
+
+    def get_compute_times(self):
+        """Returns the time the cluster spent on this step, from the start of the dispatch.
+
+        Returns:
+        ========
+        times: dict with the time span [t_start, t_end] of "fft" (dispatch until the fourier-transformed
+               data is complete), "analysis" (until the last tile is complete) and "compute" (both).
+               Stages that were not watched, or are not complete, are left out.
+        """
+        times = {}
+        if "dispatch" not in self.timing:
+            return(times)
+        t_start = self.timing["dispatch"][0]
+        with self.lock:
+            completed = dict(self.completed)
+        if "fft" in completed:
+            times["fft"] = [t_start, completed["fft"]]
+        if "analysis" in completed:
+            times["analysis"] = [completed.get("fft", t_start), completed["analysis"]]
+            times["compute"] = [t_start, completed["analysis"]]
+        return(times)
+
+
+    def snapshot(self, task_list):
+        """Stores the futures of the analysis tasks of this step.
+        Call after the tasks are dispatched. The next dispatch overwrites the futures in the task objects."""
+        self.task_futures = [(task, list(task.futures_list), list(getattr(task, "accumulator_futures", []) or []))
+                             for task in task_list]
+
+
+    def describe(self, t0=0.0):
+        """Returns a string with the time span of each stage, relative to t0."""
+        stages = ["{0:s} {1:7.3f}-{2:7.3f}s".format(stage, t[0] - t0, t[1] - t0)
+                  for stage, t in self.timing.items() if t[1] is not None]
+        with self.lock:
+            completed = dict(self.completed)
+        stages += ["{0:s} done {1:7.3f}s".format(stage, t - t0) for stage, t in completed.items()]
+        stages += ["{0:s} {1:g}".format(key, val) for key, val in self.metrics.items()]
+        return("Step {0:04d}: ".format(self.step) + ", ".join(stages))
+
+
+class step_pipeline():
+    """Keeps track of the time steps that are dispatched but not yet stored."""
+
+    def __init__(self, max_in_flight, sink, scheduler=None):
+        """
+        Input:
+        ======
+        max_in_flight: int, maximum number of steps that are dispatched but not yet stored
+        sink: result_sink, stores the results of the steps in the background. See analysis/result_sink.py
+        scheduler: deadline_policy or None. Observes the latency of the stored steps, see analysis/scheduling.py
+        """
+        assert(max_in_flight >= 1)
+        self.max_in_flight = max_in_flight
+        self.sink = sink
+        self.scheduler = scheduler
+
+        # Time when the pipeline was created. Stage timings are reported relative to this.
+        self.t0 = timeit.default_timer()
+        # Stored steps, used for the timing summary
+        self.finished = []
+
+
+    def collect(self, block=False):
+        """Reports the steps that the sink has stored since the last call.
+
+        Input:
+        ======
+        block: bool, If true, wait until at least one more step is stored
+        """
+        for step in self.sink.pop_written(block):
+            if self.scheduler is not None:
+                self.scheduler.observe(step)
+            print(step.describe(self.t0))
+            self.finished.append(step)
+
+
+    def is_full(self):
+        """Returns true if max_in_flight steps are in flight."""
+        return(self.sink.num_in_flight() >= self.max_in_flight)
+
+
+    def wait_for_slot(self, block=True):
+        """Back-pressure: Waits until less than max_in_flight steps are in flight, and until
+        less than max_queue results wait for the writer thread of the sink.
+
+        Input:
+        ======
+        block: bool. If false, only report the stored steps. Used when full steps are dropped instead, see scheduling.py
+        """
+        self.collect()
+        if self.scheduler is not None:
+            self.scheduler.check_in_flight(self.sink.in_flight_steps())
+        while block and self.is_full():
+            self.collect(block=True)
+        if block:
+            self.sink.wait_for_queue()
+            self.collect()
+
+
+    def push(self, step):
+        """Passes a dispatched step to the sink. Does not block."""
+        self.sink.add_step(step)
+        self.collect()
+
+
+    def drain(self):
+        """Waits until all steps in flight are stored."""
+        self.sink.close()
+        self.collect()
+
+
+    def summary(self):
+        """Compares the total elapsed time to the sum of the stage latencies of all steps.
+        With overlapping stages, the elapsed time is less than the sum of the latencies.
+
+        Also reports the mean time the cluster spent on the FFT and the analysis of a step, and
+        the overlap: the time during which the cluster computed more than one step."""
+        if len(self.finished) == 0:
+            return("No steps processed")
+
+        t_elapsed = max([step.timing["store"][1] for step in self.finished]) - self.t0
+        t_latency = sum([t[1] - t[0] for step in self.finished for t in step.timing.values()])
+        res = "Processed {0:d} steps in {1:6.3f}s ({2:6.3f}s per step). Sum of stage latencies: {3:6.3f}s".format(
+            len(self.finished), t_elapsed, t_elapsed / len(self.finished), t_latency)
+
+        times = [step.get_compute_times() for step in self.finished]
+        spans = [t["compute"] for t in times if "compute" in t]
+        if len(spans) > 0:
+            t_fft = np.mean([t["fft"][1] - t["fft"][0] for t in times if "fft" in t])
+            t_analysis = np.mean([t["analysis"][1] - t["analysis"][0] for t in times if "analysis" in t])
+            t_compute = sum([t1 - t0 for t0, t1 in spans])
+            res += "\nCluster: FFT {0:6.3f}s, analysis {1:6.3f}s per step. Computing {2:6.3f}s in total, of which {3:6.3f}s overlap with other steps".format(
+                t_fft, t_analysis, t_compute, t_compute - union_length(spans))
+        return(res)
+
+
+def union_length(spans):
+    """Returns the length of the union of time spans [t0, t1]."""
+    total = 0.0
+    t_end = -np.inf
+    for t0, t1 in sorted(spans):
+        if t1 > t_end:
+            total += t1 - max(t0, t_end)
+            t_end = t1
+    return(total)
+
+
+# End of file pipeline.py
@@ -0,0 +1,46 @@
+# Coding: UTF-8 -*-
+
+"""
+Defines the floating point precision used throughout the pipeline.
+
+The precision is set with the 'precision' field of the configuration file:
+"double" (default) keeps data as float64 and fourier coefficients as complex128,
+"single" keeps data as float32 and fourier coefficients as complex64.
+Single precision halves memory usage and the volume of data scattered to the workers.
+See tests_analysis/test_precision.py for the accuracy of single vs. double precision.
+"""
+
+import numpy as np
+
+
+# Maps a precision setting to the data type of real and complex data
+precision_dtypes = {"double": (np.float64, np.complex128),
+                    "single": (np.float32, np.complex64)}
+
+
+def get_dtypes(precision="double"):
+    """Returns the real and complex data type for a given precision.
+
+    Input:
+    ======
+    precision: string, either 'double' or 'single'
+
+    Returns:
+    ========
+    real_dtype, complex_dtype: numpy data types
+    """
+
+    try:
+        return(precision_dtypes[precision])
+    except KeyError:
+        raise ValueError("Unknown precision {0:s}. Use one of {1}".format(str(precision), list(precision_dtypes.keys())))
+
+
+def complex_dtype(real_dtype):
+    """Returns the complex data type that matches a real data type.
+    float32 maps to complex64, everything else to complex128."""
+
+    return(np.result_type(real_dtype, np.complex64))
+
+
+# End of file precision.py
@@ -0,0 +1,248 @@
+# Coding: UTF-8 -*-
+
+"""
+Collects the results of the analysis tasks as their futures complete, and stores them
+from a background thread.
+
+The futures of a step are not waited for in the order they were submitted. Each finished
+tile is copied into the result array of its task as soon as it is done, see
+task_spectral.apply_to_tile. Once all tiles of a task are in, the assembled array is put
+into a queue. A writer thread takes the arrays from the queue and passes them to the write
+function, f.ex. np.savez or a mongodb backend. Fast tasks are stored as soon as they finish,
+independent of slow tasks such as the bicoherence.
+
+The callbacks run in threads of the executor, or in the caller of add_step if a future is
+already finished. They never block: the queue is unbounded. The number of queued results is
+limited by the main loop instead, which waits in wait_for_queue before it dispatches the next
+step, see pipeline.step_pipeline.wait_for_slot.
+
+Accumulated estimates (see cross_spectra.csd_accumulator) are updated in step order.
+Steps that complete early are held back until the previous steps are in. Steps where a task
+is not dispatched, f.ex. when load is shed (see scheduling.py), are left out.
+
+>>> sink = result_sink(write_fn, max_queue=8)
+>>> sink.add_step(step)   # Does not block
+>>> sink.wait_for_queue() # Back-pressure: Blocks while max_queue results wait for the writer
+>>> sink.close()          # Waits until everything is written
+"""
+
+from collections import deque
+import queue
+import threading
+
+import numpy as np
+
+
+class task_result():
+    """Assembles the result array of one task at one step from the finished tiles."""
+
+    def __init__(self, task, step, num_tiles):
+        self.task = task
+        self.step = step
+        self.num_pending = num_tiles
+        self.res = None
+        self.failed = False
+
+
+    def add_tile(self, pair_idx, res_tile):
+        """Copies the result of a tile into the result array.
+        Returns true once all tiles are in."""
+        if self.res is None:
+            num_pairs = sum([len(tile[0]) for tile in self.task.get_dispatch_tiles()])
+            self.res = np.zeros((num_pairs,) + res_tile.shape[1:], dtype=res_tile.dtype)
+        self.res[pair_idx] = res_tile
+        self.num_pending -= 1
+        return(self.num_pending == 0)
+
+
+class result_sink():
+    """Stores the results of pipeline_steps from a background thread, in completion order."""
+
+    def __init__(self, write_fn, max_queue=8):
+        """
+        Input:
+        ======
+        write_fn: callable, write_fn(task, step, name, res) stores the result res of a task at step.
+                  name is 'res' for the result of the step and 'res_acc' for the accumulated estimate.
+        max_queue: int, number of results waiting for the writer thread at which wait_for_queue blocks
+        """
+        self.write_fn = write_fn
+        self.max_queue = max_queue
+        # Unbounded, so that the callbacks never block. See wait_for_queue.
+        self.queue = queue.Queue()
+
+        # Protects the bookkeeping below. Future callbacks run in other threads.
+        self.lock = threading.Condition()
+        # Number of results that are not yet written, for each step
+        self.num_unwritten = {}
+        # Steps by index, until all their results are written
+        self.steps = {}
+        # Steps that are completely written, in completion order
+        self.written = []
+        # Finished accumulator sums of each task by step, until the previous steps are in
+        self.acc_pending = {}
+        # Steps that are added to the accumulator of each task, in order
+        self.acc_order = {}
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+
+    def add_step(self, step):
+        """Registers the futures of a pipeline_step. Does not block on the futures.
+
+        Input:
+        ======
+        step: pipeline_step, with the futures of the analysis tasks, see pipeline_step.snapshot
+        """
+        step.start("store")
+        # Accumulators are only updated by tasks that dispatched their per-step sums. Otherwise
+        # no callback would ever write the accumulated result, and the step would not finish.
+        accumulates = [task.accumulator is not None and len(accumulator_futures) > 0
+                       for task, _, accumulator_futures in step.task_futures]
+        with self.lock:
+            for (task, _, _), acc in zip(step.task_futures, accumulates):
+                # Steps are added in order
+                if acc:
+                    self.acc_order.setdefault(task, deque()).append(step.step)
+            self.steps[step.step] = step
+            self.num_unwritten[step.step] = sum([2 if acc else 1 for acc in accumulates])
+            if self.num_unwritten[step.step] == 0:
+                self.step_written(step.step)
+
+        for (task, futures_list, accumulator_futures), acc in zip(step.task_futures, accumulates):
+            collector = task_result(task, step.step, len(futures_list))
+            for f in futures_list:
+                f.add_done_callback(lambda f, collector=collector: self.on_tile_done(collector, f))
+
+            if acc:
+                sums = [None] * len(accumulator_futures)
+                for i, f in enumerate(accumulator_futures):
+                    f.add_done_callback(lambda f, task=task, i=i, sums=sums: self.on_sums_done(task, step.step, sums, i, f))
+
+        return None
+
+
+    def on_tile_done(self, collector, future):
+        """Callback of the futures of the tiles. Queues the result once all tiles are in."""
+        try:
+            pair_idx, res_tile = future.result()
+            with self.lock:
+                is_complete = collector.add_tile(pair_idx, res_tile)
+        except Exception as exc:
+            print("*** result_sink: {0:s} at step {1:d} failed: {2}".format(collector.task.description, collector.step, exc))
+            with self.lock:
+                collector.failed = True
+                collector.num_pending -= 1
+                is_complete = collector.num_pending == 0
+
+        if is_complete:
+            self.queue.put((collector.task, collector.step, "res", None if collector.failed else collector.res))
+
+
+    def on_sums_done(self, task, step, sums, i, future):
+        """Callback of the accumulator futures. Updates accumulators in step order."""
+        try:
+            res = future.result()
+        except Exception as exc:
+            print("*** result_sink: accumulator of {0:s} at step {1:d} failed: {2}".format(task.description, step, exc))
+            res = exc
+
+        with self.lock:
+            # Only the callback that fills the last slot passes on the sums of the step
+            sums[i] = res
+            if any([s is None for s in sums]):
+                return
+            pending = self.acc_pending.setdefault(task, {})
+            pending[step] = sums
+
+            # Add all steps to the accumulator that are next in line
+            to_write = []
+            order = self.acc_order[task]
+            while len(order) > 0 and order[0] in pending:
+                s = order.popleft()
+                step_sums = pending.pop(s)
+                res_acc = None
+                if not any([isinstance(x, Exception) for x in step_sums]):
+                    task.update_accumulator(accumulator_sums=step_sums)
+                    res_acc = task.get_accumulated_results()
+                to_write.append((task, s, "res_acc", res_acc))
+
+        for item in to_write:
+            self.queue.put(item)
+
+
+    def write_loop(self):
+        """Runs in the writer thread. Writes the queued results until None is queued."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            task, step, name, res = item
+            if res is not None:
+                try:
+                    self.write_fn(task, step, name, res)
+                except Exception as exc:
+                    print("*** result_sink: writing {0:s} at step {1:d} failed: {2}".format(task.description, step, exc))
+
+            with self.lock:
+                self.num_unwritten[step] -= 1
+                if self.num_unwritten[step] == 0:
+                    self.step_written(step)
+                # Wake up wait_for_queue
+                self.lock.notify_all()
+
+
+    def step_written(self, step_idx):
+        """Marks a step as completely written. Call with self.lock held."""
+        step = self.steps.pop(step_idx)
+        self.num_unwritten.pop(step_idx)
+        step.stop("store")
+        self.written.append(step)
+        self.lock.notify_all()
+
+
+    def pop_written(self, block=False):
+        """Returns the steps that were completely written since the last call.
+
+        Input:
+        ======
+        block: bool. If true, wait until at least one step is written
+        """
+        with self.lock:
+            if block:
+                self.lock.wait_for(lambda: len(self.written) > 0)
+            written = self.written
+            self.written = []
+        return(written)
+
+
+    def wait_for_queue(self):
+        """Waits until less than max_queue results wait for the writer thread.
+        Called by the main loop, never by the callbacks."""
+        with self.lock:
+            self.lock.wait_for(lambda: self.queue.qsize() < self.max_queue)
+
+
+    def num_in_flight(self):
+        """Returns the number of steps that are not completely written."""
+        with self.lock:
+            return(len(self.steps))
+
+
+    def in_flight_steps(self):
+        """Returns the pipeline_steps that are not completely written."""
+        with self.lock:
+            return(list(self.steps.values()))
+
+
+    def close(self):
+        """Waits until all results are written and stops the writer thread."""
+        with self.lock:
+            self.lock.wait_for(lambda: len(self.steps) == 0)
+        self.queue.put(None)
+        self.writer.join()
+
+
+# End of file result_sink.py
@@ -0,0 +1,189 @@
+# Coding: UTF-8 -*-
+
+"""
+Deadline-aware scheduling of the time steps for near-real-time operation.
+
+Each time step should be stored within a latency budget, measured from the start of its
+read to the end of its store. When steps take longer, the processor falls further and
+further behind the stream. deadline_policy then sheds load, one level at a time, in this
+order:
+
+1. Skip the analyses of the lowest priority class for the step, f.ex. the bicoherence.
+   Then the next priority class, and so on. The highest priority class is never skipped.
+2. Decimate the STFT bins: Only every n-th bin is passed to the analysis tasks.
+3. Drop whole steps: A step is read, but not dispatched, if the pipeline is full.
+
+The level increases by one whenever a step that ran at the current level misses the
+deadline, or is still in flight after the deadline. It decreases by one after relax_after
+consecutive steps that finished within relax * budget.
+
+The decision for each step is recorded, see deadline_policy.decisions, and stored
+together with the results.
+
+Configuration, all fields but budget are optional:
+"deadline": {"budget": 2.0, "actions": ["skip", "decimate", "drop"], "decimate": 2,
+             "relax": 0.5, "relax_after": 3}
+The priority of a task is set with "priority" in its configuration, see task_spectral.
+"""
+
+import timeit
+
+from analysis.kernels import run_kernel
+from analysis.sharding import sharded_data
+
+
+class deadline_policy():
+    """Decides which work to shed for each time step, based on the latency of the previous steps."""
+
+    def __init__(self, deadline_cfg, task_list):
+        """
+        Input:
+        ======
+        deadline_cfg: dict, see the module documentation
+        task_list: list of task_spectral objects
+        """
+        # Latency budget for each step, in s
+        self.budget = deadline_cfg["budget"]
+        # Only every decimate-th STFT bin is kept when the decimate level is reached
+        self.decimate = deadline_cfg.get("decimate", 2)
+        # Shedding is reduced after relax_after steps with a latency below relax * budget
+        self.relax = deadline_cfg.get("relax", 0.5)
+        self.relax_after = deadline_cfg.get("relax_after", 3)
+        actions = deadline_cfg.get("actions", ["skip", "decimate", "drop"])
+
+        self.task_list = task_list
+
+        # Ladder of shedding actions. At level L, the first L actions are applied.
+        self.ladder = []
+        if "skip" in actions:
+            priorities = sorted(set([task.priority for task in task_list]))
+            self.ladder += [("skip", p) for p in priorities[:-1]]
+        if "decimate" in actions and self.decimate > 1:
+            self.ladder.append(("decimate", self.decimate))
+        if "drop" in actions:
+            self.ladder.append(("drop", None))
+
+        self.level = 0
+        # Number of consecutive steps within relax * budget
+        self.num_fast = 0
+        # Decision for each step, by step index
+        self.decisions = {}
+
+
+    def get_actions(self):
+        """Returns the shedding actions of the current level."""
+        return(self.ladder[:self.level])
+
+
+    def may_drop(self):
+        """Returns true if steps are dropped at the current level.
+        In this case, the processor should not block while the pipeline is full."""
+        return(("drop", None) in self.get_actions())
+
+
+    def escalate(self, step_idx):
+        """Raises the level by one, because step step_idx misses the deadline.
+        Steps that were dispatched at a lower level do not raise the level again."""
+        self.num_fast = 0
+        if self.decisions[step_idx]["level"] < self.level or self.level == len(self.ladder):
+            return None
+
+        self.level += 1
+        print("*** deadline_policy: Step {0:d} misses the deadline of {1:5.3f}s. Shedding level {2:d}: {3}".format(
+              step_idx, self.budget, self.level, self.get_actions()))
+        return None
+
+
+    def observe(self, step):
+        """Updates the level with the latency of a stored step. Called by step_pipeline.
+
+        Input:
+        ======
+        step: pipeline_step, with the timings of the read and the store stage
+        """
+        latency = step.timing["store"][1] - step.timing["read"][0]
+        step.metrics["latency"] = latency
+        if step.step not in self.decisions:
+            return None
+        self.decisions[step.step]["latency"] = latency
+
+        if latency > self.budget:
+            self.escalate(step.step)
+        elif latency < self.relax * self.budget:
+            self.num_fast += 1
+            if self.num_fast >= self.relax_after and self.level > 0:
+                self.level -= 1
+                self.num_fast = 0
+                print("*** deadline_policy: Relaxing to shedding level {0:d}: {1}".format(self.level, self.get_actions()))
+        else:
+            self.num_fast = 0
+
+
+    def check_in_flight(self, steps):
+        """Raises the level if a step in flight is already past the deadline.
+
+        Input:
+        ======
+        steps: list of pipeline_step that are dispatched, but not yet stored
+        """
+        t_now = timeit.default_timer()
+        for step in steps:
+            if t_now - step.timing["read"][0] > self.budget and not self.decisions[step.step]["late"]:
+                self.decisions[step.step]["late"] = True
+                self.escalate(step.step)
+
+
+    def decide(self, step, pipe_full):
+        """Decides which work is shed for a step. Call after the step is read.
+
+        Input:
+        ======
+        step: pipeline_step
+        pipe_full: bool, true if the maximum number of steps is in flight
+
+        Returns:
+        ========
+        decision: dict with fields
+                  "level": shedding level
+                  "skipped": list of the descriptions of the tasks that are not dispatched
+                  "decimate": int, only every decimate-th STFT bin is used
+                  "dropped": bool, if true the step is not dispatched at all
+                  "latency": float, time from read to store in s. Set once the step is stored
+                  "late": bool, true if the step was still in flight after the deadline
+        """
+        actions = self.get_actions()
+        skip_priorities = [p for action, p in actions if action == "skip"]
+
+        decision = {"level": self.level,
+                    "skipped": [task.description for task in self.task_list if task.priority in skip_priorities],
+                    "decimate": max([1] + [d for action, d in actions if action == "decimate"]),
+                    "dropped": self.may_drop() and pipe_full,
+                    "latency": None,
+                    "late": False}
+        self.decisions[step.step] = decision
+        step.metrics["shed_level"] = self.level
+        return(decision)
+
+
+def decimate_fft_data(dask_client, fft_future, num_channels, decimate):
+    """Keeps every decimate-th STFT bin of the fourier-transformed data, on the workers.
+
+    Input:
+    ======
+    dask_client: dask client
+    fft_future: future to the fourier-transformed data, or sharded_data
+    num_channels: int, number of channels
+    decimate: int
+
+    Returns:
+    ========
+    future to the decimated data, or sharded_data
+    """
+    if isinstance(fft_future, sharded_data):
+        return(fft_future.map_blocks(dask_client, run_kernel, fft_future.bytes_per_channel // decimate,
+                                     args=(decimate,), pre_args=("decimate_bins",)))
+
+    return(dask_client.submit(run_kernel, "decimate_bins", fft_future, 0, num_channels, decimate))
+
+
+# End of file scheduling.py
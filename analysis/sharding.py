@@ -0,0 +1,181 @@
+# Coding: UTF-8 -*-
+
+"""
+Locality-aware placement of channel data on the workers.
+
+By default the raw data of a step is scattered with broadcast=True, so every worker
+receives all channels, and the fourier-transformed data is moved to wherever the pair
+tasks run. In sharded mode, the channels are split into blocks and each block is
+placed on one worker:
+
+* The raw data of a block is scattered only to its worker.
+* The FFT of a block runs on the worker that holds the block, and the result stays there.
+* A tile of channel pairs runs on the worker that holds most of the channels it needs.
+  Only the missing blocks are moved.
+
+sharded_data keeps the futures of the blocks and where they live. It counts the bytes
+that are moved to other workers, so the transfer volume of each step can be monitored.
+
+>>> sharding = channel_sharding(192, 16, get_worker_addresses(dask_client))
+>>> data_shards = sharding.scatter(dask_client, stream_data)
+>>> fft_shards = my_fft.do_fft(dask_client, data_shards, 192)
+>>> plan.calculate(dask_client, fft_shards)
+>>> fft_shards.transfer_bytes
+"""
+
+import numpy as np
+
+
+def get_worker_addresses(dask_client):
+    """Returns the addresses of the workers of a dask client.
+    The local executors have a single worker, 'local'."""
+    if hasattr(dask_client, "scheduler_info"):
+        return(sorted(dask_client.scheduler_info()["workers"].keys()))
+    return(["local"])
+
+
+class channel_sharding():
+    """Assigns blocks of consecutive channels to workers, round-robin."""
+
+    def __init__(self, num_channels, block_size, workers):
+        """
+        Input:
+        ======
+        num_channels: int, total number of channels
+        block_size: int, number of channels per block
+        workers: list of worker addresses
+        """
+        self.num_channels = num_channels
+        self.block_size = block_size
+        self.workers = list(workers)
+
+        # First channel of each block, and the first channel after the last block
+        self.block_starts = np.arange(0, num_channels + block_size, block_size)
+        self.block_starts[-1] = num_channels
+        self.num_blocks = len(self.block_starts) - 1
+        self.block_workers = [self.workers[b % len(self.workers)] for b in range(self.num_blocks)]
+
+
+    def block_of_channel(self, ch_idx):
+        """Returns the block index of linear channel indices."""
+        return(np.asarray(ch_idx) // self.block_size)
+
+
+    def scatter(self, dask_client, data):
+        """Scatters the blocks of data to their workers.
+
+        Input:
+        ======
+        dask_client: dask client
+        data: ndarray. dim0: channel
+
+        Returns:
+        ========
+        sharded_data
+        """
+        futures = [dask_client.scatter(data[self.block_starts[b]:self.block_starts[b + 1]],
+                                       workers=[self.block_workers[b]])
+                   for b in range(self.num_blocks)]
+        # Each block is sent once
+        return(sharded_data(self, futures, data[0].nbytes, scatter_bytes=data.nbytes))
+
+
+def run_on_blocks(fn, pre_args, blocks, ch0, ch1, args):
+    """Concatenates the blocks and calls fn(*pre_args, data, ch0, ch1, *args). Runs on the workers.
+    ch0 and ch1 index into the concatenation of the blocks."""
+    return(fn(*pre_args, np.concatenate(blocks, axis=0), ch0, ch1, *args))
+
+
+class sharded_data():
+    """Futures of the blocks of a channel_sharding, together with the transfer volume of the step."""
+
+    def __init__(self, sharding, futures, bytes_per_channel, scatter_bytes=0):
+        """
+        Input:
+        ======
+        sharding: channel_sharding
+        futures: list of futures, one per block of the sharding
+        bytes_per_channel: int, size of the data of a single channel, in bytes
+        scatter_bytes: int, number of bytes sent by the client to create the blocks
+        """
+        self.sharding = sharding
+        self.futures = futures
+        self.bytes_per_channel = bytes_per_channel
+        self.scatter_bytes = scatter_bytes
+        # Number of bytes that are moved between workers by the tasks submitted with submit_pairs
+        self.transfer_bytes = 0
+        # Workers that hold a copy of each block. dask keeps blocks that were moved to a worker,
+        # so later tasks on that worker do not move them again.
+        self.replicas = [{worker} for worker in sharding.block_workers]
+
+
+    def map_blocks(self, dask_client, fn, bytes_per_channel, args=(), pre_args=()):
+        """Submits fn(*pre_args, block, 0, num_channels_of_block, *args) on the worker of each block.
+
+        Input:
+        ======
+        fn: callable, f.ex. kernels.run_kernel
+        bytes_per_channel: int, size of the result of fn for a single channel, in bytes
+        args: tuple, arguments passed after the channel range
+        pre_args: tuple, arguments passed before the block, f.ex. the name of the kernel
+
+        Returns:
+        ========
+        sharded_data with the results
+        """
+        sh = self.sharding
+        futures = [dask_client.submit(fn, *pre_args, self.futures[b], 0, sh.block_starts[b + 1] - sh.block_starts[b], *args,
+                                      workers=[sh.block_workers[b]])
+                   for b in range(sh.num_blocks)]
+        return(sharded_data(sh, futures, bytes_per_channel))
+
+
+    def submit_pairs(self, dask_client, fn, ch0, ch1, args, pre_args=()):
+        """Submits fn(*pre_args, data, ch0, ch1, *args) where data only holds the blocks needed by the pairs.
+        The task is placed on the worker that already holds most of these channels.
+
+        Returns:
+        ========
+        future
+        """
+        sh = self.sharding
+        ch0 = np.asarray(ch0)
+        ch1 = np.asarray(ch1)
+
+        # Blocks needed by the pairs, and where each block starts in their concatenation
+        blocks = np.unique(sh.block_of_channel(np.concatenate([ch0, ch1])))
+        block_sizes = sh.block_starts[blocks + 1] - sh.block_starts[blocks]
+        offsets = np.zeros(sh.num_blocks, dtype=int)
+        offsets[blocks] = np.cumsum(block_sizes) - block_sizes
+
+        def to_local(ch):
+            b = sh.block_of_channel(ch)
+            return(offsets[b] + ch - sh.block_starts[b])
+
+        # Prefer the worker that holds the most channels of the tile. The other blocks are moved there.
+        bytes_on_worker = {}
+        for b, size in zip(blocks, block_sizes):
+            for w in self.replicas[b]:
+                bytes_on_worker[w] = bytes_on_worker.get(w, 0) + size * self.bytes_per_channel
+        worker = max(bytes_on_worker, key=bytes_on_worker.get)
+        self.transfer_bytes += block_sizes.sum() * self.bytes_per_channel - bytes_on_worker[worker]
+        for b in blocks:
+            self.replicas[b].add(worker)
+
+        return(dask_client.submit(run_on_blocks, fn, pre_args, [self.futures[b] for b in blocks],
+                                  to_local(ch0), to_local(ch1), args,
+                                  workers=[worker], allow_other_workers=True))
+
+
+def submit_pairs(dask_client, fn, fft_data, ch0, ch1, *args, pre_args=()):
+    """Submits fn(*pre_args, fft_data, ch0, ch1, *args) for a list of channel pairs.
+
+    fft_data is either a future to the fourier-transformed data of all channels, or a
+    sharded_data. In the latter case, the task runs close to its data, see sharded_data.submit_pairs.
+    """
+    if isinstance(fft_data, sharded_data):
+        return(fft_data.submit_pairs(dask_client, fn, ch0, ch1, args, pre_args))
+    return(dask_client.submit(fn, *pre_args, fft_data, ch0, ch1, *args))
+
+
+# End of file sharding.py
@@ -1,86 +1,68 @@
 # Encoding: UTF-8 -*-
 import time
+import functools
 
 import numpy as np
 import dask.array as da
 from scipy import signal
 
+from .precision import complex_dtype
+from .fft_setup import get_fft_setup
+
 
 def fft_window(tnum, nfft, window, overlap):
     # IN : full length of time series, nfft, window name, overlap ratio
-    # OUT : bins, 1 x nfft window function
-
-    # use overlapping
-    bins = int(np.fix((int(tnum/nfft) - overlap)/(1.0 - overlap)))
-
-    # window function
-    if window == 'rectwin':  # overlap = 0.5
-        win = np.ones(nfft)
-    elif window == 'hann':  # overlap = 0.5
-        win = np.hanning(nfft)
-    elif window == 'hamm':  # overlap = 0.5
-        win = np.hamming(nfft)
-    elif window == 'kaiser':  # overlap = 0.62
-        win = np.kaiser(nfft, beta=30)
-    elif window == 'HFT248D':  # overlap = 0.84
-        z = 2*np.pi/nfft*np.arange(0,nfft)
-        win = 1 - 1.985844164102*np.cos(z) + 1.791176438506*np.cos(2*z) - 1.282075284005*np.cos(3*z) + \
-            0.667777530266*np.cos(4*z) - 0.240160796576*np.cos(5*z) + 0.056656381764*np.cos(6*z) - \
-            0.008134974479*np.cos(7*z) + 0.000624544650*np.cos(8*z) - 0.000019808998*np.cos(9*z) + \
-            0.000000132974*np.cos(10*z)
-
-    return bins, win
+    # OUT : bins, 1 x nfft window function (cached, read-only)
+    setup = get_fft_setup(nfft, window, overlap)
+
+    return setup.get_bins(tnum), setup.win
 
 
 def fftbins(x, dt, nfft, window, overlap, detrend, full):
     # IN : 1 x tnum data
     # OUT : bins x faxis fftdata
-    tnum = len(x)
-    bins, win = fft_window(tnum, nfft, window, overlap)
-    win_factor = np.mean(win**2)  # window factors
+    ax, fftdata, win_factor = fftbins_batch(x[np.newaxis, :], dt, nfft, window, overlap, detrend, full)
 
-    # make an x-axis #
-    ax = np.fft.fftfreq(nfft, d=dt) # full 0~fN -fN~-f1
-    if np.mod(nfft, 2) == 0:  # even nfft
-        ax = np.hstack([ax[0:int(nfft/2)], -(ax[int(nfft/2)]), ax[int(nfft/2):nfft]])
-    if full == 1: # full shift to -fN ~ 0 ~ fN
-        ax = np.fft.fftshift(ax)
-    else: # half 0~fN
-        ax = ax[0:int(nfft/2+1)]
-
-    # make fftdata
-    if full == 1: # full shift to -fN ~ 0 ~ fN
-        if np.mod(nfft, 2) == 0:  # even nfft
-            fftdata = np.zeros((bins, nfft+1), dtype=np.complex_)
-        else:  # odd nfft
-            fftdata = np.zeros((bins, nfft), dtype=np.complex_)
-    else: # half 0 ~ fN
-        fftdata = np.zeros((bins, int(nfft/2+1)), dtype=np.complex_)
+    return ax, fftdata[0], win_factor
 
-    for b in range(bins):
-        idx1 = int(b*np.fix(nfft*(1 - overlap)))
-        idx2 = idx1 + nfft
 
-        sx = x[idx1:idx2]
+def fftbins_batch(x, dt, nfft, window, overlap, detrend, full, workers=1):
+    # IN : cnum x tnum data, workers: number of threads per FFT call
+    # OUT : cnum x bins x faxis fftdata
+    x = np.asarray(x)
+    cnum, tnum = x.shape
+    # cached window and frequency axis
+    setup = get_fft_setup(nfft, window, overlap, full, dt, workers)
+    bins = setup.get_bins(tnum)
+    win_factor = setup.win_factor  # window factors
+
+    # make an x-axis #
+    ax = setup.ax.copy()
 
-        if detrend == 1:
-            sx = signal.detrend(sx, type='linear')
-        sx = signal.detrend(sx, type='constant')  # subtract mean
+    # view all overlapping segments as cnum x bins x nfft without copying.
+    # Segment b starts at b*fix(nfft*(1 - overlap)), the same as the per-bin loop.
+    sx = np.lib.stride_tricks.as_strided(x, shape=(cnum, bins, nfft),
+                                         strides=(x.strides[0], setup.step*x.strides[1], x.strides[1]),
+                                         writeable=False)
 
-        sx = sx * win  # apply window function
+    if detrend == 1:
+        sx = signal.detrend(sx, type='linear', axis=-1)
+    sx = signal.detrend(sx, type='constant', axis=-1)  # subtract mean
 
-        # get fft
-        SX = np.fft.fft(sx, n=nfft)/nfft  # divide by the length
-        if np.mod(nfft, 2) == 0:  # even nfft
-            SX = np.hstack([SX[0:int(nfft/2)], np.conj(SX[int(nfft/2)]), SX[int(nfft/2):nfft]])
-        if full == 1: # shift to -fN ~ 0 ~ fN
-            SX = np.fft.fftshift(SX)
-        else: # half 0 ~ fN
-            SX = SX[0:int(nfft/2+1)]
+    sx = sx * setup.win.astype(sx.dtype)  # apply window function, keeping the precision of x
 
-        fftdata[b,:] = SX
+    # get fft of all segments in one call
+    SX = setup.fft(sx)/nfft  # divide by the length
+    SX = SX.astype(complex_dtype(sx.dtype), copy=False)  # complex64 for float32 input
+    if np.mod(nfft, 2) == 0:  # even nfft
+        SX = np.concatenate([SX[:, :, 0:int(nfft/2)], np.conj(SX[:, :, int(nfft/2):int(nfft/2)+1]),
+                             SX[:, :, int(nfft/2):nfft]], axis=-1)
+    if full == 1: # shift to -fN ~ 0 ~ fN
+        SX = np.fft.fftshift(SX, axes=-1)
+    else: # half 0 ~ fN
+        SX = SX[:, :, 0:int(nfft/2+1)]
 
-    return ax, fftdata, win_factor
+    return ax, SX, win_factor
 
 
 def cross_power(XX, YY, win_factor):
@@ -145,17 +127,9 @@ def cross_phase(XX, YY):
 
 
 def xspec(XX, YY, win_factor):
-    bins = len(XX)
-
-    val = np.zeros(XX.shape)
-
-    for b in range(bins):
-        X = XX[b,:]
-        Y = YY[b,:]
-
-        Pxy = X*np.matrix.conjugate(Y) / win_factor
-
-        val[b,:] = np.abs(Pxy).real
+    # IN : bins x full fftdata
+    # OUT : bins x full cross-spectrogram |X Y*| / win_factor, all bins at once
+    val = np.abs(XX * np.conj(YY)) / win_factor
 
     return val
 
@@ -164,180 +138,138 @@ def bicoherence(XX, YY):
     # ax1 = self.Dlist[dtwo].ax # full -fN ~ fN
     # ax2 = np.fft.ifftshift(self.Dlist[dtwo].ax) # full 0 ~ fN, -fN ~ -f1
     # ax2 = ax2[0:int(nfft/2+1)] # half 0 ~ fN
+    # IN : bins x full fftdata
+    # OUT : full x half bicoherence, full summed bicoherence
+    # Working memory is a few full x half arrays, independent of the number of bins.
 
     bins = len(XX)
     full = len(XX[0,:]) # full length
     half = int(full/2+1) # half length
 
-    # calculate bicoherence
-    B = np.zeros((full, half), dtype=np.complex_)
-    P12 = np.zeros((full, half))
-    P3 = np.zeros((full, half))
-    val = np.zeros((full, half))
-
-    for b in range(bins):
-        X = XX[b,:] # full -fN ~ fN
-        Y = YY[b,:] # full -fN ~ fN
-
-        Xhalf = np.fft.ifftshift(X) # full 0 ~ fN, -fN ~ -f1
-        Xhalf = Xhalf[0:half] # half 0 ~ fN
+    hidx, sidx, valid = bicoherence_idx(full)
 
-        X1 = np.transpose(np.tile(X, (half, 1)))
-        X2 = np.tile(Xhalf, (full, 1))
-        X3 = np.zeros((full, half), dtype=np.complex_)
-        for j in range(half):
-            if j == 0:
-                X3[0:, j] = Y[j:]
-            else:
-                X3[0:(-j), j] = Y[j:]
+    # X1 = X(f1): full -fN ~ fN, X2 = X(f2): half 0 ~ fN
+    Xhalf = XX[:, hidx]
+    # X3 = Y(f1 + f2), zero outside of -fN ~ fN. Element [b, i, j] of the strided view is
+    # cYpad[b, i + j], so all bins are covered without materializing bins x full x half arrays.
+    cYpad = np.hstack([np.conj(YY), np.zeros((bins, half), dtype=YY.dtype)])
+    cX3 = np.lib.stride_tricks.as_strided(cYpad, shape=(bins, full, half),
+                                          strides=(cYpad.strides[0], cYpad.strides[1], cYpad.strides[1]),
+                                          writeable=False)
 
-        B = B + X1 * X2 * np.matrix.conjugate(X3) / bins #  complex bin average
-        P12 = P12 + (np.abs(X1 * X2).real)**2 / bins # real average
-        P3 = P3 + (np.abs(X3).real)**2 / bins # real average
+    # calculate bicoherence
+    B = np.einsum('bi,bj,bij->ij', XX, Xhalf, cX3) / bins #  complex bin average
+    P12 = np.matmul(np.transpose(np.abs(XX)**2), np.abs(Xhalf)**2) / bins # real average
+    P3 = np.hstack([np.sum(np.abs(YY)**2, axis=0), 0.0])[sidx] / bins # real average
 
     # val = np.log10(np.abs(B)**2) # bispectrum
     val = (np.abs(B)**2) / P12 / P3 # bicoherence
 
-    # summation over pairs
-    sum_val = np.zeros(full)
-    for i in range(half):
-        if i == 0:
-            sum_val = sum_val + val[:,i]
-        else:
-            sum_val[i:] = sum_val[i:] + val[:-i,i]
+    # summation over pairs f1 + f2 = f
+    sum_val = np.bincount(sidx[valid], weights=val[valid], minlength=full)
 
-    N = np.array([i+1 for i in range(half)] + [half for i in range(full-half)])
+    N = np.minimum(np.arange(full) + 1, half)
     sum_val = sum_val / N # element wise division
 
     return val, sum_val
 
 
-def ritz_nonlinear(XX, YY):
-    # calculate
-    bins = len(XX)
-    full = len(XX[0,:]) # full length
+@functools.lru_cache(maxsize=16)
+def bicoherence_idx(full):
+    # IN : full length
+    # OUT : half 0 ~ fN indices into full -fN ~ fN, full x half indices of f1 + f2 (full if out of range), valid mask
+    half = int(full/2+1)
 
-    kidx = get_kidx(full)
+    hidx = np.fft.ifftshift(np.arange(full))[0:half]
+    sidx = np.arange(full)[:, np.newaxis] + np.arange(half)[np.newaxis, :]
+    valid = sidx < full
+    sidx[~valid] = full
 
-    Aijk = np.zeros((full, full), dtype=np.complex_) # Xo1 Xo2 cXo
-    cAijk = np.zeros((full, full), dtype=np.complex_) # cXo1 cXo2 Xo
-    Bijk = np.zeros((full, full), dtype=np.complex_) # Yo cXo1 cXo2
-    Aij = np.zeros((full, full)) # |Xo1 Xo2|^2
+    for arr in (hidx, sidx, valid):
+        arr.setflags(write=False)
 
-    Ak = np.zeros(full) # Xo cXo
-    Bk = np.zeros(full, dtype=np.complex_) # Yo cXo
+    return hidx, sidx, valid
 
-    for b in range(bins):
-        X = XX[b,:] # full -fN ~ fN
-        Y = YY[b,:] # full -fN ~ fN
 
-        # make Xi and Xj
-        Xi = np.transpose(np.tile(X, (full, 1))) # columns of (-fN ~ fN)
-        Xj = np.tile(X, (full, 1)) # rows of (-fN ~ fN)
+def ritz_nonlinear(XX, YY):
+    # calculate
+    bins = len(XX)
+    full = len(XX[0,:]) # full length
 
-        # make Xk and Yk
-        Xk = np.zeros((full, full), dtype=np.complex_)
-        Yk = np.zeros((full, full), dtype=np.complex_)
-        for k in range(full):
-            idx = kidx[k]
-            for n, ij in enumerate(idx):
-                Xk[ij] = X[k]
-                Yk[ij] = Y[k]
+    kk, ii, jj, kstart = get_kidx_flat(full)
 
-        # do ensemble average
-        Aijk = Aijk + Xi * Xj * np.matrix.conjugate(Xk) / bins
+    # triad values Xi Xj cXk, evaluated only where f_i + f_j = f_k
+    Xi = XX[:, ii]
+    Xj = XX[:, jj]
+    Xk = XX[:, kk]
+    Yk = YY[:, kk]
 
-        cAijk = cAijk + np.matrix.conjugate(Xi) * np.matrix.conjugate(Xj) * Xk / bins
+    # do ensemble average
+    Aijk = np.zeros((full, full), dtype=np.complex128) # Xo1 Xo2 cXo
+    Aijk[ii, jj] = np.mean(Xi * Xj * np.conj(Xk), axis=0)
 
-        Bijk = Bijk + np.matrix.conjugate(Xi) * np.matrix.conjugate(Xj) * Yk / bins
+    cAijk = np.zeros((full, full), dtype=np.complex128) # cXo1 cXo2 Xo
+    cAijk[ii, jj] = np.mean(np.conj(Xi) * np.conj(Xj) * Xk, axis=0)
 
-        Aij = Aij + (np.abs(Xi * Xj).real)**2 / bins
+    Bijk = np.zeros((full, full), dtype=np.complex128) # Yo cXo1 cXo2
+    Bijk[ii, jj] = np.mean(np.conj(Xi) * np.conj(Xj) * Yk, axis=0)
 
-        Ak = Ak + (np.abs(X).real)**2 / bins
+    Aij = np.matmul(np.transpose(np.abs(XX)**2), np.abs(XX)**2) / bins # |Xo1 Xo2|^2
 
-        Bk = Bk + Y * np.matrix.conjugate(X) / bins
+    Ak = np.mean(np.abs(XX)**2, axis=0) # Xo cXo
+    Bk = np.mean(YY * np.conj(XX), axis=0) # Yo cXo
 
     # Linear transfer function ~ growth rate
-    Lk = np.zeros(full, dtype=np.complex_)
-
-    bsum = np.zeros(full, dtype=np.complex_)
-    asum = np.zeros(full)
-    for k in range(full):
-        idx = kidx[k]
-        for n, ij in enumerate(idx):
-            bsum[k] = bsum[k] + Aijk[ij] * Bijk[ij] / Aij[ij]
-            asum[k] = asum[k] + (np.abs(Aijk[ij]).real)**2 / Aij[ij]
+    bsum = np.add.reduceat(Aijk[ii, jj] * Bijk[ii, jj] / Aij[ii, jj], kstart)
+    asum = np.add.reduceat(np.abs(Aijk[ii, jj])**2 / Aij[ii, jj], kstart)
 
     Lk = (Bk - bsum) / (Ak - asum)
 
     # Quadratic transfer function ~ nonlinear energy transfer rate
-    Lkk = np.zeros((full, full), dtype=np.complex_)
-    for k in range(full):
-        idx = kidx[k]
-        for n, ij in enumerate(idx):
-            Lkk[ij] = Lk[k]
+    Lkk = np.zeros((full, full), dtype=np.complex128)
+    Lkk[ii, jj] = Lk[kk]
 
     Qijk = (Bijk - Lkk * cAijk) / Aij
 
     return Lk, Qijk, Bk, Aijk
 
 
-def wit_nonlinear(XX, YY):
+def wit_nonlinear(XX, YY, kbatch=64):
     # calculate
     bins = len(XX)
     full = len(XX[0,:]) # full length
 
-    kidx = get_kidx(full)
+    kk, ii, jj, kstart = get_kidx_flat(full)
+    # position of each pair within its k
+    nn = np.arange(len(kk)) - kstart[kk]
+    npair = np.diff(np.append(kstart, len(kk)))
 
-    Lk = np.zeros(full, dtype=np.complex_) # Linear
-    Qijk = np.zeros((full, full), dtype=np.complex_) # Quadratic
+    Lk = np.zeros(full, dtype=np.complex128) # Linear
+    Qijk = np.zeros((full, full), dtype=np.complex128) # Quadratic
 
     print('For stable calculations, bins ({0}) >> full/2 ({1})'.format(bins, full/2))
-    for k in range(full):
-        idx = kidx[k]
-
-        # construct equations for each k
-        U = np.zeros((bins, len(idx)+1), dtype=np.complex_)  # N (number of ensembles) x P (number of pairs + 1)
-        V = np.zeros(bins, dtype=np.complex_) # N x 1
-
-        for b in range(bins):
-
-            U[b,0] = XX[b,k]
-            for n, ij in enumerate(idx):
-                U[b,n+1] = XX[b, ij[0]]*XX[b, ij[1]]
-
-            V[b] = YY[b,k]
+    # construct the equations for kbatch values of k at once.
+    # U is zero-padded to the largest number of pairs. The zero columns do not change the
+    # minimum-norm least-squares solution of the other columns, and get zero weight.
+    for k0 in range(0, full, kbatch):
+        k1 = min(k0 + kbatch, full)
+        sel = (kk >= k0) & (kk < k1)
+
+        U = np.zeros((k1 - k0, bins, npair[k0:k1].max() + 1), dtype=np.complex128) # N (number of ensembles) x P (number of pairs + 1)
+        U[:, :, 0] = np.transpose(XX[:, k0:k1])
+        U[kk[sel] - k0, :, nn[sel] + 1] = np.transpose(XX[:, ii[sel]] * XX[:, jj[sel]])
+        V = np.transpose(YY[:, k0:k1])[:, :, np.newaxis] # N x 1
 
         # solution for each k
-        H = np.matmul(np.linalg.pinv(U), V)
+        H = np.matmul(np.linalg.pinv(U), V)[:, :, 0]
 
-        Lk[k] = H[0]
-        for n, ij in enumerate(idx):
-            Qijk[ij] = H[n+1]
+        Lk[k0:k1] = H[:, 0]
+        Qijk[ii[sel], jj[sel]] = H[kk[sel] - k0, nn[sel] + 1]
 
     # calculate others for the rates
-    Aijk = np.zeros((full, full), dtype=np.complex_) # Xo1 Xo2 cXo
-    Bk = np.zeros(full, dtype=np.complex_) # Yo cXo
-
-    # print('DO NOT CALCULATE RATES')
-    for b in range(bins):
-        X = XX[b,:] # full -fN ~ fN
-        Y = YY[b,:] # full -fN ~ fN
-
-        # make Xi and Xj
-        Xi = np.transpose(np.tile(X, (full, 1))) # columns of (-fN ~ fN)
-        Xj = np.tile(X, (full, 1)) # rows of (-fN ~ fN)
-
-        # make Xk and Yk
-        Xk = np.zeros((full, full), dtype=np.complex_)
-        for k in range(full):
-            idx = kidx[k]
-            for n, ij in enumerate(idx):
-                Xk[ij] = X[k]
-
-        # do ensemble average
-        Aijk = Aijk + Xi * Xj * np.matrix.conjugate(Xk) / bins
-        Bk = Bk + Y * np.matrix.conjugate(X) / bins
+    Aijk = np.zeros((full, full), dtype=np.complex128) # Xo1 Xo2 cXo
+    Aijk[ii, jj] = np.mean(XX[:, ii] * XX[:, jj] * np.conj(XX[:, kk]), axis=0)
+    Bk = np.mean(YY * np.conj(XX), axis=0) # Yo cXo
 
     return Lk, Qijk, Bk, Aijk
 
@@ -347,17 +279,14 @@ def nonlinear_rates(Lk, Qijk, Bk, Aijk, dt):
     # dt = vd / dz
     full = len(Lk)
 
-    kidx = get_kidx(full)
+    kk, ii, jj, kstart = get_kidx_flat(full)
 
     # Cross phase related terms
     Ek = (Bk / np.abs(Bk))**(-1.0) # Exp[-i(Tk)]
     Tk = np.arctan2(Bk.imag, Bk.real).real
 
-    Ekk = np.zeros((full, full), dtype=np.complex_)
-    for k in range(full):
-        idx = kidx[k]
-        for n, ij in enumerate(idx):
-            Ekk[ij] = Ek[k]
+    Ekk = np.zeros((full, full), dtype=np.complex128)
+    Ekk[ii, jj] = Ek[kk]
 
     # Linear kernel
     # Gk = (Lk * Ek - 1.0 + 1.0j*Tk) / dz
@@ -376,12 +305,8 @@ def nonlinear_rates(Lk, Qijk, Bk, Aijk, dt):
     Tijk = 1.0/2.0 * 1.0/dt * (Qijk * Ekk * Aijk).real
 
     # summed Tijk
-    sum_Tijk = np.zeros(full)
-    for k in range(full):
-        idx = kidx[k]
-        for n, ij in enumerate(idx):
-            sum_Tijk[k] += Tijk[ij]
-            # sum_Tijk[k] += Tijk[ij] / len(idx) # divide by number of pairs?
+    sum_Tijk = np.add.reduceat(Tijk[ii, jj], kstart)
+    # sum_Tijk[k] += Tijk[ij] / len(idx) # divide by number of pairs?
 
     return gk, Tijk, sum_Tijk
 
@@ -391,23 +316,19 @@ def nonlinear_ratesJS(Lk, Aijk, Qijk, XX, delta):
     # delta = dt or dz
     full = len(Lk)
 
-    kidx = get_kidx(full)
+    kk, ii, jj, kstart = get_kidx_flat(full)
 
     gk = (np.abs(Lk)**2 - 1)/delta # JSKim 96
 
-    sum_Tijk = np.zeros(full, dtype=np.complex_)
-    for k in range(full):
-        idx = kidx[k]
-
-        for n, ij in enumerate(idx):
-            # XXX = np.mean( XX[:,ij[0]] * XX[:,ij[1]] * np.conjugate(XX[:,k]) ) # same with Aijk[ij]
-            sum_Tijk[k] += 2.0*(np.conjugate(Lk[k]) * Qijk[ij] * Aijk[ij] / delta).real
+    # XXX = np.mean( XX[:,ij[0]] * XX[:,ij[1]] * np.conjugate(XX[:,k]) ) # same with Aijk[ij]
+    sum_Tijk = np.add.reduceat(2.0*(np.conjugate(Lk[kk]) * Qijk[ii, jj] * Aijk[ii, jj] / delta).real, kstart)
+    sum_Tijk = sum_Tijk.astype(np.complex128)
 
-        # # fourth order terms
-        # for n, ij in enumerate(idx):
-        #     for m, lm in enumerate(idx):
-        #         XXXX = np.mean( XX[:,ij[0]] * XX[:,ij[1]] * np.conjugate(XX[:,lm[0]]) * np.conjugate(XX[:,lm[1]]) )
-        #         sum_Tijk[k] += Qijk[ij] * np.conjugate(Qijk[lm]) * XXXX / delta
+    # # fourth order terms
+    # for n, ij in enumerate(idx):
+    #     for m, lm in enumerate(idx):
+    #         XXXX = np.mean( XX[:,ij[0]] * XX[:,ij[1]] * np.conjugate(XX[:,lm[0]]) * np.conjugate(XX[:,lm[1]]) )
+    #         sum_Tijk[k] += Qijk[ij] * np.conjugate(Qijk[lm]) * XXXX / delta
 
     Tijk = Qijk
 
@@ -420,30 +341,20 @@ def nonlinear_test(ax, XX):
 
     pN = ax[-1]
 
-    kidx = get_kidx(full)
+    kk, ii, jj, kstart = get_kidx_flat(full)
 
     # Lk = np.zeros(full, dtype=np.complex_)
     Lk = 1.0 - 0.4*ax**2/pN**2 + 0.8j*ax/pN
 
-    Qijk = np.zeros((full, full), dtype=np.complex_)
-    for k in range(full):
-        idx = kidx[k]
-        for n, ij in enumerate(idx):
-            pi = ax[ij[0]]
-            pj = ax[ij[1]]
-            pk = ax[k]
+    pi = ax[ii]
+    pj = ax[jj]
+    pk = ax[kk]
 
-            Qijk[ij] = 1.0j/(5.0*pN**4)*pi*pj*(pj**2 - pi**2)/(1.0 + pk**2/pN**2)
+    Qijk = np.zeros((full, full), dtype=np.complex128)
+    Qijk[ii, jj] = 1.0j/(5.0*pN**4)*pi*pj*(pj**2 - pi**2)/(1.0 + pk**2/pN**2)
 
     # modeled YY from Lk and Qijk
-    YY = np.zeros(XX.shape, dtype=np.complex_)
-    for b in range(bins):
-        for k in range(full):
-            YY[b, k] = Lk[k]*XX[b, k]
-
-            idx = kidx[k]
-            for n, ij in enumerate(idx):
-                YY[b, k] += Qijk[ij]*XX[b, ij[0]]*XX[b, ij[1]]
+    YY = Lk * XX + np.add.reduceat(Qijk[ii, jj] * XX[:, ii] * XX[:, jj], kstart, axis=1)
 
     return YY, Lk, Qijk
 
@@ -471,4 +382,22 @@ def get_kidx(full):
     return kidx
 
 
-# End of file specs.py
\ No newline at end of file
+@functools.lru_cache(maxsize=16)
+def get_kidx_flat(full):
+    # flat version of get_kidx for fancy indexing
+    # IN : full length
+    # OUT : k, i, j of all pairs (i, j) with f_i + f_j = f_k, sorted by k; index of the first pair of each k
+    kidx = get_kidx(full)
+
+    kk = np.concatenate([np.full(len(idx), k, dtype=np.intp) for k, idx in enumerate(kidx)])
+    ii = np.array([ij[0] for idx in kidx for ij in idx], dtype=np.intp)
+    jj = np.array([ij[1] for idx in kidx for ij in idx], dtype=np.intp)
+    kstart = np.cumsum([0] + [len(idx) for idx in kidx[:-1]]).astype(np.intp)
+
+    for arr in (kk, ii, jj, kstart):
+        arr.setflags(write=False)
+
+    return kk, ii, jj, kstart
+
+
+# End of file specs.py
@@ -11,61 +11,16 @@ import dask.array as da
 #from dask.distributed import get_worker
 from scipy.signal import detrend, spectrogram, stft
 from math import floor
+import scipy.fft
 
+from analysis.precision import get_dtypes
+from analysis.fft_setup import get_fft_setup
+from analysis.kernels import run_kernel
+from analysis.sharding import sharded_data
 
 
-def fft_window(tnum, nfft, window, overlap):
-    # IN : full length of time series, nfft, window name, overlap ratio
-    # OUT : bins, 1 x nfft window function
 
-    # use overlapping
-    bins = int(np.fix((tnum // nfft - overlap) / (1.0 - overlap)))
-
-    # window function
-    if window == 'rectwin':  # overlap = 0.5
-        win = np.ones(nfft)
-    elif window == 'hann':  # overlap = 0.5
-        win = np.hanning(nfft)
-    elif window == 'hamm':  # overlap = 0.5
-        win = np.hamming(nfft)
-    elif window == 'kaiser':  # overlap = 0.62
-        win = np.kaiser(nfft, beta=30)
-    elif window == 'HFT248D':  # overlap = 0.84
-        z = 2. * np.pi / nfft * np.arange(0, nfft)
-        win = 1 - 1.985844164102*np.cos(z) + 1.791176438506*np.cos(2*z) - 1.282075284005*np.cos(3*z) + \
-            0.667777530266*np.cos(4*z) - 0.240160796576*np.cos(5*z) + 0.056656381764*np.cos(6*z) - \
-            0.008134974479*np.cos(7*z) + 0.000624544650*np.cos(8*z) - 0.000019808998*np.cos(9*z) + \
-            0.000000132974*np.cos(10*z)
-
-    return bins, win
-
-
-def create_fft_freq(dt, nfft, full):
-    """
-    Creates a list of Fourier Frequencies
-    Inputs:
-    =======
-    dt: float, Sampling frequency in Hz
-    nfft: int, number of data points to apply FFT to
-    full: bool, if True, then we want the DFT from -fN...0...fN. If false, we do a half-DFT from 0...fN
-
-    Returns:
-    ========
-    freqs, ndarray(float): Frequencies of the Fourier Coefficients calculated by FFT.
-    """
-    freqs = da.fft.fftfreq(nfft, d=dt) 
-
-    if (nfft % 2 == 0):
-        freqs = da.hstack([freqs[0: nfft // 2], -freqs[nfft //2], freqs[nfft // 2:nfft]])
-    if full:
-        freqs = da.fft.fftshift(freqs)
-    else:
-        freqs = freqs[0:nfft // 2 + 1]
-
-    return(freqs)
-
-
-def allocate_fft_data(nfft, bins, full):
+def allocate_fft_data(nfft, bins, full, dtype=np.complex128):
     """
     Allocate data to store DFT in.
     Inputs:
@@ -73,26 +28,46 @@ def allocate_fft_data(nfft, bins, full):
     nfft: int, number of data points to apply FFT to
     full: bool, if True, then we want the DFT from -fN...0...fN. If false, we do a half-DFT from 0...fN
     bins: Number of FFTs per channel
+    dtype: complex data type of the DFT. Use np.complex64 for single precision.
     """
 
     if full: # full shift to -fN ~ 0 ~ fN
         if (nfft % 2) == 0:  # even nfft
-            # TODO: Store everything as float32/complex64
-            fftdata = da.zeros((bins, nfft + 1), dtype=np.complex128)
+            fftdata = da.zeros((bins, nfft + 1), dtype=dtype)
         else:  # odd nfft
-            # TODO: Store everything as float32/complex64
-            fftdata = da.zeros((bins, nfft), dtype=np.complex128)
+            fftdata = da.zeros((bins, nfft), dtype=dtype)
     else: # half 0 ~ fN
-        # TODO: Store everything as float32/complex64
-        fftdata = da.zeros((bins, nfft // 2 + 1), dtype=np.complex128)
+        fftdata = da.zeros((bins, nfft // 2 + 1), dtype=dtype)
 
     return fftdata
 
 
 
+def stack_fft_blocks(blocks):
+    """Concatenates the channel blocks returned by task_fft_scipy.do_fft into a single array.
+    Submit this to the workers with the block futures, so that the fourier-transformed data
+    stays on the cluster:
+
+    >>> fft_future = dask_client.submit(stack_fft_blocks, my_fft.do_fft(dask_client, data_future, num_channels))
+
+    Inputs:
+    =======
+    blocks: list of ndarray, complex. dim0: channel, dim1: Fourier Coefficients, dim2: STFT (bins)
+
+    Returns:
+    ========
+    fft_data: ndarray, complex. Same layout as the blocks, with all channels along dim0
+    """
+    return(np.concatenate(blocks, axis=0))
+
+
 class task_fft_kstar():
     """Performs a DFT for incoming data chunks. This class uses the methods provided in
-    the fluctana package for the DFTs."""
+    the fluctana package for the DFTs, i.e. the conventions of specs.fftbins:
+    *For even nfft, the Nyquist coefficient is duplicated (conjugated) so that there are nfft+1 coefficients
+    *Coefficients are divided by nfft
+    *With full=1, the coefficients are fft-shifted to -fN...0...fN. With full=0, only 0...fN are kept.
+    """
     def __init__(self, data_per_chunk, fft_params, normalize=True, detrend=True):
         """
         Inputs:
@@ -114,43 +89,81 @@ class task_fft_kstar():
         self.detrend = fft_params["detrend"]
         # Sampling frequency of the data
         self.fs = fft_params["fsample"]
-        self.full = True
-
+        self.full = fft_params.get("full", 1)
+        # Floating point precision of the data, either 'double' or 'single'
+        self.precision = fft_params.get("precision", "double")
+        self.dtype, self.complex_dtype = get_dtypes(self.precision)
+        # Number of channels transformed by a single dask task
+        self.block_size = fft_params.get("block_size", 32)
+
+        # Cached window function and frequencies
+        self.fft_setup = get_fft_setup(self.nfft, self.window, self.overlap, self.full, 1. / self.fs,
+                                       fft_params.get("fft_workers", 1))
         # Calculate number of bins (ffts per channel) and the windowing function
-        self.fft_bins, self.fft_win = fft_window(self.ndata, self.nfft, self.window, self.overlap)
+        self.fft_bins = self.fft_setup.get_bins(self.ndata)
+        self.fft_win = self.fft_setup.win
+        self.win_factor = self.fft_setup.win_factor
         # Calculate the frequencies
-        self.fft_freqs = create_fft_freq(self.fs, self.nfft, self.full)
+        self.fft_freqs = self.fft_setup.ax
 
-    def do_fft(self, cs_data):
-        """Perform the FFT. This former fftbins routine
-        Inputs:
-        cs_data: dask array(float). dim0: channels(192) dim1: samples (10_000)
-        """
 
-        for fbin in range(self.fft_bins):
-            idx1 = int(fbin * floor(nfft * (1. - overlap)))
-            idx2 = idx1 + nfft
+    def get_fft_params(self):
+        """Returns parameters of the fft in dictionary form.
+        layout is the order of the Fourier Coefficients: 'shifted' for -fN...0...fN (full=1)
+        and 'onesided' for 0...fN (full=0)."""
+
+        fft_params = {"nfft": self.nfft, "window": self.window, "overlap": self.overlap,
+                      "detrend": self.detrend, "fs": self.fs, "win_factor": self.win_factor,
+                      "full": self.full, "precision": self.precision, "block_size": self.block_size,
+                      "fft_workers": self.fft_setup.workers,
+                      "layout": "shifted" if self.full == 1 else "onesided"}
+
+        return fft_params
+
+
+    def get_nbytes_per_channel(self):
+        """Returns the size of the fourier-transformed data of a single channel, in bytes."""
+        return(self.fft_freqs.size * self.fft_bins * np.dtype(self.complex_dtype).itemsize)
+
 
-            sx = cs_data[:, idx1:idx2]
+    def do_fft(self, dask_client, stream_data_future, num_channels, block_size=None):
+        """Dispatch the fluctana-convention STFT to the workers. See specs.fftbins_batch.
 
-            if detrend == 1:
-                sx = detrend(sx, type='linear', axis=1)
-            sx = detrend(sx, type='constant', axis=1)  # subtract mean
+        The channels are split into blocks of block_size consecutive channels. Each block is
+        transformed by a single dask task, vectorized over channels and bins.
 
-            sx = sx * win  # apply window function
+        Input:
+        ======
+        dask_client: dask client
+        stream_data_future: future to the time-data. dim0: channel, dim1: time. Or sharded_data
+                            of the time-data, see analysis/sharding.py
+        num_channels: int, number of channels in the time-data, stream_data.shape[0]
+        block_size: int, number of channels per dask task. Defaults to self.block_size.
+                    Not used for sharded time-data, which is transformed block by block.
+
+        Returns:
+        ========
+        List of futures. Each future holds an ndarray, complex for a block of channels.
+        dim0: channel, dim1: Fourier Coefficients, dim2: index of the n-th stft.
+        This is the layout of task_fft_scipy, so the results can be used by the task_spectral kernels.
+        For sharded time-data, returns the sharded_data of the fourier-transformed data.
+        """
 
-            # get fft
-            SX = np.fft.fft(sx, n=nfft)/nfft  # divide by the length
-            if np.mod(nfft, 2) == 0:  # even nfft
-                SX = np.hstack([SX[0:int(nfft/2)], np.conj(SX[int(nfft/2)]), SX[int(nfft/2):nfft]])
-            if full == 1: # shift to -fN ~ 0 ~ fN
-                SX = np.fft.fftshift(SX)
-            else: # half 0 ~ fN
-                SX = SX[0:int(nfft/2+1)]
+        if isinstance(stream_data_future, sharded_data):
+            # Transform each block on the worker that holds it
+            return(stream_data_future.map_blocks(dask_client, run_kernel, self.get_nbytes_per_channel(),
+                                                 args=(self.get_fft_params(),), pre_args=("fftbins_kstar",)))
 
-            fftdata[b,:] = SX
+        if block_size is None:
+            block_size = self.block_size
 
-        return ax, fftdata, win_factor
+        # Distribute the fft function to the workers
+        fft_params = self.get_fft_params()
+        futures = [dask_client.submit(run_kernel, "fftbins_kstar", stream_data_future, ch_start, min(ch_start + block_size, num_channels),
+                                      fft_params)
+                   for ch_start in range(0, num_channels, block_size)]
+
+        return(futures)
 
 
 class task_fft_scipy():
@@ -176,66 +189,45 @@ class task_fft_scipy():
         self.detrend = fft_params["detrend"]
         # Sampling frequency of the data
         self.fs = fft_params["fsample"]
-        self.full = fft_params["full"]
+        self.full = fft_params.get("full", 1)
+        # Floating point precision of the data, either 'double' or 'single'
+        self.precision = fft_params.get("precision", "double")
+        self.dtype, self.complex_dtype = get_dtypes(self.precision)
 
         self.noverlap = int(self.nfft * self.overlap)
+        # Number of channels transformed by a single dask task
+        self.block_size = fft_params.get("block_size", 32)
 
-        _, win = self.build_fft_window(self.ndata, self.nfft, self.window, self.overlap)
-        self.win_factor = np.mean(win**2.0)
+        # Cached window function. This is the periodic window that stft builds from a window name.
+        # It is passed to stft as an array, so that win_factor matches the window that is applied
+        # and HFT248D is available.
+        self.fft_setup = get_fft_setup(self.nfft, self.window, self.overlap, self.full, 1. / self.fs,
+                                       fft_params.get("fft_workers", 1), periodic=True)
+        self.win_factor = self.fft_setup.win_factor
 
         #print("Overlap = {0}, win_factor = {1}".format(self.overlap, self.win_factor))
 
-        
-    def build_fft_window(self, tnum, nfft, window, overlap):
-        """Builds the window used in the STFTs. Taken from KSTAR/specs.py
-
-        Input:
-        ======
-        tnum: int, length of the input time series
-        nfft: int, data points used in FFT
-        window: string, defines the window to use. See corresponding numpy functions.
-        overlap: float, Overlap between ffts, relative to nfft.
-
-        Returns:
-        ========
-        bins: int, The number of individual data points performed on the input time series
-        win: ndarray, flot, The window function applied to input-segments of the FFT
-        """
-
-        # use overlapping
-        bins = int(np.fix((int(tnum/nfft) - overlap)/(1.0 - overlap)))
-
-        # window function
-        if window == 'rectwin':  # overlap = 0.5
-            win = np.ones(nfft)
-        elif window == 'hann':  # overlap = 0.5
-            win = np.hanning(nfft)
-        elif window == 'hamm':  # overlap = 0.5
-            win = np.hamming(nfft)
-        elif window == 'kaiser':  # overlap = 0.62
-            win = np.kaiser(nfft, beta=30)
-        elif window == 'HFT248D':  # overlap = 0.84
-            z = 2*np.pi/nfft*np.arange(0,nfft)
-            win = 1 - 1.985844164102*np.cos(z) + 1.791176438506*np.cos(2*z) - 1.282075284005*np.cos(3*z) + \
-                0.667777530266*np.cos(4*z) - 0.240160796576*np.cos(5*z) + 0.056656381764*np.cos(6*z) - \
-                0.008134974479*np.cos(7*z) + 0.000624544650*np.cos(8*z) - 0.000019808998*np.cos(9*z) + \
-                0.000000132974*np.cos(10*z)
-
-        return bins, win
-
 
     def get_fft_params(self):
-        """Returns parameters of the fft in dictionary form."""
+        """Returns parameters of the fft in dictionary form.
+        layout is 'fft': stft returns all nfft Fourier Coefficients in FFT order, 0...fN, -fN...-f1."""
 
         fft_params = {"nfft": self.nfft, "window": self.window, "overlap": self.overlap,
                       "detrend": self.detrend, "fs": self.fs, "noverlap": self.noverlap,
-                      "win_factor": self.win_factor, "full": self.full}
+                      "win_factor": self.win_factor, "full": self.full, "precision": self.precision,
+                      "block_size": self.block_size, "fft_workers": self.fft_setup.workers,
+                      "periodic_window": True, "layout": "fft"}
 
         return fft_params
 
 
+    def get_nbytes_per_channel(self):
+        """Returns the size of the fourier-transformed data of a single channel, in bytes."""
+        num_segments = (self.ndata - self.noverlap) // (self.nfft - self.noverlap)
+        return(self.nfft * num_segments * np.dtype(self.complex_dtype).itemsize)
+
 
-    def do_fft(self, dask_client, stream_data_future):
+    def do_fft(self, dask_client, stream_data_future, num_channels, block_size=None):
         """Dispatch a STFT to the workers.
         For details on how the STFT relates to other spectrograms, see
         tests_div/scipy_compare_spectrograms.ipynb
@@ -245,42 +237,41 @@ class task_fft_scipy():
         *self.window as the windowing function
         *self.nfft as nperseg
         *self.noverlap = int(self.nfft * self.overlap) the overlap
-        linear detrending
+        linear detrending if self.detrend == 1, otherwise only the mean is subtracted
 
-        The returned spectrogram is the average of all calculated fourier transformations.
+        The channels are split into blocks of block_size consecutive channels. Each block is
+        transformed by a single dask task.
 
         Input:
         ======
-        dask_client:
-        stream_data_future:
+        dask_client: dask client
+        stream_data_future: future to the time-data. dim0: channel, dim1: time. Or sharded_data
+                            of the time-data, see analysis/sharding.py
+        num_channels: int, number of channels in the time-data, stream_data.shape[0]
+        block_size: int, number of channels per dask task. Defaults to self.block_size.
+                    Not used for sharded time-data, which is transformed block by block.
 
         Returns:
         ========
-
-        List of futures
+        List of futures. Each future holds an ndarray, complex for a block of channels.
+        dim0: channel, dim1: Fourier Coefficients, dim2: index of the n-th stft.
+        Concatenate the results along dim0 to get the STFT of all channels.
+        For sharded time-data, returns the sharded_data of the fourier-transformed data.
         """
 
-        def stft_scipy(data_in, ch_idx):
-            """ Calculates short-time fourier transformations using scipy.signal.spectrogram
-            Inputs
-            ======
-            data_in: ndarray, float. Time-data to be Fourier-Transformed. dim0: channel, dim1: time
-            ch_idx: int, Index of the channel to apply the STFT to.
-
-            Returns:
-            ========
-            res[2]: The third element of the return-tuple from spectrogram.
-                    ndarray, complex dim0: Fourier Coefficients. dim1: index of the n-th stft.
-            """
-
-            res = stft(data_in[ch_idx, :], fs=self.fs, nperseg=self.nfft, window=self.window,
-                       detrend=self.detrend, noverlap=self.noverlap, padded=False,
-                       return_onesided=False, boundary=None)
+        if isinstance(stream_data_future, sharded_data):
+            # Transform each block on the worker that holds it
+            return(stream_data_future.map_blocks(dask_client, run_kernel, self.get_nbytes_per_channel(),
+                                                 args=(self.get_fft_params(),), pre_args=("stft_scipy",)))
 
-            return res[2]
+        if block_size is None:
+            block_size = self.block_size
 
         # Distribute the stft function to the workers
-        futures = [dask_client.submit(stft_scipy, stream_data_future, idx) for idx in range(192)]
+        fft_params = self.get_fft_params()
+        futures = [dask_client.submit(run_kernel, "stft_scipy", stream_data_future, ch_start, min(ch_start + block_size, num_channels),
+                                      fft_params)
+                   for ch_start in range(0, num_channels, block_size)]
 
         return(futures)
 
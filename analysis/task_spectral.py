@@ -1,12 +1,49 @@
 # coding: UTF-8 -*-
 
 from analysis.channels import channel, channel_range
+from analysis.cross_spectra import csd_accumulator, merge_csd_sums
+from analysis.fft_setup import build_freq_axis
+from analysis.kernels import get_kernel, run_kernel
+from analysis.sharding import submit_pairs
 import itertools
+import numbers
+import numpy as np
+
+
+def apply_to_tile(kernel, pair_idx, *args):
+    """Evaluates a kernel on a tile of channel pairs and tags the result with the pair indices.
+
+    Input:
+    ======
+    kernel: string, name of a kernel in kernels.py, or a callable.
+            Returns an array with one row per channel pair of the tile
+    pair_idx: ndarray, int. Position of the pairs of the tile in the dispatch sequence
+    args: Arguments passed to kernel
+
+    Returns:
+    ========
+    pair_idx: ndarray, int. Same as the input
+    res: ndarray. Packed result of the tile. dim0: channel pair
+    """
+    return(pair_idx, get_kernel(kernel)(*args))
 
 
 class task_spectral():
     """Serves as the super-class for analysis methods. Do not instantiate directly"""
 
+    # Name of the kernel that calculates the result of the analysis from the sums of cross_spectra.csd_sums.
+    # Tasks that define it share these sums with other tasks on the same channel pairs.
+    # See execution_plan and kernels.py
+    from_sums = None
+
+    # True if the task can accumulate its spectra over time steps, see "accumulate" below.
+    # These tasks dispatch the per-step sums and implement get_accumulated_results.
+    accumulates = False
+
+    # Tasks with lower priority are skipped first when the pipeline falls behind its deadline.
+    # Set with "priority" in the task configuration. See scheduling.py
+    priority = 1
+
     def __init__(self, task_config, fft_config):
         """Initialize the object with a fixed channel list, a fixed name of the analysis to be performed
         and a fixed set of parameters for the analysis routine.
@@ -36,15 +73,44 @@ class task_spectral():
             self.kwargs = None
 
         self.fft_config = fft_config
+        self.priority = task_config.get("priority", self.priority)
+
+        # Number of channel pairs that are computed by a single dask task, f.ex.
+        # "kwargs": {..., "tile_size": 256}. If not given or 0, all pairs are computed by one task.
+        self.tile_size = task_config.get("kwargs", {}).get("tile_size", None)
+        if self.tile_size is not None:
+            if isinstance(self.tile_size, bool) or not isinstance(self.tile_size, numbers.Integral) or self.tile_size < 0:
+                raise ValueError("{0:s}: tile_size has to be a non-negative integer, got {1}".format(self.description, self.tile_size))
+            if self.tile_size == 0:
+                self.tile_size = None
+
+        # Optionally accumulate the spectra over time steps, f.ex.
+        # "kwargs": {..., "accumulate": {"mode": "window", "nsteps": 10}}
+        # See cross_spectra.csd_accumulator for the parameters.
+        self.accumulator = None
+        if "accumulate" in task_config.get("kwargs", {}):
+            if not self.accumulates:
+                raise ValueError("{0:s}: {1:s} does not support accumulate".format(self.description, self.analysis))
+            self.accumulator = csd_accumulator(**task_config["kwargs"]["accumulate"])
 
         self.storage_scheme =  {"ref_channels": self.ref_channels.to_str(),
                                 "cross_channels": self.x_channels.to_str()}
 
+        # Layout of the channels in the data, see set_layout. If None, the data has all channels.
+        self.layout = None
+
 
     def calculate(self, *args):
         raise NotImplementedError
 
 
+    def require_full_spectrum(self):
+        """Raises a ValueError if the fourier-transformed data has only the Fourier Coefficients 0...fN.
+        Used by analyses that need the negative frequencies."""
+        if self.fft_config.get("layout", "fft") == "onesided":
+            raise ValueError("{0:s} needs the full spectrum. Use full=1 for the kstar FFT engine".format(self.analysis))
+
+
     def get_dispatch_sequence(self):
         """Returns an iterator over the reference and cross channels."""
 
@@ -55,8 +121,114 @@ class task_spectral():
         return(itertools.combinations_with_replacement(crg_total, 2))
 
 
+    def get_channels(self):
+        """Returns the reference and cross channels of the task."""
+        return(list(itertools.chain(self.ref_channels, self.x_channels)))
+
+
+    def set_layout(self, layout):
+        """Sets the layout of the channels in the data, when the reader fetches only a selection
+        of the channels. See channels.channel_layout.
+
+        Input:
+        ======
+        layout: channel_layout, or None if the data has all channels.
+        """
+        self.layout = layout
+
+
+    def get_pair_indices(self):
+        """Returns the channel indices of the dispatch sequence, i.e. the rows of the
+        channels in the data. These are the linear channel indices unless a layout is set.
+
+        Returns:
+        ========
+        ch0, ch1: ndarray, int. Index of the first and second channel of each pair.
+        """
+        idx = channel.idx if self.layout is None else self.layout.idx
+        pairs = np.array([(idx(ch_r), idx(ch_x)) for ch_r, ch_x in self.get_dispatch_sequence()], dtype=int)
+        return(pairs[:, 0], pairs[:, 1])
+
+
+    def get_dispatch_tiles(self):
+        """Splits the dispatch sequence into tiles of at most tile_size channel pairs.
+        Each tile is computed by a single dask task.
+
+        Returns:
+        ========
+        tiles: list of tuples (pair_idx, ch0, ch1). pair_idx is the position of the pairs
+               in the dispatch sequence, ch0 and ch1 are their channel indices.
+        """
+        ch0, ch1 = self.get_pair_indices()
+        num_pairs = ch0.size
+        tile_size = num_pairs if self.tile_size is None else self.tile_size
+
+        return([(np.arange(start, min(start + tile_size, num_pairs)),
+                 ch0[start:start + tile_size], ch1[start:start + tile_size])
+                for start in range(0, num_pairs, tile_size)])
+
+
+    def dispatch_accumulator(self, dask_client, fft_future):
+        """Dispatches the calculation of the per-step sums for the accumulator, if any."""
+        if self.accumulator is None:
+            return None
+
+        self.accumulator_futures = [submit_pairs(dask_client, run_kernel, fft_future, ch0, ch1, pre_args=("csd_sums",))
+                                    for _, ch0, ch1 in self.get_dispatch_tiles()]
+        return None
+
+
+    def update_accumulator(self, accumulator_futures=None, accumulator_sums=None):
+        """Adds the per-step sums from the last call to calculate to the accumulator.
+        This blocks until the sums are evaluated. Pass accumulator_futures to use the sums of
+        an earlier call to calculate, or accumulator_sums to pass the evaluated sums of each tile.
+        Steps have to be added in order."""
+        if accumulator_sums is None:
+            if accumulator_futures is None:
+                accumulator_futures = self.accumulator_futures
+            accumulator_sums = [f.result() for f in accumulator_futures]
+        self.accumulator.update(*merge_csd_sums(accumulator_sums))
+
+
+    def get_accumulated_results(self, steps=None):
+        """Returns the result of the analysis from the accumulated spectra.
+        See cross_spectra.csd_accumulator.get_sums for steps."""
+        raise NotImplementedError
+
+
+    def get_results(self, futures_list=None):
+        """Gathers the results of the futures from the last call to calculate.
+        Each future holds the pair indices and the packed result of a tile, see apply_to_tile.
+        This blocks until all futures are evaluated.
+
+        Input:
+        ======
+        futures_list: None or list of futures. Use these futures instead of those from the last
+                      call to calculate, f.ex. when several time steps are in flight.
+
+        Returns:
+        ========
+        res: ndarray. dim0: channel pair in dispatch order.
+        """
+        if futures_list is None:
+            futures_list = self.futures_list
+
+        res = None
+        for f in futures_list:
+            pair_idx, res_tile = f.result()
+            if res is None:
+                num_pairs = sum([len(tile[0]) for tile in self.get_dispatch_tiles()])
+                res = np.zeros((num_pairs,) + res_tile.shape[1:], dtype=res_tile.dtype)
+            res[pair_idx] = res_tile
+
+        return(res)
+
+
 class task_cross_phase(task_spectral):
     """This class calculates the cross-phase via the calculate method."""
+    from_sums = "cross_phase_from_sums"
+    accumulates = True
+
     def __init__(self, task_config, fft_config):
         super().__init__(task_config, fft_config)
         # Append the analysis name to the storage scheme
@@ -74,13 +246,9 @@ class task_cross_phase(task_spectral):
         Scatter time-chunk data to the cluster
         >>> data_future = client.scatter(data, broadcast=True)
         Calculate the fft. Do this with a special method, so we don't use dask array
-        >>> fft_future = my_fft.do_fft(client, data_future)
-        Gather the results
-        >>> results = client.gather(fft_future)
-        Create an np array from the fourier-transformed data
-        >>> fft_data = np.array(results)
-        Scatter the dask array to all clients.
-        >>> fft_future = client.scatter(fft_data, broadcast=True)
+        >>> fft_future = my_fft.do_fft(client, data_future, num_channels)
+        Concatenate the channel blocks on the workers. The data never passes through the client.
+        >>> fft_future = client.submit(stack_fft_blocks, fft_future)
         Execute a task on the transformed data
         >>> task.calculate(dask_client, fft_future)        
         
@@ -96,96 +264,61 @@ class task_cross_phase(task_spectral):
         future: dask future that holds the result of the analysis.
         """
 
-        # Somehow dask complains when we don't define the function in the local scope.
-        def cross_phase(fft_data, ch0, ch1):
-            """Kernel that calculates the cross-phase between two channels.
-            Input:
-            ======
-            fft_data: ndarray, float: Contains the fourier-transformed data. 
-                      dim0: channel, dim1: Fourier Coefficients, dim2: STFT (bins in fluctana code)
-            ch0: int, index for first channel
-            ch1: int, index for second channel
-
-            Returns:
-            ========
-            cp: float, the cross phase
-            """    
-
-            from math import atan2
-            _tmp1 = (fft_data[ch0, :, :] * fft_data[ch1, :, :].conj()).mean(axis=1)#.compute()
-            return(atan2(_tmp1.real, _tmp1.imag).real)
+        self.futures_list = [submit_pairs(dask_client, apply_to_tile, fft_future, ch0, ch1, pre_args=("cross_phase", pair_idx))
+                             for pair_idx, ch0, ch1 in self.get_dispatch_tiles()]
+        self.dispatch_accumulator(dask_client, fft_future)
 
+        return None
 
-        self.futures_list = [dask_client.submit(cross_phase, fft_future, ch_r.idx(), ch_x.idx()) for ch_r, ch_x in self.get_dispatch_sequence()]
 
-        return None
+    def get_accumulated_results(self, steps=None):
+        """Returns the cross-phase from the accumulated spectra."""
+        return(self.accumulator.cross_phase(steps=steps))
 
 
 class task_cross_power(task_spectral):
     """This class calculates the cross-power between two channels."""
+    from_sums = "cross_power_from_sums"
+    accumulates = True
+
     def __init__(self, task_config, fft_config):
         super().__init__(task_config, fft_config)
         self.storage_scheme["analysis_name"] = "cross_power"
 
     def calculate(self, dask_client, fft_future):
-        def cross_power(fft_data, ch0, ch1):
-            """Kernel that calculates the cross-power between two channels.
-            Input:
-            ======    
-            fft_data: ndarray, float: Contains the fourier-transformed data. 
-                      dim0: channel, dim1: Fourier Coefficients, dim2: STFT (bins in fluctana code)
-            ch0: int, index for first channel
-            ch1: int, index for second channel
-
-            Returns:
-            ========
-            cross_power, float.
-            """
-            return((fft_data[ch0, :] * fft_data[ch1, :].conj()).mean().__abs__())
-    
+        self.futures_list = [submit_pairs(dask_client, apply_to_tile, fft_future, ch0, ch1, self.fft_config["win_factor"],
+                                          pre_args=("cross_power", pair_idx))
+                             for pair_idx, ch0, ch1 in self.get_dispatch_tiles()]
+        self.dispatch_accumulator(dask_client, fft_future)
+        return None
+
 
-        self.futures_list = [dask_client.submit(cross_power, fft_future, ch_r.idx(), ch_x.idx()) for ch_r, ch_x in self.get_dispatch_sequence()]
-        return None        
+    def get_accumulated_results(self, steps=None):
+        """Returns the cross-power from the accumulated spectra."""
+        return(self.accumulator.cross_power(self.fft_config["win_factor"], steps=steps))
 
 
 class task_coherence(task_spectral):
     """This class calculates the coherence between two channels."""
+    from_sums = "coherence_from_sums"
+    accumulates = True
+
     def __init__(self, task_config, fft_config):
         super().__init__(task_config, fft_config)
         self.storage_scheme["analysis_name"] = "coherence"
 
     
     def calculate(self, dask_client, fft_future):
-        def coherence(fft_data, ch0, ch1):
-            """Kernel that calculates the coherence between two channels.
-            Input:
-            ======    
-            fft_data: ndarray, float: Contains the fourier-transformed data. 
-                      dim0: channel, dim1: Fourier Coefficients. dim2: STFT (bins in fluctana code)
-            ch0: int, index for first channel
-            ch1: int, index for second channel
-
-            Returns:
-            ========
-            coherence, float.
-            """
-
-            from numpy import sqrt, mean, fabs
-            X = fft_data[ch0, :, :]
-            Y = fft_data[ch1, :, :]
-
-            Pxx = X * X.conj()
-            Pyy = Y * Y.conj()
-
-            Gxy = mean((X * Y.conj()) / sqrt(Pxx * Pyy), axis=1)
-            Gxy = fabs(Gxy).real
+        self.futures_list = [submit_pairs(dask_client, apply_to_tile, fft_future, ch0, ch1, pre_args=("coherence", pair_idx))
+                             for pair_idx, ch0, ch1 in self.get_dispatch_tiles()]
+        self.dispatch_accumulator(dask_client, fft_future)
+        return None
 
-            #Gxy = fabs(mean(X * Y.conj() / sqrt(X * X.conj() * Y * Y.conj())).real)
 
-            return(Gxy)
+    def get_accumulated_results(self, steps=None):
+        """Returns the coherence from the accumulated spectra."""
+        return(self.accumulator.coherence(steps=steps))
 
-        self.futures_list = [dask_client.submit(coherence, fft_future, ch_r.idx(), ch_x.idx()) for ch_r, ch_x in self.get_dispatch_sequence()]
-        return None  
 
 #    def store(self, mongo_client):
 #        for future in future_list:
@@ -198,151 +331,79 @@ class task_coherence(task_spectral):
 
 
 class task_xspec(task_spectral):
-    """This class calculates the coherence between two channels."""
+    """This class calculates the time-resolved cross-spectrogram between two channels.
+
+    Optional kwargs reduce the size of the result:
+    * "freq_range": [f_lo, f_hi], only keep frequencies f_lo <= |f| <= f_hi, in Hz
+    * "decimate": int, average this many consecutive STFT bins into one time bin
+    """
     def __init__(self, task_config, fft_config):
         super().__init__(task_config, fft_config)
         self.storage_scheme["analysis_name"] = "xspec"
+
+        kwargs = task_config.get("kwargs", {})
+        self.decimate = kwargs.get("decimate", 1)
+
+        self.require_full_spectrum()
+
+        # Frequencies of the fourier coefficients
+        if fft_config.get("layout", "fft") != "fft":
+            # As returned by task_fft_kstar, -fN...0...fN
+            self.freqs = build_freq_axis(fft_config["nfft"], 1. / fft_config["fs"], fft_config["full"])
+        else:
+            # As returned by scipy's stft with return_onesided=False
+            self.freqs = np.fft.fftfreq(fft_config["nfft"], d=1. / fft_config["fs"])
+        self.freq_idx = None
+        if "freq_range" in kwargs:
+            f_lo, f_hi = kwargs["freq_range"]
+            self.freq_idx = np.where((np.abs(self.freqs) >= f_lo) & (np.abs(self.freqs) <= f_hi))[0]
+            self.freqs = self.freqs[self.freq_idx]
+
+        self.storage_scheme["freq_range"] = kwargs.get("freq_range", None)
+        self.storage_scheme["decimate"] = self.decimate
+        # Frequency axis of the stored spectrogram, after freq_range is applied
+        self.storage_scheme["freqs"] = self.freqs.tolist()
+
     
     def calculate(self, dask_client, fft_future):
-        def xspec(fft_data, ch0, ch1):
-            """Kernel that calculates the coherence between two channels.
-            Input:
-            ======    
-            fft_data: dask_array, float: Contains the fourier-transformed data. 
-                      dim0: channel, dim1: Fourier Coefficients, dim2: STFT (bins in fluctana code)
-            ch0: int, index for first channel
-            ch1: int, index for second channel
-
-            Returns:
-            ========
-            coherence, float.
-            """
-
-            return 0.0
-
-        #self.futures_list = [dask_client.submit(coherence, fft_future, ch_r.idx(), ch_x.idx()) for ch_r in self.ref_channels for ch_x in self.x_channels]
-        raise NotImplementedError
+        self.futures_list = [submit_pairs(dask_client, apply_to_tile, fft_future, ch0, ch1,
+                                          self.fft_config["win_factor"], self.freq_idx, self.decimate,
+                                          pre_args=("xspec", pair_idx))
+                             for pair_idx, ch0, ch1 in self.get_dispatch_tiles()]
         return None  
 
 
 class task_cross_correlation(task_spectral):
     """This class calculates the cross-correlation between two channels."""
+    from_sums = "cross_correlation_from_sums"
+
     def __init__(self, task_config, fft_config):
         super().__init__(task_config, fft_config)
         self.storage_scheme["analysis_name"] = "cross_correlation"
+        self.require_full_spectrum()
 
     def calculate(self, dask_client, fft_future):
-        def cross_corr(fft_data, ch0, ch1, fft_params):
-            """Defines a kernel that calculates the cross-correlation between two channels.
-
-            Input:
-            ======
-            fft_data: ndarray, float: Contains the fourier-transformed data. 
-                      dim0: channel. dim1: Fourier Coefficients, dim2: STFT (bins in fluctana code)
-            ch0: int, index of first channel
-            ch1: int, index of second channel
-            fft_params: dict, parameters of the fourier-transformed data
-
-            Returns:
-            ========
-            cross-correlation, float array
-            """
-
-            from numpy.fft import ifftshift, ifft, fftshift
-
-            # Perform fftshift on the fourier coefficient axis (dim1)
-            X = fftshift(fft_data[ch0, :, :], axes=0)
-            Y = fftshift(fft_data[ch1, :, :], axes=0)
-
-            _tmp = ifftshift(X * Y.conj(), axes=0) / fft_params['win_factor']
-            _tmp = ifft(_tmp, n=fft_params['nfft'], axis=0) * fft_params['nfft']
-            _tmp = fftshift(_tmp, axes=0)
-
-            res = _tmp.mean(axis=1).real
-
-            return(res)
-
-
-        #print("task_cross_corr: fft_config = ", self.fft_config)
-        #print("Dispatch sequence")
-        #for ch_r, ch_x in self.get_dispatch_sequence():
-        #    print(ch_r, ch_x)
-
-        self.futures_list = [dask_client.submit(cross_corr, fft_future, ch_r.idx(), ch_x.idx(), self.fft_config) for ch_r, ch_x in self.get_dispatch_sequence()]
+        self.futures_list = [submit_pairs(dask_client, apply_to_tile, fft_future, ch0, ch1, self.fft_config,
+                                          pre_args=("cross_correlation", pair_idx))
+                             for pair_idx, ch0, ch1 in self.get_dispatch_tiles()]
         return None 
 
 
 class task_bicoherence(task_spectral):
     """This class calculates the bicoherence between two channels."""
+    # Expensive and the least time-critical result. Shed first.
+    priority = 0
+
     def __init__(self, task_config, fft_config):
         super().__init__(task_config, fft_config)
         self.storage_scheme["analysis_name"] = "xspec"
+        self.require_full_spectrum()
     
     def calculate(self, dask_client, fft_future):
-        def bicoherence(fft_data, ch0, ch1): 
-            """Kernel that calculates the bi-coherence between two channels.
-            Input:
-            ======    
-            fft_data: dask_array, float: Contains the fourier-transformed data. dim0: channel, dim1: Fourier Coefficients
-            ch0: int, index for first channel
-            ch1: int, index for second channel
-
-            Returns:
-            ========
-            bicoherence, float.
-            """
-            import numpy as np
-
-            # Transpose to make array layout compatible with code from specs.py
-            XX = np.fft.fftshift(fft_data[ch0, :, :], axes=0).T
-            YY = np.fft.fftshift(fft_data[ch1, :, :], axes=0).T
-
-            bins, full = XX.shape
-            half = full // 2 + 1
-
-            # calculate bicoherence
-            B = np.zeros((full, half), dtype=np.complex_)
-            P12 = np.zeros((full, half))
-            P3 = np.zeros((full, half))
-            val = np.zeros((full, half))
-
-            for b in range(bins):
-                X = XX[b,:] # full -fN ~ fN
-                Y = YY[b,:] # full -fN ~ fN
-
-                Xhalf = np.fft.ifftshift(X) # full 0 ~ fN, -fN ~ -f1
-                Xhalf = Xhalf[0:half] # half 0 ~ fN
-
-                X1 = np.transpose(np.tile(X, (half, 1)))
-                X2 = np.tile(Xhalf, (full, 1))
-                X3 = np.zeros((full, half), dtype=np.complex_)
-                for j in range(half):
-                    if j == 0:
-                        X3[0:, j] = Y[j:]
-                    else:
-                        X3[0:(-j), j] = Y[j:]
-
-                B = B + X1 * X2 * np.matrix.conjugate(X3) / bins #  complex bin average
-                P12 = P12 + (np.abs(X1 * X2).real)**2 / bins # real average
-                P3 = P3 + (np.abs(X3).real)**2 / bins # real average
-
-            # val = np.log10(np.abs(B)**2) # bispectrum
-            val = (np.abs(B)**2) / P12 / P3 # bicoherence
-
-            # summation over pairs
-            sum_val = np.zeros(full)
-            for i in range(half):
-                if i == 0:
-                    sum_val = sum_val + val[:,i]
-                else:
-                    sum_val[i:] = sum_val[i:] + val[:-i,i]
-
-            N = np.array([i+1 for i in range(half)] + [half for i in range(full-half)])
-            sum_val = sum_val / N # element wise division
-
-            return (val, sum_val)
-
-        self.futures_list = [dask_client.submit(bicoherence, fft_future, ch_r.idx(), ch_x.idx()) for ch_r, ch_x in self.get_dispatch_sequence()]
+        is_shifted = self.fft_config.get("layout", "fft") == "shifted"
+        self.futures_list = [submit_pairs(dask_client, apply_to_tile, fft_future, ch0, ch1, is_shifted,
+                                          pre_args=("bicoherence", pair_idx))
+                             for pair_idx, ch0, ch1 in self.get_dispatch_tiles()]
         return None 
 
 
@@ -0,0 +1,225 @@
+# Coding: UTF-8 -*-
+
+"""
+Measures the throughput and latency of the dask processor for different chunk, channel-block
+and pair-tile sizes. Used by tune_dask_one_to_one_fluctana.py.
+
+A time step is processed in two stages:
+* fft: scatter the data of the step and calculate the STFT of all channels, in blocks of
+  block_size channels (fft_params["block_size"])
+* pairs: calculate the analysis tasks, in tiles of tile_size channel pairs (kwargs["tile_size"])
+
+measure_steps runs a few steps of a stream through both stages, with the executor of the
+processor, and reports the median time of each stage. As in the processor, the stream only
+holds the channels of the channel_layout of the tasks, see analysis/channels.py. The time steps are processed one at
+a time, so the numbers are the latency of a step without pipelining.
+
+The parameters are tuned one at a time: First the chunk size, then the block size, then the
+tile size, each with the best values of the previous parameters. See tune.
+"""
+
+import timeit
+
+import numpy as np
+
+from analysis.channels import channel_layout
+from analysis.execution_plan import execution_plan
+from analysis.task_fft import stack_fft_blocks
+
+
+def synthetic_stream(num_channels, fs, seed=0):
+    """Returns a function that creates synthetic data for a chunk size.
+    The data are noise plus a wave that propagates across the channels.
+
+    Input:
+    ======
+    num_channels: int, number of channels
+    fs: float, sampling frequency in Hz
+    seed: int, seed of the random number generator
+
+    Returns:
+    ========
+    get_chunk: callable, get_chunk(chunk_size, step) returns an ndarray. dim0: channel, dim1: time
+    """
+    rng = np.random.default_rng(seed)
+    phase = np.linspace(0.0, 2.0 * np.pi, num_channels)[:, np.newaxis]
+
+    def get_chunk(chunk_size, step):
+        tb = (np.arange(chunk_size) + step * chunk_size) / fs
+        return(np.sin(2.0 * np.pi * 2e4 * tb[np.newaxis, :] + phase) + rng.normal(size=(num_channels, chunk_size)))
+
+    return(get_chunk)
+
+
+def recorded_stream(data):
+    """Returns a function that cuts chunks of a chunk size from recorded data.
+    The recorded data are re-used cyclically if they are shorter than the requested chunks.
+
+    Input:
+    ======
+    data: ndarray, f.ex. a few time steps read from a bp file. dim0: channel, dim1: time
+
+    Returns:
+    ========
+    get_chunk: callable, get_chunk(chunk_size, step) returns an ndarray. dim0: channel, dim1: time
+    """
+    num_samples = data.shape[1]
+
+    def get_chunk(chunk_size, step):
+        idx = (np.arange(chunk_size) + step * chunk_size) % num_samples
+        return(data[:, idx])
+
+    return(get_chunk)
+
+
+def wait_for(futures):
+    """Waits until futures are finished, without gathering their results to the client.
+    Raises the exception of a failed future."""
+    for f in futures:
+        exc = f.exception()
+        if exc is not None:
+            raise exc
+
+
+def measure_steps(dask_client, fft_class, fft_params, task_object_dict, task_configs, get_chunk, chunk_size, nsteps=3, layout=None):
+    """Runs nsteps time steps through the fft and the pairs stage and measures the time of each stage.
+
+    Input:
+    ======
+    dask_client: dask client or local executor, see executors/factory.py
+    fft_class: task_fft_scipy or task_fft_kstar
+    fft_params: dict, the fft_params of the configuration, including block_size
+    task_object_dict: dict, maps the analysis field of a task configuration to a task_spectral class
+    task_configs: list of the task configurations, including tile_size
+    get_chunk: callable, see synthetic_stream
+    chunk_size: int, number of samples per channel and time step
+    nsteps: int, number of measured steps. One more step is run before, to warm up the workers.
+    layout: channel_layout of the channels in the stream, or None if the stream has all channels.
+            The processor uses the union of the channels of the tasks, see get_layout.
+
+    Returns:
+    ========
+    res: dict with the median time of the fft and the pairs stage and of the whole step (latency), in s,
+         the throughput in samples per second and the real-time factor, i.e. the duration of the
+         data in a step over the latency. A real-time factor above one keeps up with the stream.
+    """
+    my_fft = fft_class(chunk_size, fft_params)
+    task_list = [task_object_dict[task_config["analysis"]](task_config, my_fft.get_fft_params()) for task_config in task_configs]
+    for task in task_list:
+        task.set_layout(layout)
+    plan = execution_plan(task_list)
+
+    t_fft = []
+    t_pairs = []
+    for step in range(nsteps + 1):
+        data = get_chunk(chunk_size, step)
+        assert(layout is None or data.shape[0] == len(layout))
+
+        t0 = timeit.default_timer()
+        data_future = dask_client.scatter(data, broadcast=True)
+        fft_future = dask_client.submit(stack_fft_blocks, my_fft.do_fft(dask_client, data_future, data.shape[0]))
+        wait_for([fft_future])
+        t1 = timeit.default_timer()
+        plan.calculate(dask_client, fft_future)
+        wait_for([f for task in task_list for f in task.futures_list])
+        t2 = timeit.default_timer()
+
+        # The first step warms up the workers
+        if step > 0:
+            t_fft.append(t1 - t0)
+            t_pairs.append(t2 - t1)
+
+    latency = np.median(np.array(t_fft) + np.array(t_pairs))
+    return({"fft": float(np.median(t_fft)), "pairs": float(np.median(t_pairs)), "latency": float(latency),
+            "throughput": float(chunk_size * data.shape[0] / latency),
+            "realtime_factor": float(chunk_size / fft_params["fsample"] / latency)})
+
+
+def get_layout(fft_class, fft_params, task_object_dict, task_configs, chunk_size):
+    """Returns the channel_layout of the union of the channels of the tasks, as used by the processor.
+
+    Input:
+    ======
+    fft_class, fft_params, task_object_dict, task_configs, chunk_size: see measure_steps
+
+    Returns:
+    ========
+    layout: channel_layout
+    """
+    fft_config = fft_class(chunk_size, fft_params).get_fft_params()
+    task_list = [task_object_dict[task_config["analysis"]](task_config, fft_config) for task_config in task_configs]
+    return(channel_layout.union([task.get_channels() for task in task_list]))
+
+
+def score(res, budget=None):
+    """Ranks a measurement. Higher is better.
+    Maximizes the real-time factor. Settings with a latency above the budget rank below all others."""
+    if budget is not None and res["latency"] > budget:
+        return((0, -res["latency"]))
+    return((1, res["realtime_factor"]))
+
+
+def tune(measure, chunk_sizes, block_sizes, tile_sizes, budget=None, verbose=True):
+    """Tunes chunk size, block size and tile size, one at a time.
+
+    Input:
+    ======
+    measure: callable, measure(chunk_size, block_size, tile_size) returns a measurement, see measure_steps
+    chunk_sizes: list of int, candidate chunk sizes. The first value is used until the chunk size is tuned
+    block_sizes: list of int, candidate channel-block sizes of the fft stage.
+    tile_sizes: list of int or None, candidate pair-tile sizes of the pairs stage. None computes all pairs in one tile
+    budget: float or None, latency budget of a step in s, see analysis/scheduling.py
+
+    Returns:
+    ========
+    best: dict with chunk_size, block_size, tile_size and the measurement of the best setting
+    results: list of dicts, all measurements
+    """
+    results = []
+    best = {"chunk_size": chunk_sizes[0], "block_size": block_sizes[0], "tile_size": tile_sizes[0]}
+
+    for name, candidates in [("chunk_size", chunk_sizes), ("block_size", block_sizes), ("tile_size", tile_sizes)]:
+        trials = []
+        for value in candidates:
+            setting = dict(best, **{name: value})
+            res = measure(setting["chunk_size"], setting["block_size"], setting["tile_size"])
+            res.update(setting)
+            results.append(res)
+            trials.append(res)
+            if verbose:
+                print("chunk_size={0:7d} block_size={1:4d} tile_size={2:>6s}: fft {3:7.4f}s, pairs {4:7.4f}s, latency {5:7.4f}s, real-time factor {6:6.2f}".format(
+                      setting["chunk_size"], setting["block_size"], str(setting["tile_size"]),
+                      res["fft"], res["pairs"], res["latency"], res["realtime_factor"]))
+
+        best_res = max(trials, key=lambda r: score(r, budget))
+        best = {key: best_res[key] for key in ["chunk_size", "block_size", "tile_size"]}
+
+    best["measurement"] = best_res
+    return(best, results)
+
+
+def recommended_config(cfg, best):
+    """Returns a copy of the processor configuration with the tuned parameters.
+
+    Input:
+    ======
+    cfg: dict, configuration of the processor
+    best: dict, as returned by tune
+    """
+    new_cfg = dict(cfg)
+    new_cfg["chunk_size"] = int(best["chunk_size"])
+    new_cfg["fft_params"] = dict(cfg["fft_params"], block_size=int(best["block_size"]))
+
+    new_cfg["task_list"] = []
+    for task_config in cfg["task_list"]:
+        kwargs = dict(task_config["kwargs"])
+        if best["tile_size"] is None:
+            kwargs.pop("tile_size", None)
+        else:
+            kwargs["tile_size"] = int(best["tile_size"])
+        new_cfg["task_list"].append(dict(task_config, kwargs=kwargs))
+
+    return(new_cfg)
+
+
+# End of file tuning.py
@@ -37,19 +37,39 @@ class mongodb_backend():
 
         # Gather the results from all futures in the task
         # This locks until all futures are evaluated.
-        result = []
-        for future in task.futures_list:
-            result.append(future.result())
-        result = np.array(result)
+        result = task.get_results()
+        self.store_result(task, result, dummy)
+
+        return None
+
+
+    def store_result(self, task, result, dummy=True, info=None):
+        """Stores the assembled result of an analysis task in the mongodb backend.
+        Does not wait on futures. Used by analysis.result_sink.
+
+        Input:
+        ======
+        task: analysis_task object.
+        result: ndarray, result of the analysis. dim0: channel pair
+        dummy: bool. If true, do not insert the item into the database
+        info: dict or None. Additional fields stored with the result, f.ex. the load shedding
+              decision of the step, see analysis/scheduling.py
+
+        Returns:
+        ========
+        None
+        """
         print("***Backend.store: result = ", result.shape)
 
         # Get the 
 
 
-        # Write results to the backend
-        storage_scheme = task.storage_scheme
+        # Write results to the backend. Copy the scheme, results of several steps may be stored concurrently.
+        storage_scheme = dict(task.storage_scheme)
         # Add a time stamp to the scheme
         storage_scheme["time"] =  datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if info is not None:
+            storage_scheme.update(info)
 
 
         for it in task.get_dispatch_sequence():
@@ -9,15 +9,20 @@ Loads the ECEI data from the HDF5 file and converts it into a bp file.
 import numpy as np
 import h5py
 import adios2
+import argparse
 from os.path import join
 
+parser = argparse.ArgumentParser(description="Convert the ECEI data from HDF5 to a bp file")
+parser.add_argument('--chunk_size', type=int, help='Number of data elements per time chunk. See tune_dask_one_to_one_fluctana.py', default=10000)
+args = parser.parse_args()
+
 scratch_dir = "/global/cscratch1/sd/rkube/"
 datadir = "KSTAR/kstar_streaming/018431"
 
 # We have 3 HDF5 file with 192 channels each.
 # Each channel has 5,000,000 values.
-# Let's divide them so that 10,000 data elements form a time chunk
-num_per_chunk = 10000
+# Let's divide them so that chunk_size (default 10,000) data elements form a time chunk
+num_per_chunk = args.chunk_size
 
 h5fname_g = join(scratch_dir, datadir, "ECEI.018431.GFS.h5")
 h5fname_h = join(scratch_dir, datadir, "ECEI.018431.HFS.h5")
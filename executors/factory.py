@@ -0,0 +1,53 @@
+# Coding: UTF-8 -*-
+
+"""
+Creates the executor that runs the analysis tasks, as defined in the configuration file:
+
+"executor": {"type": "dask", "scheduler_file": "/global/cscratch1/sd/rkube/scheduler.json"}
+"executor": {"type": "thread", "max_workers": 8}
+"executor": {"type": "process", "max_workers": 8}
+
+"dask" connects to a running dask scheduler. "thread" and "process" run on the local node
+without a scheduler, see local_executor.py. All executors provide submit, scatter, gather,
+run and close, so the tasks and the processor work with either of them.
+"""
+
+from executors.local_executor import thread_executor, process_executor, local_future
+
+
+def get_executor(executor_cfg):
+    """Creates an executor.
+
+    Input:
+    ======
+    executor_cfg: dict, with field 'type' and the parameters of the executor
+
+    Returns:
+    ========
+    executor: distributed.Client, thread_executor or process_executor
+    """
+
+    executor_type = executor_cfg.get("type", "dask")
+    if executor_type == "dask":
+        from distributed import Client
+        return(Client(scheduler_file=executor_cfg["scheduler_file"]))
+    elif executor_type == "thread":
+        return(thread_executor(max_workers=executor_cfg.get("max_workers", None)))
+    elif executor_type == "process":
+        return(process_executor(max_workers=executor_cfg.get("max_workers", None)))
+
+    raise ValueError("Unknown executor type {0:s}. Use one of ['dask', 'thread', 'process']".format(str(executor_type)))
+
+
+def fire_and_forget(future):
+    """Runs a future to completion even if no reference to it is kept.
+    Futures of the local executors always run to completion."""
+    if isinstance(future, local_future):
+        return None
+
+    import distributed
+    distributed.fire_and_forget(future)
+    return None
+
+
+# End of file factory.py
@@ -0,0 +1,333 @@
+# Coding: UTF-8 -*-
+
+"""
+Executors that run the analysis tasks on the local node, without a dask scheduler.
+
+They implement the subset of the distributed.Client interface that the tasks and the
+processor use: submit, scatter, gather, run, register_plugin and close. As with dask, futures that are
+passed as arguments to submit, also inside lists, tuples and dicts, are replaced by
+their results before the function is called. A function only starts after all futures
+in its arguments are finished, so no worker blocks on the result of another task.
+
+* thread_executor runs the functions in a thread pool. numpy and scipy.fft release the
+  GIL for the heavy lifting, so the kernels run in parallel.
+* process_executor runs the functions in a process pool. Scattered arrays and array
+  results are kept in shared memory, so that they are not pickled to the worker for
+  every task. Only a small descriptor of the array is sent.
+
+>>> executor = thread_executor(max_workers=8)
+>>> data_future = executor.scatter(data, broadcast=True)
+>>> fft_futures = my_fft.do_fft(executor, data_future, data.shape[0])
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import concurrent.futures
+import threading
+import weakref
+from multiprocessing import get_context, shared_memory, resource_tracker
+
+import cloudpickle
+import numpy as np
+
+
+class local_future():
+    """Future of a local executor. Mirrors result and done of distributed.Future."""
+
+    def __init__(self, deps=None):
+        """
+        Input:
+        ======
+        deps: list of local_future, the futures in the arguments of the function.
+              They are kept alive until this future is finished.
+        """
+        self._future = concurrent.futures.Future()
+        self._deps = deps
+
+
+    def result(self, timeout=None):
+        """Returns the result. Blocks until it is evaluated."""
+        res = self._future.result(timeout)
+        if isinstance(res, shared_array):
+            return(res.local)
+        return(res)
+
+
+    def done(self):
+        """Returns true if the future is finished. Does not block."""
+        return(self._future.done())
+
+
+    def exception(self, timeout=None):
+        """Returns the exception raised by the function, or None."""
+        return(self._future.exception(timeout))
+
+
+    def add_done_callback(self, fn):
+        """Calls fn(self) when the future is finished."""
+        self._future.add_done_callback(lambda _: fn(self))
+
+
+    def _set_result(self, result):
+        self._deps = None
+        self._future.set_result(result)
+
+
+    def _set_exception(self, exc):
+        self._deps = None
+        self._future.set_exception(exc)
+
+
+def find_futures(obj):
+    """Returns all local_futures in obj, searching lists, tuples and dicts."""
+    if isinstance(obj, local_future):
+        return([obj])
+    if isinstance(obj, (list, tuple)):
+        return([f for item in obj for f in find_futures(item)])
+    if isinstance(obj, dict):
+        return([f for item in obj.values() for f in find_futures(item)])
+    return([])
+
+
+def resolve_futures(obj):
+    """Replaces the local_futures in obj by their results. All futures have to be finished.
+    Arrays in shared memory are passed on as their shared_array descriptor."""
+    if isinstance(obj, local_future):
+        return(obj._future.result())
+    if isinstance(obj, list):
+        return([resolve_futures(item) for item in obj])
+    if isinstance(obj, tuple):
+        return(tuple([resolve_futures(item) for item in obj]))
+    if isinstance(obj, dict):
+        return({key: resolve_futures(item) for key, item in obj.items()})
+    return(obj)
+
+
+class local_executor_base():
+    """Serves as the super-class for the local executors. Do not instantiate directly"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+
+    def _run(self, fn, args, kwargs):
+        """Submits fn(*args, **kwargs) to the pool. The arguments contain no futures.
+        Returns a concurrent.futures.Future"""
+        raise NotImplementedError
+
+
+    def _wrap_result(self, result):
+        """Converts the result of a function before it is stored in a future."""
+        return(result)
+
+
+    def submit(self, fn, *args, workers=None, allow_other_workers=False, **kwargs):
+        """Calls fn(*args, **kwargs) once all futures in args and kwargs are finished.
+        The placement hints workers and allow_other_workers of dask are accepted and ignored.
+
+        Returns:
+        ========
+        future: local_future
+        """
+        deps = find_futures(args) + find_futures(kwargs)
+        future = local_future(deps)
+
+        num_pending = [len(deps)]
+        lock = threading.Lock()
+
+        def on_finished(pool_future):
+            try:
+                future._set_result(self._wrap_result(pool_future.result()))
+            except Exception as exc:
+                future._set_exception(exc)
+
+        def on_dep_done(_):
+            with lock:
+                num_pending[0] -= 1
+                if num_pending[0] > 0:
+                    return
+            # All dependencies are finished. Propagate their errors, as dask does.
+            for dep in deps:
+                if dep.exception() is not None:
+                    future._set_exception(dep.exception())
+                    return
+            self._run(fn, resolve_futures(args), resolve_futures(kwargs)).add_done_callback(on_finished)
+
+        if len(deps) == 0:
+            self._run(fn, args, kwargs).add_done_callback(on_finished)
+        else:
+            for dep in deps:
+                dep.add_done_callback(on_dep_done)
+
+        return(future)
+
+
+    def scatter(self, data, broadcast=True, workers=None):
+        """Returns a finished future that holds data. All workers share the same memory,
+        so broadcast and workers have no effect."""
+        future = local_future()
+        future._set_result(self._wrap_result(data))
+        return(future)
+
+
+    def gather(self, futures):
+        """Returns the results of a future or a list of futures. Blocks until they are evaluated."""
+        if isinstance(futures, local_future):
+            return(futures.result())
+        return([f.result() for f in futures])
+
+
+    def run(self, fn, *args, **kwargs):
+        """Calls fn on the local node. Used for setup functions, f.ex. to extend sys.path."""
+        return(fn(*args, **kwargs))
+
+
+    def register_plugin(self, plugin):
+        """Runs the setup method of a worker plugin, see worker_setup.py.
+        The threads share this process, so the plugin is set up here."""
+        plugin.setup(worker=None)
+
+
+    def close(self):
+        """Shuts down the pool."""
+        self.pool.shutdown(wait=True)
+
+
+class thread_executor(local_executor_base):
+    """Runs the tasks in a thread pool of the current process."""
+
+    def __init__(self, max_workers=None):
+        """
+        Input:
+        ======
+        max_workers: int, number of threads. None uses the default of ThreadPoolExecutor.
+        """
+        super().__init__(ThreadPoolExecutor(max_workers=max_workers))
+
+
+    def _run(self, fn, args, kwargs):
+        return(self.pool.submit(fn, *args, **kwargs))
+
+
+class shared_array():
+    """Picklable descriptor of an ndarray in shared memory.
+    In the parent process, local holds the original array. It is not pickled."""
+
+    def __init__(self, name, shape, dtype, local=None):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.local = local
+
+
+    def __getstate__(self):
+        return({"name": self.name, "shape": self.shape, "dtype": self.dtype, "local": None})
+
+
+def to_shared_memory(arr):
+    """Copies an ndarray into a new shared memory block.
+
+    Returns:
+    ========
+    shm: SharedMemory. Has to be kept alive as long as the array is used.
+    desc: shared_array. Describes the array for the workers.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return(shm, shared_array(shm.name, arr.shape, arr.dtype, local=arr))
+
+
+def release_shared_memory(shm):
+    """Closes and removes a shared memory block."""
+    shm.close()
+    shm.unlink()
+
+
+def attach_shared(obj, segments):
+    """Replaces the shared_array descriptors in obj by ndarrays that view the shared memory.
+    The attached SharedMemory objects are appended to segments."""
+    if isinstance(obj, shared_array):
+        # The workers are forked after the resource tracker of the parent is started and share it,
+        # so the block is only removed by the parent. See process_executor.
+        shm = shared_memory.SharedMemory(name=obj.name)
+        segments.append(shm)
+        return(np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf))
+    if isinstance(obj, list):
+        return([attach_shared(item, segments) for item in obj])
+    if isinstance(obj, tuple):
+        return(tuple([attach_shared(item, segments) for item in obj]))
+    if isinstance(obj, dict):
+        return({key: attach_shared(item, segments) for key, item in obj.items()})
+    return(obj)
+
+
+def run_in_worker(call_pickled):
+    """Runs a cloudpickled call (fn, args, kwargs) on arguments that may reference shared memory."""
+    fn, args, kwargs = cloudpickle.loads(call_pickled)
+    segments = []
+    res = fn(*attach_shared(args, segments), **attach_shared(kwargs, segments))
+
+    # The result is pickled back to the parent, so it must not view the shared memory
+    if isinstance(res, np.ndarray) and not res.flags.owndata:
+        res = res.copy()
+    for shm in segments:
+        try:
+            shm.close()
+        except BufferError:
+            # Some object still views the block. It is closed when that object is collected.
+            pass
+
+    return(res)
+
+
+class process_executor(local_executor_base):
+    """Runs the tasks in a process pool.
+
+    Functions and arguments are serialized with cloudpickle, so closures such as the kernels
+    defined in task_spectral work. ndarrays that are scattered or returned by a task and are larger than
+    min_shared_bytes are moved to shared memory. Tasks that use them attach to the shared
+    memory instead of receiving a pickled copy. A block is removed once its future is
+    garbage-collected.
+    """
+
+    def __init__(self, max_workers=None, min_shared_bytes=1 << 16):
+        """
+        Input:
+        ======
+        max_workers: int, number of processes. None uses the number of cores.
+        min_shared_bytes: int, arrays smaller than this are pickled instead of shared
+        """
+        # Start the resource tracker before forking, so that the workers share it with this process.
+        # A worker with its own tracker would remove the shared memory blocks it used when it exits.
+        resource_tracker.ensure_running()
+        super().__init__(ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context("fork")))
+        self.min_shared_bytes = min_shared_bytes
+        self.max_workers = self.pool._max_workers
+        # Fork all workers now, from the main thread. Later submits come from callback threads.
+        self.pool.submit(int).result()
+
+
+    def register_plugin(self, plugin):
+        """Runs the setup method of a worker plugin, see worker_setup.py, here and in the worker processes.
+        The setup is submitted once per worker process. The pool does not guarantee that each process
+        picks up one of them, so this is a best effort. Setup methods have to be idempotent."""
+        plugin.setup(worker=None)
+        setup_pickled = cloudpickle.dumps((plugin.setup, (), {}))
+        for f in [self.pool.submit(run_in_worker, setup_pickled) for _ in range(self.max_workers)]:
+            f.result()
+
+
+    def _wrap_result(self, result):
+        if not isinstance(result, np.ndarray) or result.nbytes < self.min_shared_bytes:
+            return(result)
+        shm, desc = to_shared_memory(result)
+        # Remove the block when the descriptor, i.e. the future holding it, is collected
+        weakref.finalize(desc, release_shared_memory, shm)
+        return(desc)
+
+
+    def _run(self, fn, args, kwargs):
+        # Kernels are often closures, also when passed as arguments (see task_spectral.apply_to_tile)
+        return(self.pool.submit(run_in_worker, cloudpickle.dumps((fn, args, kwargs))))
+
+
+# End of file local_executor.py
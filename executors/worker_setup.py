@@ -0,0 +1,123 @@
+# Coding: UTF-8 -*-
+
+"""
+Prepares the workers for the analysis tasks, once when each worker starts.
+
+A worker that starts up imports numpy, scipy and the analysis modules, and builds the
+window function, when it runs its first task. This makes the first time step after a
+(re-)start much slower than the following ones. warm_up does this work ahead of time: It
+imports the kernels (see analysis/kernels.py), builds the cached fft_setup and runs one
+transform of the configured size.
+
+There are two ways to run it on dask workers:
+
+* As a worker plugin, registered by the processor. dask runs it on all current workers
+  and on every worker that joins or restarts later.
+  >>> setup_workers(dask_client, fft_params)
+
+* As a preload module, when starting the workers. This also works when the repository is
+  not on the python path of the workers.
+  $ dask worker --scheduler-file scheduler.json --preload /path/to/delta/executors/worker_setup.py
+
+The analysis modules are not imported at module level, only once the repository is on the
+python path.
+"""
+
+import os
+import sys
+import time
+
+import cloudpickle
+from distributed.diagnostics.plugin import WorkerPlugin
+
+
+# Root of the repository, i.e. the directory that contains analysis/ and executors/
+source_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def add_source_path(path=None):
+    """Adds the root of the repository to the python path, so that the analysis modules can be imported."""
+    if path is None:
+        path = source_path
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def warm_up(fft_params=None):
+    """Imports the analysis kernels and builds the FFT setup.
+
+    Input:
+    ======
+    fft_params: dict, as returned by task_fft_*.get_fft_params. If None, only the imports are done.
+
+    Returns:
+    ========
+    info: dict, with the registered kernel names and the time spent, in s
+    """
+    t0 = time.perf_counter()
+    import numpy as np
+    import scipy.fft
+    import scipy.signal
+    from analysis import kernels
+
+    if fft_params is not None:
+        # Build the cached window and frequency axis, and run one transform of this size
+        setup = kernels.get_setup(fft_params)
+        dtype = np.float32 if fft_params.get("precision", "double") == "single" else np.float64
+        setup.fft(np.zeros((1, fft_params["nfft"]), dtype=dtype))
+
+    return({"kernels": sorted(kernels.kernel_registry.keys()), "time": time.perf_counter() - t0})
+
+
+class analysis_plugin(WorkerPlugin):
+    """Worker plugin that runs warm_up when a worker starts.
+    The plugin is pickled by value, so the workers do not need to import this module to load it."""
+
+    # Registering a plugin with the same name replaces the previous one
+    name = "delta-analysis"
+
+    def __init__(self, fft_params=None, path=None):
+        """
+        Input:
+        ======
+        fft_params: dict, as returned by task_fft_*.get_fft_params
+        path: string, root of the repository on the workers. Defaults to the path on the driver.
+        """
+        self.fft_params = fft_params
+        self.path = source_path if path is None else path
+
+
+    def setup(self, worker=None):
+        add_source_path(self.path)
+        info = warm_up(self.fft_params)
+        if worker is not None:
+            worker.log_event("delta-analysis", info)
+
+
+def setup_workers(dask_client, fft_params=None, path=None):
+    """Registers an analysis_plugin with an executor, so that warm_up runs on all its workers.
+    dask also runs the plugin on workers that start later.
+
+    Input:
+    ======
+    dask_client: distributed.Client, thread_executor or process_executor
+    fft_params: dict, as returned by task_fft_*.get_fft_params
+    path: string, root of the repository on the workers. Defaults to the path on the driver.
+    """
+    # Ship the plugin by value. Workers can load it before the repository is on their python path.
+    cloudpickle.register_pickle_by_value(sys.modules[__name__])
+    try:
+        dask_client.register_plugin(analysis_plugin(fft_params, path))
+    finally:
+        cloudpickle.unregister_pickle_by_value(sys.modules[__name__])
+
+    return None
+
+
+def dask_setup(worker):
+    """Entry point for dask worker --preload."""
+    add_source_path()
+    warm_up()
+
+
+# End of file worker_setup.py
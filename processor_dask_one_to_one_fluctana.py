@@ -33,13 +33,21 @@ import numpy as np
 
 import json
 import argparse
-from distributed import Client, progress
 
 from backends.mongodb import mongodb_backend
+from executors.factory import get_executor, fire_and_forget
+from executors.worker_setup import setup_workers
 from readers.reader_one_to_one import reader_bpfile
-from analysis.task_fft import task_fft_scipy
+from readers.prefetch import step_prefetcher
+from analysis.task_fft import task_fft_scipy, task_fft_kstar, stack_fft_blocks
 
 from analysis.task_spectral import task_spectral, task_cross_phase, task_cross_power, task_coherence, task_bicoherence, task_xspec, task_cross_correlation
+from analysis.execution_plan import execution_plan
+from analysis.channels import channel_layout
+from analysis.pipeline import pipeline_step, step_pipeline
+from analysis.result_sink import result_sink
+from analysis.scheduling import deadline_policy, decimate_fft_data
+from analysis.sharding import channel_sharding, get_worker_addresses
 
 
 import timeit
@@ -57,16 +65,6 @@ task_object_dict = {"cross_phase": task_cross_phase,
 
 # This object manages storage to a backend.
 mongo_client = mongodb_backend()
-# Interface to worker nodes
-dask_client = Client(scheduler_file="/global/cscratch1/sd/rkube/scheduler.json")
-
-
-# Add the source path to all workers so that the imports are working :)
-def add_path():
-    import sys
-    sys.path.append("/global/homes/r/rkube/repos/delta")
-
-dask_client.run(add_path)
 
 
 # Parse command line arguments and read configuration file
@@ -78,13 +76,30 @@ with open(args.config, "r") as df:
     cfg = json.load(df)
     df.close()
 
+# Interface to worker nodes. Either a dask client or a thread or process pool on the local node.
+# See executors/factory.py
+dask_client = get_executor(cfg.get("executor", {"type": "dask",
+                                                "scheduler_file": "/global/cscratch1/sd/rkube/scheduler.json"}))
+
+
 # Sample rate in Hz
 cfg["fft_params"]["fsample"] = cfg["ECEI_cfg"]["SampleRate"] * 1e3
-
-# Create the FFT task
-my_fft = task_fft_scipy(10_000, cfg["fft_params"], normalize=True, detrend=True)
+# Floating point precision used from the reader through the analysis. See analysis/precision.py
+precision = cfg.get("precision", "double")
+cfg["fft_params"]["precision"] = precision
+
+# Create the FFT task. "engine": "kstar" uses the conventions of fluctana's fftbins, "scipy" uses scipy's stft.
+fft_engine_dict = {"scipy": task_fft_scipy, "kstar": task_fft_kstar}
+# Number of samples per channel and time step of the stream. See tune_dask_one_to_one_fluctana.py
+chunk_size = cfg.get("chunk_size", 10_000)
+my_fft = fft_engine_dict[cfg["fft_params"].get("engine", "scipy")](chunk_size, cfg["fft_params"], normalize=True, detrend=True)
 fft_params = my_fft.get_fft_params()
 
+# Add the source path to the workers, import the analysis kernels and prepare the FFT once per worker.
+# Workers that restart are set up again. "source_path" defaults to the location of this repository.
+# See executors/worker_setup.py
+setup_workers(dask_client, fft_params, cfg.get("source_path", None))
+
 # Build list of analysis tasks that are performed at any given time step
 # Here we iterate over the task list defined in the json file
 # Each task needs to define the field 'analysis' that describes an analysis to be performed
@@ -94,28 +109,92 @@ task_list = []
 for task_config in cfg["task_list"]:
     task_list.append(task_object_dict[task_config["analysis"]](task_config, fft_params))
 
-reader = reader_bpfile(cfg["shotnr"], cfg["ECEI_cfg"])
+# Read only the channels that the tasks use. The data has one row per channel of the layout,
+# and the tasks index it by the rows of their channels. See analysis/channels.py
+layout = channel_layout.union([task.get_channels() for task in task_list])
+for task in task_list:
+    task.set_layout(layout)
+print("Reading {0:d} channels: {1:s}".format(len(layout), layout.to_str()))
+
+# Group tasks on the same channel pairs so that they share intermediate results.
+plan = execution_plan(task_list)
+print(plan.describe())
+
+# The reader re-uses its buffers. Up to "prefetch" steps are read ahead in the background while
+# max_in_flight steps are computed, see below and readers/prefetch.py
+prefetch_depth = cfg.get("prefetch", 2)
+reader = reader_bpfile(cfg["shotnr"], cfg["ECEI_cfg"], precision=precision,
+                       num_buffers=prefetch_depth + cfg.get("max_in_flight", 2) + 1)
 reader.Open(cfg["datapath"])
 
+
+# Optionally shed load when steps take longer than a latency budget, f.ex.
+# "deadline": {"budget": 2.0}. See analysis/scheduling.py
+policy = deadline_policy(cfg["deadline"], task_list) if "deadline" in cfg else None
+
+
+def write_result(task, step, name, res):
+    """Stores the result of a task at a time step. Called from the writer thread of the result sink.
+    name is 'res' for the result of the step and 'res_acc' for the estimate from the spectra
+    accumulated over all steps up to this one.
+    The normalization state and the load shedding decision of the step are stored along with the result."""
+    suffix = "" if name == "res" else "_acc"
+    fname = "test_data/{0:s}_{1:03d}{2:s}.npz".format(task.description, step, suffix)
+    print("...saving to {0:s}".format(fname))
+    info = {key: json.dumps(value) for key, value in step_info[step].items()}
+    if policy is not None:
+        info["shedding"] = json.dumps(policy.decisions[step])
+    np.savez(fname, **{name: res}, **info)
+
+    # Pass the task object to our backend for storage
+    #mongo_client.store_result(task, res, dummy=True, info=info)
+
+
+# Steps are pipelined: While the cluster computes step s, the driver reads step s+1, and the
+# results of earlier steps are stored in the background as they complete. At most max_in_flight
+# steps are dispatched but not yet stored. See analysis/pipeline.py and analysis/result_sink.py
+# Information on each step that is stored with its results, by step index
+step_info = {}
+sink = result_sink(write_result, max_queue=cfg.get("max_queue", 8))
+pipe = step_pipeline(cfg.get("max_in_flight", 2), sink, policy)
+
+# Read the steps ahead in a background thread: BeginStep, Get, EndStep. The reader normalizes the
+# data once the offset is known. The time base and the normalization state are taken along with the data.
+prefetcher = step_prefetcher(reader, lambda r: r.Get(layout.channels),
+                             lambda r: {"tb": r.gen_timebase(), "normalization": r.normalization.get_state()},
+                             depth=prefetch_depth)
+
 print("Starting main loop")
 s = 0
 
 while(True):
-    stepStatus = reader.BeginStep()
-    tic_tstep = timeit.default_timer()
+    # Back-pressure: Do not read a new step while too many steps are in flight.
+    # When the deadline policy drops steps, read the step anyway and drop it if the pipeline is full.
+    pipe.wait_for_slot(block=(policy is None or not policy.may_drop()))
+
+    step = pipeline_step(s)
+    step.start("read")
+    item = prefetcher.get()
+    stepStatus = item is not None
 
     # Iterate over the task list and update the required data at the current time step
     if stepStatus:
-        print("ok")
-        task_futures = []
-
-        # generate a dummy time-base for the data of the current chunk
-        dummy_tb = np.arange(0.0, 2e-2, 2e-6) * float(s+1)
-  
-        # Get the raw data from the stream
-        stream_data = reader.Get()
-        tb = reader.gen_timebase()
-
+        # The data of the step, in a buffer of the reader
+        stream_data = item.data
+        tb = item.meta["tb"]
+        step.stop("read")
+        step_info[s] = {"normalization": item.meta["normalization"]}
+        step.metrics["normalized"] = item.meta["normalization"]["state"] == "ready"
+
+        # Decide which work to shed for this step
+        decision = {"skipped": [], "decimate": 1, "dropped": False}
+        if policy is not None:
+            decision = policy.decide(step, pipe.is_full())
+        if decision["dropped"]:
+            print("*** Dropping step {0:d}".format(s))
+
+    if stepStatus and not decision["dropped"]:
+        step.start("dispatch")
         # There are basically two options of distributing the FFT of the stream_data
         # among the workers.
         # Option 1) Create a dask array
@@ -123,78 +202,78 @@ while(True):
         #raw_data = da.from_array(raw_data, chunks=(1, 10_000))
         #dask_client.persist(raw_data)
 
-        # Option 2)
-        # Scatter the raw data to the workers.
-        stream_data_future = dask_client.scatter(stream_data, broadcast=True)
-
-        tic_fft = timeit.default_timer()
-        # Perform a FFT on the raw data
-        fft_future = my_fft.do_fft(dask_client, stream_data_future)
-        # gather pulls the result of the operation: 
-        # https://docs.dask.org/en/latest/futures.html#distributed.Client.gather
-        results = dask_client.gather(fft_future)
-        toc_fft = timeit.default_timer()
-        print("*** main_loop: FFT took {0:f}s".format(toc_fft - tic_fft))
-
-        # concatenate the results into a numpy array
-        fft_data = np.array(results)
-        np.savez("test_data/fft_data_s{0:04d}.npz".format(s), fft_data=fft_data)
-
-        # Broadcast the fourier-transformed data to all workers
-        fft_future = dask_client.scatter(fft_data, broadcast=True)
-
-        #fft_data = da.from_array(results)
-        #dask_client.persist(fft_data)
-        #fft_future = dask_client.scatter(fft_data, broadcast=True)
-        #if (s == 0):
-        #print("***storing fft_data: ", type(fft_data.compute()))
-        #np.savez("test_data/dask_fft_data_s{0:04d}.npz".format(s), fft_data=fft_data.compute())
-
-
-        #print("*** main_loop: type(fft_future) = ", type(fft_future), fft_future)
-
-        for task in task_list:
-            print("*** main_loop: ", task.description)
-            task.calculate(dask_client, fft_future)
-            #task.update_data(data_ft, dummy_tb)
-
-            # Method 1: Pass dask_client to object
-            #task_futures.append(task.method(dask_client))
+        if "sharding" in cfg:
+            # Option 3)
+            # Place blocks of channels on specific workers. The FFT of each block runs where the block is,
+            # and pair tiles run where most of their channels are. See analysis/sharding.py
+            sharding = channel_sharding(stream_data.shape[0], cfg["sharding"]["block_size"], get_worker_addresses(dask_client))
+            stream_data_future = sharding.scatter(dask_client, stream_data)
+            fft_future = my_fft.do_fft(dask_client, stream_data_future, stream_data.shape[0])
+            fft_block_futures = fft_future.futures
+            step.metrics["scatter_MB"] = stream_data_future.scatter_bytes / 1e6
+
+        else:
+            # Option 2)
+            # Scatter the raw data to the workers.
+            stream_data_future = dask_client.scatter(stream_data, broadcast=True)
+            step.metrics["scatter_MB"] = stream_data.nbytes * len(get_worker_addresses(dask_client)) / 1e6
+
+            # Perform a FFT on the raw data
+            fft_block_futures = my_fft.do_fft(dask_client, stream_data_future, stream_data.shape[0])
+            # Concatenate the channel blocks on the workers. The fourier-transformed data stays on
+            # the cluster and is moved between workers by dask as the analysis tasks require it.
+            fft_future = dask_client.submit(stack_fft_blocks, fft_block_futures)
+
+        # Time at which the fourier-transformed data is complete, see analysis/pipeline.py
+        step.watch("fft", fft_block_futures)
+
+        # Optionally store the fourier-transformed data. This is written by a worker.
+        if cfg.get("save_fft", False):
+            fire_and_forget(dask_client.submit(np.savez, "test_data/fft_data_s{0:04d}.npz".format(s),
+                                               fft_data=dask_client.submit(stack_fft_blocks, fft_block_futures)))
+
+        # Shed load: Use fewer STFT bins
+        if decision["decimate"] > 1:
+            fft_future = decimate_fft_data(dask_client, fft_future, stream_data.shape[0], decision["decimate"])
+
+        # Dispatch all analysis tasks, except for the ones that are shed at this step
+        plan.calculate(dask_client, fft_future, skip=decision["skipped"])
+        if "sharding" in cfg:
+            # Fourier-transformed data moved between workers by the analysis tasks
+            step.metrics["transfer_MB"] = fft_future.transfer_bytes / 1e6
+        # Keep the futures of this step. The next call to calculate replaces them in the task objects.
+        step.snapshot([task for task in task_list if task.description not in decision["skipped"]])
+        # Time at which the last tile of the step is complete
+        step.watch("analysis", step.get_futures())
+        step.stop("dispatch")
+
+        pipe.push(step)
 
-            # Method 2: Get method and data from object
-            #task_futures.append(dask_client.submit(task.get_method(), task.get_data()))
+    if stepStatus:
+        # Steps in flight may still use the buffer. The reader has enough buffers for them, see above.
+        prefetcher.release(item)
 
-    else:
+    elif not stepStatus:
         print("End of stream")
         break
 
-    reader.EndStep()
-
-    # Store result in npz file for quick comparison
-    for task in task_list:
-        res = []
-        for f in task.futures_list:
-            res.append(f.result()[1])
-        res = np.array(res)
-        fname = "test_data/{0:s}_{1:03d}.npz".format(task.description, s)
-        print("...saving to {0:s}".format(fname))
-        np.savez(fname, res=res)
-
-
-    #tic_mongo = timeit.default_timer()
-    # Pass the task object to our backend for storage
-    #for task in task_list:
-    #     mongo_client.store(task, dummy=True)
-    #toc_mongo = timeit.default_timer()
-    #print("Storing data: Elapsed time: ", toc_mongo - tic_mongo)
-
-    toc_tstep = timeit.default_timer()
-    print("Processed timestep {0:d}: Elapsed time: {1:6.3f}s".format(s, toc_tstep - tic_tstep))
-
     # Do only 10 time steps for now
     s -= -1
     if s > 2:
         break
 
+if not prefetcher.stop():
+    print("*** Prefetcher is still waiting for the stream")
+# Store the steps that are still in flight
+pipe.drain()
+print(pipe.summary())
+# Tells whether the analysis waits for the stream, or the stream for the analysis
+print(prefetcher.summary())
+if policy is not None:
+    # Log of the load shedding decisions, including the dropped steps
+    with open("test_data/shedding.json", "w") as df:
+        json.dump(policy.decisions, df, indent=1)
+dask_client.close()
+
 
 # End of file processor_dask_one_to_one.py.
\ No newline at end of file
@@ -0,0 +1,239 @@
+# Coding: UTF-8 -*-
+
+"""
+Reads the time steps of an ADIOS2 stream ahead of the analysis, in a background thread.
+
+The readers in processors/readers.py, processors/readers_nompi.py and readers/reader_one_to_one.py
+are driven by the main loop: BeginStep, get_data or Get, EndStep. While a step is read, no
+analysis runs, and while the analysis runs, no step is read. step_prefetcher runs this loop
+in a background thread instead and keeps up to depth steps ready for the consumer.
+
+The data of a step is passed on as it is returned by the reader, without a copy. The
+consumer hands a step back with release once it no longer uses the data. At most depth
+steps are read ahead or held by the consumer. readers that re-use their buffers, such as
+reader_one_to_one.reader_base, need more buffers than that: num_buffers >= depth + 1, plus
+the steps that are still used after they are released.
+
+End of stream: get returns None, and iterating over the prefetcher stops. An exception in the
+background thread is raised in the consumer by get.
+
+The counters tell which side is the bottleneck, see stats:
+* consumer_wait: time the consumer waited for a step. The stream is slower than the analysis.
+* producer_wait: time the reader waited for a free slot. The analysis is slower than the stream.
+* queue depth: number of steps that were ready each time the consumer asked for one.
+
+>>> pf = step_prefetcher(reader, lambda r: r.Get(), depth=2)
+>>> for item in pf:
+>>>     ...item.data, item.meta...
+>>>     pf.release(item)
+>>> print(pf.stats())
+"""
+
+import queue
+import threading
+import timeit
+
+import adios2
+
+
+def is_step_ok(status):
+    """Returns true if BeginStep returned a new step.
+    reader_one_to_one returns a bool, the readers in processors/ return an adios2.StepStatus."""
+    if isinstance(status, bool):
+        return(status)
+    return(status == adios2.StepStatus.OK)
+
+
+class prefetched_step():
+    """Data and metadata of a step that was read ahead."""
+
+    def __init__(self, step, data, meta, t_read):
+        """
+        Input:
+        ======
+        step: int, index of the step, counted from 0 by the prefetcher
+        data: the data returned by the reader. Not copied.
+        meta: dict, metadata of the step, see step_prefetcher
+        t_read: list of two floats, begin and end of reading the step, see timeit.default_timer
+        """
+        self.step = step
+        self.data = data
+        self.meta = meta
+        self.t_read = t_read
+
+
+class step_prefetcher():
+    """Runs the step loop of a reader in a background thread and keeps up to depth steps ready."""
+
+    def __init__(self, reader, get_step, get_meta=None, depth=2, start=True):
+        """
+        Input:
+        ======
+        reader: An opened reader, with BeginStep and EndStep
+        get_step: callable, get_step(reader) returns the data of the current step.
+                  Called between BeginStep and EndStep in the background thread.
+        get_meta: callable or None, get_meta(reader) returns a dict with metadata of the current step,
+                  f.ex. the time base. Called after get_step. Defaults to the step of the reader.
+        depth: int, maximum number of steps that are read ahead or held by the consumer
+        start: bool, if true, start reading right away. Otherwise call start().
+        """
+        self.reader = reader
+        self.get_step = get_step
+        self.get_meta = get_meta if get_meta is not None else lambda r: {"current_step": r.CurrentStep()}
+        self.depth = depth
+
+        # Steps that are ready for the consumer. The end of the stream is marked by None,
+        # an error in the background thread by the exception.
+        self.ready = queue.Queue()
+        # Free slots. A slot is taken before a step is read and returned by release.
+        self.slots = threading.Semaphore(depth)
+        self.stopped = threading.Event()
+        self.finished = False
+
+        # Counters, see stats
+        self.num_steps = 0
+        self.num_released = 0
+        self.producer_wait = 0.0
+        self.consumer_wait = 0.0
+        self.depth_sum = 0
+        self.num_gets = 0
+        self.t_read = 0.0
+
+        self.thread = threading.Thread(target=self.read_loop, daemon=True)
+        if start:
+            self.start()
+
+
+    def start(self):
+        """Starts the background thread."""
+        self.thread.start()
+
+
+    def read_loop(self):
+        """Runs in the background thread. Reads steps until the end of the stream or until stop is called."""
+        try:
+            while not self.stopped.is_set():
+                t0 = timeit.default_timer()
+                # Wait for a free slot. Check for stop once in a while.
+                while not self.slots.acquire(timeout=0.1):
+                    if self.stopped.is_set():
+                        return None
+                t1 = timeit.default_timer()
+                self.producer_wait += t1 - t0
+
+                if not is_step_ok(self.reader.BeginStep()):
+                    self.slots.release()
+                    break
+                data = self.get_step(self.reader)
+                meta = self.get_meta(self.reader)
+                self.reader.EndStep()
+                t2 = timeit.default_timer()
+                self.t_read += t2 - t1
+
+                self.ready.put(prefetched_step(self.num_steps, data, meta, [t1, t2]))
+                self.num_steps += 1
+
+        except Exception as exc:
+            print("*** step_prefetcher: Reading step {0:d} failed: {1}".format(self.num_steps, exc))
+            self.ready.put(exc)
+            return None
+
+        # End of the stream
+        self.ready.put(None)
+        return None
+
+
+    def get(self, timeout=None):
+        """Returns the next step.
+
+        Input:
+        ======
+        timeout: float or None. Wait at most timeout seconds. Raises queue.Empty if no step is ready by then.
+
+        Returns:
+        ========
+        item: prefetched_step, or None at the end of the stream
+        """
+        if self.finished:
+            return None
+
+        self.depth_sum += self.ready.qsize()
+        self.num_gets += 1
+        t0 = timeit.default_timer()
+        item = self.ready.get(timeout=timeout)
+        self.consumer_wait += timeit.default_timer() - t0
+
+        if isinstance(item, Exception):
+            self.finished = True
+            raise item
+        if item is None:
+            self.finished = True
+        return(item)
+
+
+    def release(self, item):
+        """Hands a step back. The reader may overwrite its data after that."""
+        item.data = None
+        self.num_released += 1
+        self.slots.release()
+
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+
+    def stop(self, timeout=1.0):
+        """Stops reading ahead. Steps that are ready are discarded.
+
+        Waits at most timeout seconds for the background thread. With a streaming engine, the
+        thread can be blocked in BeginStep until the next step arrives. It is a daemon thread
+        and does not keep the program from exiting.
+
+        Returns:
+        ========
+        stopped: bool, true if the background thread has finished
+        """
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        self.finished = True
+        return(not self.thread.is_alive())
+
+
+    def stats(self):
+        """Returns the counters of the prefetcher.
+
+        Returns:
+        ========
+        stats: dict with fields
+               "num_steps": number of steps read
+               "t_read": total time spent in BeginStep, get_step and EndStep, in s
+               "num_released": number of steps handed back by the consumer
+               "producer_wait": total time the reader waited for a free slot, in s
+               "consumer_wait": total time the consumer waited for a step, in s
+               "mean_depth": mean number of steps that were ready when the consumer asked for one
+               "bottleneck": "stream" if the consumer waited longer than the reader, "analysis" otherwise
+        """
+        return({"num_steps": self.num_steps,
+                "num_released": self.num_released,
+                "t_read": self.t_read,
+                "producer_wait": self.producer_wait,
+                "consumer_wait": self.consumer_wait,
+                "mean_depth": self.depth_sum / max(1, self.num_gets),
+                "bottleneck": "stream" if self.consumer_wait > self.producer_wait else "analysis"})
+
+
+    def summary(self):
+        """Formats stats for the end of a run, see step_pipeline.summary."""
+        stats = self.stats()
+        return("Read {0:d} steps in {1:6.3f}s. The analysis waited {2:6.3f}s for the stream, the reader waited {3:6.3f}s "
+               "for the analysis. Mean queue depth {4:4.2f} of {5:d}. Bottleneck: {6:s}".format(
+               stats["num_steps"], stats["t_read"], stats["consumer_wait"], stats["producer_wait"],
+               stats["mean_depth"], self.depth, stats["bottleneck"]))
+
+
+# End of file prefetch.py
@@ -3,10 +3,45 @@
 import adios2
 import numpy as np
 from analysis.channels import channel, channel_range
+from analysis.precision import get_dtypes
+from analysis.normalization import ecei_normalization
+
+
+# Maps ADIOS2 variable types to numpy data types. Raw digitizer counts are stored as integers.
+adios_dtypes = {"float": np.float32, "double": np.float64,
+                "int8_t": np.int8, "int16_t": np.int16, "int32_t": np.int32, "int64_t": np.int64,
+                "uint8_t": np.uint8, "uint16_t": np.uint16, "uint32_t": np.uint32, "uint64_t": np.uint64}
+
+
+def get_file_dtype(var):
+    """Returns the numpy data type of an ADIOS2 variable.
+
+    Input:
+    ======
+    var: adios2 variable
+
+    Returns:
+    ========
+    dtype: numpy data type, see adios_dtypes. Raises a ValueError for types that can not be read as ECEI data.
+    """
+    if var.Type() not in adios_dtypes:
+        raise ValueError("Variable {0:s} has type {1:s}. Supported types are {2:s}".format(
+                         var.Name(), var.Type(), ", ".join(adios_dtypes.keys())))
+    return(adios_dtypes[var.Type()])
 
 
 class reader_base():
-    def __init__(self, shotnr, ecei_cfg):
+    def __init__(self, shotnr, ecei_cfg, precision="double", num_buffers=2):
+        """
+        Inputs:
+        =======
+        shotnr: int, shot number
+        ecei_cfg: dict, configuration of the ECEI diagnostic
+        precision: string, either 'double' or 'single'. See analysis/precision.py
+        num_buffers: int, number of buffers that Get cycles through. The array returned by Get is
+                     overwritten num_buffers steps later. Use at least the number of steps that are
+                     processed concurrently plus one.
+        """
         self.adios = adios2.ADIOS()
         self.shotnr = shotnr
         self.IO = self.adios.DeclareIO("KSTAR_18431")
@@ -23,6 +58,20 @@ class reader_base():
 
         # Defines the time where we take the offset
         self.tnorm = ecei_cfg["t_norm"]
+        # Normalization stage. Its state tells downstream tasks whether the data is normalized.
+        # See analysis/normalization.py
+        self.normalization = ecei_normalization(self.tnorm, ecei_cfg["SampleRate"] * 1e3)
+
+        # Data type of the returned data. Either float64 or float32, see analysis/precision.py
+        self.dtype, _ = get_dtypes(precision)
+
+        # ADIOS variables of the channels, inquired once for each list of channels
+        self.variables = {}
+        # Buffers that Get reads into, dim0: channel, dim1: sample. They are re-used across steps.
+        self.buffers = [None] * num_buffers
+        self.buffer_idx = -1
+        # Buffer in the data type of the file, if it differs from self.dtype
+        self.staging_buffer = None
 
 
     def Open(self, datapath):
@@ -79,7 +128,59 @@ class reader_base():
         return(tb)
 
 
-    
+    def get_variables(self, channels):
+        """Returns the ADIOS variables of a list of channels. They are inquired once and re-used in later steps."""
+        key = tuple([str(c) for c in channels])
+        if key not in self.variables:
+            self.variables[key] = [self.IO.InquireVariable("ECEI_" + c) for c in key]
+        return(self.variables[key])
+
+
+    def next_buffer(self, shape, dtype):
+        """Returns the next buffer of the ring. A buffer is only re-allocated when the shape changes."""
+        self.buffer_idx = (self.buffer_idx + 1) % len(self.buffers)
+        buffer = self.buffers[self.buffer_idx]
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[self.buffer_idx] = buffer
+        return(buffer)
+
+
+    def read_channels(self, channels):
+        """Reads the data of the current step into the next buffer and scales it by 1e-4.
+
+        Deferred Gets are issued straight into the rows of the buffer, and are performed
+        together with a single PerformGets. If the file has the same data type as self.dtype,
+        the data is read into the buffer and scaled in place. Otherwise it is read into a
+        staging buffer and converted while scaling.
+
+        Inputs:
+        =======
+        channels: channel_range
+
+        Returns:
+        ========
+        io_array: ndarray, dim0: channel, dim1: sample. Valid until len(self.buffers) more steps are read.
+        """
+        variables = self.get_variables(channels)
+        shape = (len(variables), int(np.prod(variables[0].Shape())))
+        file_dtype = get_file_dtype(variables[0])
+
+        io_array = self.next_buffer(shape, self.dtype)
+        target = io_array
+        if file_dtype != self.dtype:
+            if self.staging_buffer is None or self.staging_buffer.shape != shape or self.staging_buffer.dtype != file_dtype:
+                self.staging_buffer = np.empty(shape, dtype=file_dtype)
+            target = self.staging_buffer
+
+        for row, var in zip(target, variables):
+            self.reader.Get(var, row, adios2.Mode.Deferred)
+        self.reader.PerformGets()
+
+        np.multiply(target, 1e-4, out=io_array, casting="unsafe")
+        return(io_array)
+
+
     def Get(self, channels=None):
         """Get data from varname at current step.
 
@@ -87,13 +188,15 @@ class reader_base():
         at the beginning of the stream.
 
         The time interval where the data we normalize to is taken from is given in ECEI_config, t_norm.
-        As long as this data is not seen by the reader, raw data is returned.
+        It may span several chunks. As long as this interval has not been passed, raw data is returned.
         
-        Once the data we normalize to is seen, the normalization values are calculated.
-        After that, the data from the current and all subsequent chunks is normalized.
+        Once the interval is passed, the normalization values are calculated.
+        After that, the data from the current and all subsequent chunks is normalized in place.
+        See analysis/normalization.py
     
         The flag self.is_data_normalized is set to false if raw data is returned.
-        It is set to true if normalized data is returned.
+        It is set to true if normalized data is returned. self.normalization.get_state()
+        gives the details.
 
 
         Inputs:
@@ -103,67 +206,30 @@ class reader_base():
         
         Returns:
         ========
-        io_array: numpy ndarray containing data of the current step
+        io_array: numpy ndarray containing data of the current step. The raw data is read into a buffer
+                  that is re-used num_buffers steps later, see read_channels.
         """
 
-        if (isinstance(channels, channel_range)):
-            data_list = []
-            for c in channels:
-                var = self.IO.InquireVariable("ECEI_" + str(c))
-                io_array = np.zeros(np.prod(var.Shape()), dtype=np.float64)
-                self.reader.Get(var, io_array, adios2.Mode.Sync)
-                data_list.append(io_array)
-
-            # Append size of current chunk to chunk sizes
-            self.chunk_sizes.append(data_list[0].size)
-            io_array = np.array(data_list) * 1e-4
-
-        elif isinstance(channels, type(None)):
-            data_list = []
+        if isinstance(channels, type(None)):
             print("Reader::Get*** Default reading channels L0101-L2408. Step no. {0:d}".format(self.CurrentStep()))
-            clist = channel_range(channel("L", 1, 1), channel("L", 24, 8))
-
-            # Inquire the data of each channel from the ADIOS IO
-            for c in clist:
-                var = self.IO.InquireVariable("ECEI_" + str(c))
-                io_array = np.zeros(np.prod(var.Shape()), dtype=np.float64)
-                self.reader.Get(var, io_array, adios2.Mode.Sync)
-                data_list.append(io_array)
-
-            # Append size of current chunk to chunk sizes
-            self.chunk_sizes.append(data_list[0].size)
-            io_array = np.array(data_list) * 1e-4
-            
-        # If the normalization offset hasn't been calculated yet see if we have the
-        # correct data to do so in the current chunk
-        if self.is_data_normalized == False:
-            # Generate the timebase for the current step
-            tb = self.gen_timebase()
-            # Calculate indices where we calculate the normalization offset from
-            tnorm_idx = (tb > self.tnorm[0]) & (tb < self.tnorm[1])
-            print("*** Reader: I found {0:d} indices where to normalize".format(tnorm_idx.sum()), ", tnorm = ", self.tnorm)
-            # Calculate normalization offset if we have enough indices
-            if(tnorm_idx.sum() > 100):
-                self.offset_lvl = np.median(io_array[:, tnorm_idx], axis=1, keepdims=True)
-                self.offset_std = io_array[:, tnorm_idx].std(axis=1)
-                self.is_data_normalized = True
-
-                np.savez("test_data/offset_lvl.npz", offset_lvl = self.offset_lvl)
-
-        if self.is_data_normalized:
-            print("*** Reader:Get: io_array.shape = ", io_array.shape)
-            np.savez("test_data/io_array_s{0:04d}.npz".format(self.CurrentStep()), io_array=io_array)
-            io_array = io_array - self.offset_lvl
-            io_array = io_array / io_array.mean(axis=1, keepdims=True) - 1.0
-            np.savez("test_data/io_array_tr_s{0:04d}.npz".format(self.CurrentStep()), io_array=io_array)
+            channels = channel_range(channel("L", 1, 1), channel("L", 24, 8))
+
+        io_array = self.read_channels(channels)
+        # Append size of current chunk to chunk sizes
+        self.chunk_sizes.append(io_array.shape[1])
 
+        # Collect the offset statistics, and normalize once the offset is known
+        self.normalization.update(io_array, self.gen_timebase())
+        if self.normalization.is_ready:
+            self.normalization.apply(io_array)
+        self.is_data_normalized = self.normalization.is_ready
 
         return io_array
 
 
 class reader_bpfile(reader_base):
-    def __init__(self, shotnr, ecei_cfg):
-        super().__init__(shotnr, ecei_cfg)
+    def __init__(self, shotnr, ecei_cfg, precision="double", num_buffers=2):
+        super().__init__(shotnr, ecei_cfg, precision, num_buffers)
         self.IO.SetEngine("BP4")
         self.reader = None
 
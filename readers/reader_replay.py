@@ -0,0 +1,270 @@
+#-*- Coding: UTF-8 -*-
+
+"""
+Random-access replay of ECEI bp files, for offline reprocessing.
+
+reader_bpfile walks the steps of a bp file forward with BeginStep and EndStep. To reach a
+later time window, all earlier steps are read. reader_replay opens the file for random
+access instead. It builds an index of the steps from the ECEI metadata (TriggerTime and
+SampleRate, see gen_timebase) and reads any range of steps with a step selection.
+
+Every step of a channel has the same number of samples, see create_ecei_bpfile.py. Step s
+then starts at sample s * chunk_size, at time TriggerTime[0] + s * chunk_size / fs.
+
+The steps of a shot can be split across MPI ranks or pool workers. Each of them opens the
+file with its own reader and replays its part of the steps, see replay:
+
+>>> steps = reader.find_steps(2.0, 2.5)
+>>> my_steps = split_steps(steps, comm.Get_size(), comm.Get_rank())
+>>> results = replay(shotnr, ecei_cfg, datapath, my_steps, fn)
+
+or, with a pool of processes, see replay_pool and replay_bpfile.py.
+"""
+
+from os.path import join
+
+import adios2
+import numpy as np
+
+from analysis.channels import channel, channel_range
+from analysis.normalization import ecei_normalization
+from readers.reader_one_to_one import reader_base, get_file_dtype
+
+
+class reader_replay(reader_base):
+    """Reads arbitrary steps and time windows of a bp file."""
+
+    def __init__(self, shotnr, ecei_cfg, precision="double"):
+        super().__init__(shotnr, ecei_cfg, precision)
+        self.IO.SetEngine("BP4")
+        self.reader = None
+
+        # Index of the steps, see build_index
+        self.num_steps = 0
+        self.chunk_size = 0
+        self.fs = ecei_cfg["SampleRate"] * 1e3
+        # Normalization of each list of channels, see get_normalization
+        self.normalizations = {}
+
+
+    def Open(self, datapath):
+        """Opens the bp file for random access and builds the index of its steps."""
+        self.channel_name = join(datapath, "KSTAR.bp")
+        # Newer versions of ADIOS2 have a separate mode for random access
+        mode = getattr(adios2.Mode, "ReadRandomAccess", adios2.Mode.Read)
+        if self.reader is None:
+            self.reader = self.IO.Open(self.channel_name, mode)
+        self.build_index()
+
+
+    def build_index(self):
+        """Reads the number of steps and the number of samples per step from the file."""
+        self.num_steps = self.reader.Steps()
+        var = self.IO.InquireVariable("ECEI_" + str(channel("L", 1, 1)))
+        self.chunk_size = int(np.prod(var.Shape()))
+        print("reader_replay: {0:s} has {1:d} steps of {2:d} samples".format(self.channel_name, self.num_steps, self.chunk_size))
+
+
+    def step_timebase(self, first, count=1):
+        """Returns the time base of count steps, starting at step first."""
+        tt0 = self.ecei_cfg["TriggerTime"][0]
+        # Use integers in arange to avoid round-off errors, as in gen_timebase
+        tb = np.arange(first * self.chunk_size, (first + count) * self.chunk_size, dtype=np.float64)
+        return(tb / self.fs + tt0)
+
+
+    def find_steps(self, t_start, t_end):
+        """Returns the steps that contain samples in the time window [t_start, t_end].
+
+        Input:
+        ======
+        t_start, t_end: float, time window in s
+
+        Returns:
+        ========
+        steps: range of step indices. Empty if the window is outside of the file.
+        """
+        tt0 = self.ecei_cfg["TriggerTime"][0]
+        first = int(np.floor((min(t_start, t_end) - tt0) * self.fs)) // self.chunk_size
+        last = int(np.floor((max(t_start, t_end) - tt0) * self.fs)) // self.chunk_size
+        first = min(max(first, 0), self.num_steps)
+        return(range(first, max(first, min(last + 1, self.num_steps))))
+
+
+    def read_steps(self, first, count=1, channels=None):
+        """Reads count consecutive steps, starting at step first, and scales the data by 1e-4.
+        All channels are read with deferred Gets and a single PerformGets.
+
+        Input:
+        ======
+        first: int, first step
+        count: int, number of steps
+        channels: channel_range, list of channels or None for all channels
+
+        Returns:
+        ========
+        io_array: ndarray, dim0: channel, dim1: sample. A new array that is not re-used by the reader.
+        """
+        if isinstance(channels, type(None)):
+            channels = channel_range(channel("L", 1, 1), channel("L", 24, 8))
+        assert(first >= 0 and first + count <= self.num_steps)
+
+        variables = self.get_variables(channels)
+        file_dtype = get_file_dtype(variables[0])
+        target = np.empty((len(variables), count * self.chunk_size), dtype=file_dtype)
+        for row, var in zip(target, variables):
+            var.SetStepSelection([first, count])
+            self.reader.Get(var, row, adios2.Mode.Deferred)
+        self.reader.PerformGets()
+
+        io_array = target if file_dtype == self.dtype else np.empty(target.shape, dtype=self.dtype)
+        np.multiply(target, 1e-4, out=io_array, casting="unsafe")
+        return(io_array)
+
+
+    def get_normalization(self, channels=None):
+        """Returns the normalization of a list of channels. The steps that contain t_norm are
+        read once per list of channels, see analysis/normalization.py"""
+        if isinstance(channels, type(None)):
+            channels = channel_range(channel("L", 1, 1), channel("L", 24, 8))
+        key = tuple([str(c) for c in channels])
+
+        if key not in self.normalizations:
+            normalization = ecei_normalization(self.tnorm, self.fs)
+            steps = self.find_steps(*self.tnorm)
+            if len(steps) > 0:
+                normalization.update(self.read_steps(steps.start, len(steps), channels),
+                                     self.step_timebase(steps.start, len(steps)))
+            if not normalization.is_ready:
+                normalization.finalize()
+            self.normalizations[key] = normalization
+
+        return(self.normalizations[key])
+
+
+    def read_window(self, t_start, t_end, channels=None, normalize=True):
+        """Reads the data in the time window [t_start, t_end], without reading the steps before it.
+
+        Input:
+        ======
+        t_start, t_end: float, time window in s
+        channels: channel_range, list of channels or None for all channels
+        normalize: bool, if true, normalize the data to the offset in t_norm, as Get does in the stream.
+                   Steps before the end of t_norm are returned raw, see normalize_steps.
+
+        Returns:
+        ========
+        tb: ndarray, float. Time base of the window
+        data: ndarray, dim0: channel, dim1: sample. Normalized as in the stream if normalize is true.
+        """
+        steps = self.find_steps(t_start, t_end)
+        if len(steps) == 0:
+            raise ValueError("Time window [{0:f}, {1:f}] is not in {2:s}".format(t_start, t_end, self.channel_name))
+
+        data = self.read_steps(steps.start, len(steps), channels)
+        if normalize:
+            self.normalize_steps(data, steps.start, channels)
+
+        tb = self.step_timebase(steps.start, len(steps))
+        # Cut the window out of the steps. This returns views into data.
+        idx = np.nonzero((tb >= min(t_start, t_end)) & (tb <= max(t_start, t_end)))[0]
+        return(tb[idx[0]:idx[-1] + 1], data[:, idx[0]:idx[-1] + 1])
+
+
+    def first_normalized_step(self):
+        """Returns the first step that Get normalizes in the stream: the step in which t_norm ends.
+        The steps before it are returned raw, since the offset is not known yet."""
+        return(max(self.find_steps(*self.tnorm).stop - 1, 0))
+
+
+    def normalize_steps(self, data, first, channels=None):
+        """Normalizes data of consecutive steps in place, one step at a time, as Get does in the
+        stream: Each step is normalized by its own mean and the steps before first_normalized_step
+        are left raw. Leaves all data raw if the offset could not be calculated.
+
+        Input:
+        ======
+        data: ndarray, dim0: channel, dim1: sample. Data of consecutive steps, see read_steps
+        first: int, step of the first sample in data
+        channels: list of channels in data, or None for all channels
+        """
+        normalization = self.get_normalization(channels)
+        if normalization.is_ready:
+            first_norm = self.first_normalized_step()
+            for step, start in enumerate(range(0, data.shape[1], self.chunk_size), start=first):
+                if step >= first_norm:
+                    normalization.apply(data[:, start:start + self.chunk_size])
+        return(data)
+
+
+def split_steps(steps, num_parts, part):
+    """Splits steps into num_parts contiguous parts of about equal length and returns one of them.
+
+    Input:
+    ======
+    steps: range of step indices, f.ex. range(reader.num_steps) or reader.find_steps(t_start, t_end)
+    num_parts: int, number of parts, f.ex. the number of MPI ranks
+    part: int, index of the part, f.ex. the MPI rank
+
+    Returns:
+    ========
+    my_steps: range of step indices
+    """
+    bounds = np.linspace(0, len(steps), num_parts + 1).round().astype(int)
+    return(steps[bounds[part]:bounds[part + 1]])
+
+
+def replay(shotnr, ecei_cfg, datapath, steps, fn, channels=None, precision="double", normalize=True, steps_per_read=1):
+    """Replays steps of a bp file and calls fn on each of them. Runs on a single rank or pool worker,
+    with its own reader.
+
+    Input:
+    ======
+    shotnr, ecei_cfg, datapath, precision: see reader_replay
+    steps: range of step indices
+    fn: callable, fn(step, tb, data) processes a step. Has to be picklable to run in a pool.
+    channels: list of channels or None for all channels
+    normalize: bool, normalize the data to the offset in t_norm. As in the stream, the steps before the end
+               of t_norm are passed raw.
+    steps_per_read: int, number of steps that are read at once
+
+    Returns:
+    ========
+    results: list of the return values of fn, in step order
+    """
+    reader = reader_replay(shotnr, ecei_cfg, precision)
+    reader.Open(datapath)
+
+    results = []
+    for first in range(steps.start, steps.stop, steps_per_read):
+        count = min(steps_per_read, steps.stop - first)
+        data = reader.read_steps(first, count, channels)
+        if normalize:
+            reader.normalize_steps(data, first, channels)
+        for i in range(count):
+            step_slice = slice(i * reader.chunk_size, (i + 1) * reader.chunk_size)
+            results.append(fn(first + i, reader.step_timebase(first + i), data[:, step_slice]))
+
+    reader.reader.Close()
+    return(results)
+
+
+def replay_pool(executor, num_workers, shotnr, ecei_cfg, datapath, steps, fn, **kwargs):
+    """Splits steps across the workers of a pool and replays them in parallel.
+
+    Input:
+    ======
+    executor: concurrent.futures executor, f.ex. a ProcessPoolExecutor or an MPIPoolExecutor
+    num_workers: int, number of parts that steps are split into
+    shotnr, ecei_cfg, datapath, steps, fn, kwargs: see replay
+
+    Returns:
+    ========
+    results: list of the return values of fn, in step order
+    """
+    futures = [executor.submit(replay, shotnr, ecei_cfg, datapath, split_steps(steps, num_workers, part), fn, **kwargs)
+               for part in range(num_workers)]
+    return([res for f in futures for res in f.result()])
+
+
+# End of file reader_replay.py
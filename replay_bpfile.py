@@ -0,0 +1,85 @@
+#-*- coding: UTF-8 -*-
+
+"""
+Reprocesses a time window of a shot from its bp file in parallel, see readers/reader_replay.py.
+
+The steps in the time window are split across the MPI ranks, or across a pool of processes
+with --nompi. Each rank reads only its own steps and calculates the power spectrum of each
+channel at each step. The spectra are stored in test_data/replay_<shotnr>.npz.
+
+mpirun -n 8 python -u replay_bpfile.py --config config_one_to_one_fluctana.json --t_start 2.0 --t_end 3.0
+python -u replay_bpfile.py --config config_one_to_one_fluctana.json --nompi --num_workers 8
+"""
+
+import json
+import argparse
+import timeit
+from functools import partial
+
+import numpy as np
+
+from analysis.spectral import power_spectrum
+from readers.reader_replay import reader_replay, split_steps, replay, replay_pool
+
+
+parser = argparse.ArgumentParser(description="Reprocess a time window of a bp file in parallel")
+parser.add_argument('--config', type=str, help='Lists the configuration file', default='config_one_to_one_fluctana.json')
+parser.add_argument('--t_start', type=float, help='Start of the time window, in s. Defaults to the start of the file', default=None)
+parser.add_argument('--t_end', type=float, help='End of the time window, in s. Defaults to the end of the file', default=None)
+parser.add_argument('--nompi', help='Use a pool of processes instead of MPI', action='store_true')
+parser.add_argument('--num_workers', type=int, help='Number of processes of the pool, with --nompi', default=4)
+parser.add_argument('--nperseg', type=int, help='Segment length of the power spectrum', default=512)
+
+
+def spectrum_of_step(step, tb, data, nperseg=512):
+    """Calculates the power spectrum of each channel at a step. Runs on the ranks or pool workers."""
+    f, Pxx = power_spectrum(data, fs=1. / (tb[1] - tb[0]), nperseg=nperseg, axis=-1)
+    return(step, f, Pxx)
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with open(args.config, "r") as df:
+        cfg = json.load(df)
+        df.close()
+
+    if args.nompi:
+        comm = None
+        rank = 0
+        size = 1
+    else:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        rank = comm.Get_rank()
+        size = comm.Get_size()
+
+    # Find the steps of the time window from the index of the file
+    reader = reader_replay(cfg["shotnr"], cfg["ECEI_cfg"], precision=cfg.get("precision", "double"))
+    reader.Open(cfg["datapath"])
+    t_start = reader.step_timebase(0)[0] if args.t_start is None else args.t_start
+    t_end = reader.step_timebase(reader.num_steps - 1)[-1] if args.t_end is None else args.t_end
+    steps = reader.find_steps(t_start, t_end)
+    if rank == 0:
+        print("Replaying steps {0:d} - {1:d} of {2:d} ({3:f}s - {4:f}s)".format(steps.start, steps.stop, reader.num_steps, t_start, t_end))
+
+    t0 = timeit.default_timer()
+    kwargs = {"precision": cfg.get("precision", "double"), "steps_per_read": cfg.get("steps_per_read", 1)}
+    if args.nompi:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            results = replay_pool(executor, args.num_workers, cfg["shotnr"], cfg["ECEI_cfg"], cfg["datapath"], steps,
+                                  partial(spectrum_of_step, nperseg=args.nperseg), **kwargs)
+    else:
+        my_results = replay(cfg["shotnr"], cfg["ECEI_cfg"], cfg["datapath"], split_steps(steps, size, rank),
+                            partial(spectrum_of_step, nperseg=args.nperseg), **kwargs)
+        results = comm.gather(my_results, root=0)
+        results = [res for rank_results in results for res in rank_results] if rank == 0 else None
+    t1 = timeit.default_timer()
+
+    if rank == 0 and len(results) > 0:
+        print("Replayed {0:d} steps in {1:f}s".format(len(results), t1 - t0))
+        np.savez("test_data/replay_{0:05d}.npz".format(cfg["shotnr"]), steps=np.array([res[0] for res in results]),
+                 f=results[0][1], Pxx=np.array([res[2] for res in results]))
+
+
+# End of file replay_bpfile.py
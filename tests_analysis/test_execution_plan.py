@@ -0,0 +1,101 @@
+# Encoding: UTF-8 -*-
+
+"""Equivalence of the fused execution plan with the single analysis tasks.
+
+Cross-phase, cross-power and coherence on the same channel pairs are fused by
+execution_plan into one group, that calculates the spectra once (cross_spectra.csd_sums)
+and derives the result of each task from them. Their results are compared to those of
+task.calculate, with and without tiling of the channel pairs. A task on other channels
+and the cross-spectrogram are not fused and run as single tasks.
+
+The tasks run on a local thread_executor, so no dask scheduler is needed.
+
+Run from the repository root:
+python tests_analysis/test_execution_plan.py
+"""
+
+import sys
+sys.path.append(".")
+
+import copy
+
+import numpy as np
+
+from analysis.task_fft import task_fft_kstar, stack_fft_blocks
+from analysis.task_spectral import task_cross_phase, task_cross_power, task_coherence, task_xspec
+from analysis.execution_plan import execution_plan
+from executors.local_executor import thread_executor
+
+
+fs = 5e5
+num_ch = 192
+num_samples = 10_000
+
+rng = np.random.default_rng(3)
+tb = np.arange(num_samples) / fs
+data = np.sin(2.0 * np.pi * 2e4 * tb[np.newaxis, :] + np.linspace(0.0, np.pi, num_ch)[:, np.newaxis]) + \
+    0.5 * rng.normal(size=(num_ch, num_samples))
+
+executor = thread_executor(max_workers=4)
+data_future = executor.scatter(data, broadcast=True)
+
+fft_params = {"nfft": 1000, "window": "hann", "overlap": 0.5, "detrend": 1, "fsample": fs, "full": 1}
+my_fft = task_fft_kstar(num_samples, fft_params)
+fft_future = executor.submit(stack_fft_blocks, my_fft.do_fft(executor, data_future, num_ch))
+params = my_fft.get_fft_params()
+
+
+def make_tasks(tile_size):
+    """Three fusable tasks on the same pairs, one on other pairs and a cross-spectrogram."""
+    kwargs = {"ref_channels": ["L0101-0104"], "x_channels": ["L0201-0204"], "tile_size": tile_size}
+    other = dict(kwargs, x_channels=["L0301-0302"])
+    return([task_cross_phase({"description": "cross_phase", "analysis": "cross_phase", "kwargs": kwargs}, params),
+            task_cross_power({"description": "cross_power", "analysis": "cross_power", "kwargs": kwargs}, params),
+            task_coherence({"description": "coherence", "analysis": "coherence", "kwargs": kwargs}, params),
+            task_coherence({"description": "coherence other", "analysis": "coherence", "kwargs": other}, params),
+            task_xspec({"description": "xspec", "analysis": "xspec", "kwargs": kwargs}, params)])
+
+
+for tile_size in [None, 0, 7]:
+    # Reference: every task calculates its result on its own
+    single_tasks = make_tasks(tile_size)
+    for task in single_tasks:
+        task.calculate(executor, fft_future)
+    ref = {task.description: task.get_results() for task in single_tasks}
+
+    fused_tasks = make_tasks(tile_size)
+    plan = execution_plan(fused_tasks)
+    print(plan.describe())
+    assert(len(plan.groups) == 1)
+    assert(sorted([t.description for t in plan.single_tasks]) == ["coherence other", "xspec"])
+
+    plan.calculate(executor, fft_future)
+    for task in fused_tasks:
+        res = task.get_results()
+        assert(res.shape == ref[task.description].shape)
+        assert(np.allclose(res, ref[task.description]))
+        assert(task.storage_scheme == single_tasks[fused_tasks.index(task)].storage_scheme)
+
+    # Skipped tasks are not dispatched and keep their futures
+    futures = {task.description: copy.copy(task.futures_list) for task in fused_tasks}
+    plan.calculate(executor, fft_future, skip=["cross_power", "xspec"])
+    for task in fused_tasks:
+        assert((task.futures_list == futures[task.description]) == (task.description in ["cross_power", "xspec"]))
+        assert(np.allclose(task.get_results(), ref[task.description]))
+
+    print("tile_size={0}: fused results match single tasks: ok".format(tile_size))
+
+# A tile size of 0 computes all pairs in one tile, as in tune_dask_one_to_one_fluctana.py. Others are rejected.
+assert(len(make_tasks(0)[0].get_dispatch_tiles()) == 1)
+for tile_size in [-1, 2.5, "8"]:
+    try:
+        make_tasks(tile_size)
+        raise AssertionError("tile_size={0} accepted".format(tile_size))
+    except ValueError:
+        pass
+print("tile_size validation: ok")
+
+executor.close()
+
+
+# End of file test_execution_plan.py
@@ -0,0 +1,102 @@
+# Encoding: UTF-8 -*-
+
+"""The local thread and process executors, see executors/local_executor.py.
+
+Both executors are created with get_executor, as the processor does, and checked for the
+parts of the distributed.Client interface that the tasks use:
+* futures in the arguments of submit, also inside lists and dicts, are replaced by their results
+* a function starts only after the futures in its arguments are finished
+* errors propagate to the dependent futures
+* scattered arrays and large array results, which the process executor keeps in shared memory
+* closures, which the process executor serializes with cloudpickle
+
+Finally the FFT and the cross-power of a task run on each executor and are compared.
+
+Run from the repository root:
+python tests_analysis/test_executors.py
+"""
+
+import sys
+sys.path.append(".")
+
+import time
+
+import numpy as np
+
+from analysis.task_fft import task_fft_kstar, stack_fft_blocks
+from analysis.task_spectral import task_cross_power
+from executors.factory import get_executor
+
+
+def slow_add(a, b, delay=0.0):
+    time.sleep(delay)
+    return(a + b)
+
+
+def total(values, scale):
+    return(sum(values) * scale["factor"])
+
+
+def fail(x):
+    raise ZeroDivisionError("failed on {0}".format(x))
+
+
+fs = 5e5
+num_ch = 24
+num_samples = 10_000
+
+rng = np.random.default_rng(4)
+data = rng.normal(size=(num_ch, num_samples))
+fft_params = {"nfft": 1000, "window": "hann", "overlap": 0.5, "detrend": 1, "fsample": fs, "full": 1, "block_size": 8}
+task_config = {"description": "cross_power", "analysis": "cross_power",
+               "kwargs": {"ref_channels": ["L0101-0104"], "x_channels": ["L0201-0204"], "tile_size": 10}}
+
+results = {}
+for executor_type in ["thread", "process"]:
+    executor = get_executor({"type": executor_type, "max_workers": 2})
+
+    # Nested futures are resolved, and dependent functions wait for their arguments
+    f_a = executor.submit(slow_add, 1, 2, delay=0.2)
+    f_b = executor.submit(slow_add, f_a, 10)
+    f_c = executor.submit(total, [f_a, f_b, 4], {"factor": executor.submit(slow_add, 1, 1)})
+    assert(not f_b.done())
+    assert(f_c.result() == (3 + 13 + 4) * 2)
+    assert(executor.gather([f_a, f_b]) == [3, 13])
+
+    # Errors propagate to the dependent futures
+    f_err = executor.submit(slow_add, executor.submit(fail, 1), 1)
+    try:
+        f_err.result()
+        raise AssertionError("{0:s}: the error did not propagate".format(executor_type))
+    except ZeroDivisionError:
+        pass
+
+    # Closures, scattered arrays and large array results
+    offset = 3.0
+    data_future = executor.scatter(data, broadcast=True)
+    f_shift = executor.submit(lambda x: x + offset, data_future)
+    assert(np.array_equal(f_shift.result(), data + offset))
+    assert(np.array_equal(executor.submit(np.sum, data_future, axis=1).result(), data.sum(axis=1)))
+
+    # FFT and an analysis task
+    my_fft = task_fft_kstar(num_samples, fft_params)
+    fft_future = executor.submit(stack_fft_blocks, my_fft.do_fft(executor, data_future, num_ch))
+    task = task_cross_power(task_config, my_fft.get_fft_params())
+    task.calculate(executor, fft_future)
+    results[executor_type] = (fft_future.result(), task.get_results())
+
+    executor.close()
+    print("{0:s} executor: ok".format(executor_type))
+
+assert(np.allclose(results["thread"][0], results["process"][0]))
+assert(np.allclose(results["thread"][1], results["process"][1]))
+print("thread and process executors agree: ok")
+
+try:
+    get_executor({"type": "mpi"})
+    raise AssertionError("unknown executor type accepted")
+except ValueError:
+    pass
+
+
+# End of file test_executors.py
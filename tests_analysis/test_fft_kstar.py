@@ -0,0 +1,143 @@
+# Encoding: UTF-8 -*-
+
+"""Equivalence of task_fft_kstar with the fluctana fftbins conventions.
+
+The fourier coefficients from task_fft_kstar.do_fft are compared to
+* specs.fftbins, applied channel by channel
+* a transcription of the original per-bin loop of fluctana's fftbins
+for even and odd nfft, full and half spectra, with and without linear detrending.
+The task runs on a local thread_executor, so no dask scheduler is needed.
+
+Finally the cross-power of the task_spectral kernels on this data is compared to the
+bin average of X Y* / win_factor, and the cross-correlation to fluctana's per-bin
+ifftshift - ifft.
+
+Run from the repository root:
+python tests_analysis/test_fft_kstar.py
+"""
+
+import sys
+sys.path.append(".")
+
+import numpy as np
+from scipy import signal
+
+from analysis import specs
+from analysis import cross_spectra as cs
+from analysis.task_fft import task_fft_kstar, stack_fft_blocks
+from analysis.task_spectral import task_xspec, task_bicoherence, task_cross_correlation
+from executors.local_executor import thread_executor
+
+
+def fftbins_loop(x, dt, nfft, window, overlap, detrend, full):
+    """The per-bin loop of fluctana's fftbins, for a single channel."""
+    tnum = len(x)
+    bins, win = specs.fft_window(tnum, nfft, window, overlap)
+
+    fftdata = []
+    for b in range(bins):
+        idx1 = int(b*np.fix(nfft*(1 - overlap)))
+        idx2 = idx1 + nfft
+
+        sx = x[idx1:idx2]
+
+        if detrend == 1:
+            sx = signal.detrend(sx, type='linear')
+        sx = signal.detrend(sx, type='constant')  # subtract mean
+
+        sx = sx * win  # apply window function
+
+        # get fft
+        SX = np.fft.fft(sx, n=nfft)/nfft  # divide by the length
+        if np.mod(nfft, 2) == 0:  # even nfft
+            SX = np.hstack([SX[0:int(nfft/2)], np.conj(SX[int(nfft/2)]), SX[int(nfft/2):nfft]])
+        if full == 1: # shift to -fN ~ 0 ~ fN
+            SX = np.fft.fftshift(SX)
+        else: # half 0 ~ fN
+            SX = SX[0:int(nfft/2+1)]
+
+        fftdata.append(SX)
+
+    return(np.array(fftdata))
+
+
+fs = 5e5
+num_ch = 40
+num_samples = 10_000
+
+rng = np.random.default_rng(2)
+tb = np.arange(num_samples) / fs
+data = np.sin(2.0 * np.pi * 2e4 * tb[np.newaxis, :] + np.linspace(0.0, np.pi, num_ch)[:, np.newaxis]) + \
+    0.1 * rng.normal(size=(num_ch, num_samples)) + 1e3 * tb[np.newaxis, :]
+
+executor = thread_executor(max_workers=4)
+data_future = executor.scatter(data, broadcast=True)
+
+for nfft in [1000, 999]:
+    for full in [1, 0]:
+        for detrend in [1, 0]:
+            fft_params = {"nfft": nfft, "window": "hann", "overlap": 0.5, "detrend": detrend,
+                          "fsample": fs, "full": full, "block_size": 16}
+            my_fft = task_fft_kstar(num_samples, fft_params)
+            fft_data = executor.submit(stack_fft_blocks, my_fft.do_fft(executor, data_future, num_ch)).result()
+
+            # Layout of the task_spectral kernels: channel, Fourier Coefficients, bins
+            assert(fft_data.shape == (num_ch, my_fft.fft_freqs.size, my_fft.fft_bins))
+
+            err_specs = 0.0
+            err_loop = 0.0
+            for c in range(num_ch):
+                ax, ref, win_factor = specs.fftbins(data[c], 1. / fs, nfft, "hann", 0.5, detrend, full)
+                err_specs = max(err_specs, np.abs(fft_data[c].T - ref).max())
+                err_loop = max(err_loop, np.abs(fft_data[c].T - fftbins_loop(data[c], 1. / fs, nfft, "hann", 0.5, detrend, full)).max())
+            assert(np.allclose(ax, my_fft.fft_freqs))
+            assert(np.isclose(win_factor, my_fft.get_fft_params()["win_factor"]))
+
+            print("nfft={0:4d}, full={1:d}, detrend={2:d}: max. deviation from specs.fftbins = {3:8.2e}, from the per-bin loop = {4:8.2e}".format(
+                  nfft, full, detrend, err_specs, err_loop))
+            assert(err_specs < 1e-12)
+            assert(err_loop < 1e-12)
+
+# The kernels of task_spectral work on the output directly
+fft_params = {"nfft": 1000, "window": "hann", "overlap": 0.5, "detrend": 1, "fsample": fs, "full": 1}
+my_fft = task_fft_kstar(num_samples, fft_params)
+fft_data = executor.submit(stack_fft_blocks, my_fft.do_fft(executor, data_future, num_ch)).result()
+params = my_fft.get_fft_params()
+ch0, ch1 = np.triu_indices(8)
+
+Sxy = cs.csd_pairs(fft_data, ch0, ch1)
+ref = np.array([np.abs((fft_data[a] * fft_data[b].conj()).mean(axis=1)) / params["win_factor"] for a, b in zip(ch0, ch1)])
+assert(np.allclose(cs.cross_power(Sxy, params["win_factor"]), ref))
+
+ref = []
+for a, b in zip(ch0, ch1):
+    val = np.fft.ifftshift(fft_data[a] * fft_data[b].conj() / params["win_factor"], axes=0)
+    val = np.fft.ifft(val, n=params["nfft"], axis=0) * params["nfft"]
+    ref.append(np.fft.fftshift(val.mean(axis=1).real))
+assert(np.allclose(cs.cross_correlation(Sxy, params), np.array(ref)))
+print("task_spectral kernels: ok")
+
+# The layout of the Fourier Coefficients selects the frequency axis of xspec. Analyses that need
+# the negative frequencies reject a one-sided spectrum.
+task_config = {"description": "layout", "kwargs": {"ref_channels": ["L0101-0102"], "x_channels": ["L0103-0104"],
+                                                     "freq_range": [0.0, fs / 4]}}
+assert(params["layout"] == "shifted")
+my_xspec = task_xspec(dict(task_config, analysis="xspec"), params)
+assert(my_xspec.freq_idx.max() < fft_data.shape[1])
+assert(np.allclose(my_xspec.freqs, my_fft.fft_freqs[my_xspec.freq_idx]))
+assert(np.allclose(my_xspec.storage_scheme["freqs"], my_xspec.freqs))
+
+params_half = task_fft_kstar(num_samples, dict(fft_params, full=0)).get_fft_params()
+assert(params_half["layout"] == "onesided")
+for task_class, name in [(task_xspec, "xspec"), (task_bicoherence, "bicoherence"), (task_cross_correlation, "cross_correlation")]:
+    try:
+        task_class(dict(task_config, analysis=name), params_half)
+        raise AssertionError("{0:s} accepts a one-sided spectrum".format(name))
+    except ValueError:
+        pass
+print("one-sided spectrum: ok")
+
+executor.close()
+
+
+# End of file test_fft_kstar.py
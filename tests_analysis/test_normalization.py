@@ -0,0 +1,114 @@
+# Encoding: UTF-8 -*-
+
+"""Streaming normalization of the ECEI data, see analysis/normalization.py.
+
+A synthetic stream of ECEI-like data (8 channels, chunks of 1_000 samples, around a finite
+offset) is passed through ecei_normalization chunk by chunk and compared to the
+normalization of kstarecei.py, calculated from the whole interval t_norm at once.
+
+Covered are
+* t_norm spanning several chunks: raw data until t_norm is passed, normalized data after that
+* the bounds of t_norm given in reversed order
+* the 'failed' state, when t_norm contains less than min_samples samples
+* the stride subsampling of long intervals, limited by max_samples
+
+Run from the repository root:
+python tests_analysis/test_normalization.py
+"""
+
+import sys
+sys.path.append(".")
+
+import numpy as np
+
+from analysis.normalization import ecei_normalization
+
+
+fs = 5e5
+num_ch = 8
+chunk_size = 1_000
+num_chunks = 10
+
+rng = np.random.default_rng(1)
+offset = rng.uniform(0.5, 1.5, size=(num_ch, 1))
+tb_all = np.arange(num_chunks * chunk_size) / fs
+data_all = offset + 0.1 * rng.normal(size=(num_ch, tb_all.size))
+# Lift the data after t_norm, so that mean(data - offset) is well away from zero
+data_all[:, 4 * chunk_size:] += 1.0
+
+
+def stream(norm):
+    """Passes the data through norm, chunk by chunk, as reader_one_to_one.Get does.
+    Returns the list of chunks and whether each one was normalized."""
+    chunks = []
+    for c in range(num_chunks):
+        data = data_all[:, c * chunk_size:(c + 1) * chunk_size].copy()
+        norm.update(data, tb_all[c * chunk_size:(c + 1) * chunk_size])
+        if norm.is_ready:
+            norm.apply(data)
+        chunks.append((data, norm.is_ready))
+    return(chunks)
+
+
+def reference(data, t_lo, t_hi):
+    """Normalization as in kstarecei.py, from all samples in [t_lo, t_hi]."""
+    idx = np.nonzero((tb_all >= t_lo) & (tb_all <= t_hi))[0]
+    offset_lvl = np.median(data_all[:, idx], axis=1, keepdims=True)
+    return(offset_lvl, (data - offset_lvl) / (data - offset_lvl).mean(axis=1, keepdims=True) - 1.0)
+
+
+# 1) t_norm spans chunks 1 to 3. Chunks 0 to 2 are returned raw, chunk 3 and later are normalized.
+t_norm = [tb_all[1500], tb_all[3200]]
+norm = ecei_normalization(t_norm, fs)
+chunks = stream(norm)
+assert([is_norm for _, is_norm in chunks] == [False] * 3 + [True] * 7)
+assert(norm.num_seen == 3200 - 1500 + 1)
+assert(norm.stride == 1)
+for c, (data, is_norm) in enumerate(chunks):
+    raw = data_all[:, c * chunk_size:(c + 1) * chunk_size]
+    if not is_norm:
+        assert(np.array_equal(data, raw))
+        continue
+    offset_lvl, ref = reference(raw, *t_norm)
+    assert(np.allclose(norm.offset_lvl, offset_lvl))
+    assert(np.allclose(data, ref))
+print("t_norm spanning chunks: ok")
+
+# 2) Reversed bounds give the same result
+norm_rev = ecei_normalization(t_norm[::-1], fs)
+chunks_rev = stream(norm_rev)
+assert(norm_rev.get_state() == norm.get_state())
+assert(all([np.array_equal(d0, d1) for (d0, _), (d1, _) in zip(chunks, chunks_rev)]))
+print("reversed bounds: ok")
+
+# 3) Less than min_samples in t_norm. The data stays raw.
+t_short = [tb_all[2000], tb_all[2010]]
+norm = ecei_normalization(t_short, fs, min_samples=100)
+chunks = stream(norm)
+assert(norm.get_state()["state"] == "failed")
+assert(norm.num_seen == 11)
+assert(not any([is_norm for _, is_norm in chunks]))
+assert(all([np.array_equal(data, data_all[:, c * chunk_size:(c + 1) * chunk_size]) for c, (data, _) in enumerate(chunks)]))
+print("failed state: ok")
+
+# 4) Stride subsampling. At most max_samples samples per channel are kept, counted from the
+#    start of t_norm across chunk boundaries. max_samples may be less than min_samples.
+t_long = [tb_all[500], tb_all[3499]]
+for max_samples in [1000, 64]:
+    norm = ecei_normalization(t_long, fs, min_samples=100, max_samples=max_samples)
+    # 3000 samples in t_norm
+    expected_stride = int(np.ceil(3000 / max_samples))
+    assert(norm.stride == expected_stride)
+    stream(norm)
+    state = norm.get_state()
+    assert(state["state"] == "ready")
+    assert(state["num_seen"] == 3000)
+    assert(state["num_samples"] == len(range(500, 3500, expected_stride)))
+    assert(state["num_samples"] <= max_samples)
+    idx = np.arange(500, 3500, expected_stride)
+    assert(np.allclose(norm.offset_lvl, np.median(data_all[:, idx], axis=1, keepdims=True)))
+    print("stride {0:d}: {1:d} of {2:d} samples kept".format(state["stride"], state["num_samples"], state["num_seen"]))
+print("stride subsampling: ok")
+
+
+# End of file test_normalization.py
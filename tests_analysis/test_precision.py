@@ -0,0 +1,90 @@
+# Encoding: UTF-8 -*-
+
+"""Accuracy of the single precision analysis path compared to double precision.
+
+A synthetic chunk of ECEI-like data (192 channels x 10_000 samples, a coherent mode on
+top of noise, normalized as in reader_one_to_one) is transformed once as float64 and
+once as float32, using both the fluctana STFT (specs.fftbins_batch) and scipy's stft as
+in task_fft_scipy. Cross-power, cross-phase and coherence are then calculated from the
+cross-spectral tensor and compared.
+
+Run from the repository root:
+python tests_analysis/test_precision.py
+
+Typical results: the relative error of the fourier coefficients and the cross-power is
+O(1e-7), that of the coherence O(1e-6), the cross-phase error is O(1e-7) rad. This is far
+below the statistical uncertainty of estimates averaged over 19 STFT bins, O(1/sqrt(19)).
+"""
+
+import sys
+sys.path.append(".")
+
+import numpy as np
+from scipy.signal import stft
+
+from analysis import specs
+from analysis import cross_spectra as cs
+from analysis.precision import get_dtypes
+from analysis.fft_setup import get_fft_setup
+
+
+fs = 5e5
+nfft = 1000
+num_ch = 192
+num_samples = 10_000
+
+# Generate a mode that propagates across the channels on top of noise, around a finite offset
+rng = np.random.default_rng(1)
+tb = np.arange(num_samples) / fs
+phase = np.linspace(0.0, 2.0 * np.pi, num_ch)[:, np.newaxis]
+data = 1.0 + 0.05 * np.sin(2.0 * np.pi * 2e4 * tb[np.newaxis, :] + phase) + 0.02 * rng.normal(size=(num_ch, num_samples))
+data = data / data.mean(axis=1, keepdims=True) - 1.0
+
+ch0, ch1 = np.triu_indices(16)
+
+
+def analyze(data, precision):
+    """Calculates fourier coefficients and spectral diagnostics in a given precision."""
+    dtype, cdtype = get_dtypes(precision)
+    data = data.astype(dtype)
+
+    # fluctana convention. Bring into the layout channel, Fourier Coefficients, STFT
+    _, fft_fa, win_factor = specs.fftbins_batch(data, 1. / fs, nfft, "hann", 0.5, 1, 1)
+    fft_fa = fft_fa.transpose(0, 2, 1)
+    # scipy convention, as in task_fft_scipy
+    fft_sc = stft(data, fs=fs, nperseg=nfft, window=get_fft_setup(nfft, "hann", 0.5, periodic=True).win, detrend="linear", noverlap=nfft // 2,
+                  padded=False, return_onesided=False, boundary=None)[2]
+
+    assert(fft_fa.dtype == cdtype)
+    assert(fft_sc.dtype == cdtype)
+
+    res = {}
+    for name, fft_data in [("fluctana", fft_fa), ("scipy", fft_sc)]:
+        Sxy = cs.csd_pairs(fft_data, ch0, ch1)
+        res[name] = {"fft": fft_data,
+                     "cross_power": cs.cross_power(Sxy, win_factor),
+                     "cross_phase": cs.cross_phase(Sxy),
+                     "coherence": cs.coherence(cs.csd_pairs(fft_data, ch0, ch1, normalize=True))}
+    return(res)
+
+
+res_d = analyze(data, "double")
+res_s = analyze(data, "single")
+
+for method in ["fluctana", "scipy"]:
+    print("*** {0:s} STFT".format(method))
+    for key in ["fft", "cross_power", "coherence"]:
+        ref = res_d[method][key]
+        err = np.abs(res_s[method][key] - ref).max() / np.abs(ref).max()
+        print("    {0:12s}: max. relative error = {1:8.2e}".format(key, err))
+        assert(err < 1e-4)
+
+    # Only compare the phase where the cross-power is significant. Elsewhere it is dominated by round-off.
+    mask = res_d[method]["cross_power"] > 1e-3 * res_d[method]["cross_power"].max()
+    dphi = np.angle(np.exp(1j * (res_s[method]["cross_phase"] - res_d[method]["cross_phase"])))
+    err = np.abs(dphi[mask]).max()
+    print("    {0:12s}: max. absolute error = {1:8.2e} rad".format("cross_phase", err))
+    assert(err < 1e-3)
+
+
+# End of file test_precision.py
@@ -0,0 +1,181 @@
+# Encoding: UTF-8 -*-
+
+"""Order in which result_sink stores the results, see analysis/result_sink.py.
+
+The results of the analysis tasks are calculated once on a local thread_executor. They are
+then passed to the sink in futures that are completed by hand, in a chosen order. This
+checks that
+* the results of a step are written in completion order: later steps that finish first are written first
+* the accumulated estimates are written in step order and equal a sequential accumulation
+* a step whose accumulating task did not dispatch its sums, and a step without tasks, still finish
+* a failed tile is not written, and its step still finishes
+* add_step does not block on a slow writer, also when the futures are already finished and
+  the callbacks run in the caller. The back-pressure is applied by step_pipeline.wait_for_slot.
+
+Run from the repository root:
+python tests_analysis/test_result_sink.py
+"""
+
+import sys
+sys.path.append(".")
+
+import threading
+import time
+import timeit
+
+import numpy as np
+
+from analysis import cross_spectra as cs
+from analysis.task_fft import task_fft_kstar, stack_fft_blocks
+from analysis.task_spectral import task_cross_power, task_coherence
+from analysis.pipeline import pipeline_step, step_pipeline
+from analysis.result_sink import result_sink
+from executors.local_executor import thread_executor, local_future
+
+
+def held(results):
+    """Returns futures for results that are completed by release."""
+    futures = [local_future() for _ in results]
+    return(futures, lambda: [f._set_result(res) for f, res in zip(futures, results)])
+
+
+def close_sink(sink, timeout=5.0):
+    """Closes the sink. Fails instead of hanging if a step never finishes."""
+    closer = threading.Thread(target=sink.close, daemon=True)
+    closer.start()
+    closer.join(timeout)
+    assert(not closer.is_alive())
+
+
+fs = 5e5
+num_ch = 16
+num_samples = 10_000
+num_steps = 3
+
+fft_params = {"nfft": 1000, "window": "hann", "overlap": 0.5, "detrend": 1, "fsample": fs, "full": 1}
+my_fft = task_fft_kstar(num_samples, fft_params)
+kwargs = {"ref_channels": ["L0101-0104"], "x_channels": ["L0201-0202"], "tile_size": 5}
+
+
+def make_tasks():
+    params = my_fft.get_fft_params()
+    return([task_coherence({"description": "coherence", "analysis": "coherence",
+                            "kwargs": dict(kwargs, accumulate={"mode": "cumulative"})}, params),
+            task_cross_power({"description": "cross_power", "analysis": "cross_power", "kwargs": kwargs}, params)])
+
+
+# Calculate the results of each step: tiles and accumulator sums of each task
+rng = np.random.default_rng(6)
+executor = thread_executor(max_workers=4)
+task_list = make_tasks()
+fft_data = []
+step_results = []
+for s in range(num_steps):
+    data_future = executor.scatter(rng.normal(size=(num_ch, num_samples)), broadcast=True)
+    fft_future = executor.submit(stack_fft_blocks, my_fft.do_fft(executor, data_future, num_ch))
+    fft_data.append(fft_future.result())
+    for task in task_list:
+        task.calculate(executor, fft_future)
+    step_results.append([([f.result() for f in task.futures_list],
+                          [f.result() for f in getattr(task, "accumulator_futures", [])] if task.accumulator is not None else [])
+                         for task in task_list])
+executor.close()
+
+
+# 1) Steps complete in reverse order
+task_list = make_tasks()
+written = []
+sink = result_sink(lambda task, step, name, res: written.append((task.description, step, name, res)), max_queue=2)
+releases = []
+for s in range(num_steps):
+    step = pipeline_step(s)
+    step.task_futures = []
+    for task, (tiles, sums) in zip(task_list, step_results[s]):
+        tile_futures, release_tiles = held(tiles)
+        sums_futures, release_sums = held(sums)
+        step.task_futures.append((task, tile_futures, sums_futures))
+        releases.append((s, release_tiles))
+        releases.append((s, release_sums))
+    sink.add_step(step)
+
+for s in reversed(range(num_steps)):
+    for _, release in [r for r in releases if r[0] == s]:
+        release()
+close_sink(sink)
+
+order = [(desc, step, name) for desc, step, name, _ in written]
+assert(len(order) == num_steps * 3)
+# Results of the step are written in completion order
+res_steps = [step for desc, step, name in order if desc == "cross_power"]
+assert(res_steps == list(reversed(range(num_steps))))
+# Accumulated estimates in step order, once step 0 is in
+acc_steps = [step for desc, step, name in order if name == "res_acc"]
+assert(acc_steps == list(range(num_steps)))
+# The results match the direct calculation
+acc = cs.csd_accumulator(mode="cumulative")
+ch0, ch1 = task_list[0].get_pair_indices()
+results = {(desc, step, name): res for desc, step, name, res in written}
+for s in range(num_steps):
+    assert(np.allclose(results[("coherence", s, "res")], cs.coherence(cs.csd_pairs(fft_data[s], ch0, ch1, normalize=True))))
+    acc.update(*cs.csd_sums(fft_data[s], ch0, ch1))
+    assert(np.allclose(results[("coherence", s, "res_acc")], acc.coherence()))
+assert(len(sink.pop_written()) == num_steps)
+print("completion order and accumulator order: ok")
+
+
+# 2) Steps without accumulator sums or without tasks finish
+task_list = make_tasks()
+written = []
+sink = result_sink(lambda task, step, name, res: written.append((task.description, step, name)))
+step = pipeline_step(0)
+tile_futures, release = held(step_results[0][0][0])
+# The accumulating task did not dispatch its sums at this step
+step.task_futures = [(task_list[0], tile_futures, [])]
+sink.add_step(step)
+sink.add_step(pipeline_step(1))
+release()
+close_sink(sink)
+assert(written == [("coherence", 0, "res")])
+assert(sorted([step.step for step in sink.pop_written()]) == [0, 1])
+print("steps without accumulator sums: ok")
+
+
+# 3) A failed tile
+task_list = make_tasks()
+written = []
+sink = result_sink(lambda task, step, name, res: written.append((task.description, step, name)))
+step = pipeline_step(0)
+tiles = step_results[0][1][0]
+tile_futures, release = held(tiles[1:])
+failed = local_future()
+step.task_futures = [(task_list[1], [failed] + tile_futures, [])]
+sink.add_step(step)
+release()
+failed._set_exception(RuntimeError("worker lost"))
+close_sink(sink)
+assert(written == [])
+assert([step.step for step in sink.pop_written()] == [0])
+print("failed tile: ok")
+
+
+# 4) A slow writer. The futures are finished before add_step, so the callbacks run in add_step.
+task_list = make_tasks()
+sink = result_sink(lambda task, step, name, res: time.sleep(0.2), max_queue=1)
+pipe = step_pipeline(max_in_flight=num_steps + 1, sink=sink)
+for s in range(num_steps):
+    step = pipeline_step(s)
+    tile_futures, release = held(step_results[s][1][0])
+    release()
+    step.task_futures = [(task_list[1], tile_futures, [])]
+    t0 = timeit.default_timer()
+    sink.add_step(step)
+    assert(timeit.default_timer() - t0 < 0.05)
+# The main loop waits here until the writer has caught up
+pipe.wait_for_slot()
+assert(sink.queue.qsize() < sink.max_queue)
+pipe.drain()
+assert(len(pipe.finished) == num_steps)
+print("add_step with a slow writer: ok")
+
+
+# End of file test_result_sink.py
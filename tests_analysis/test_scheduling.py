@@ -0,0 +1,122 @@
+# Encoding: UTF-8 -*-
+
+"""Shedding ladder of deadline_policy, see analysis/scheduling.py.
+
+The latencies of the steps are set by hand, so no executor is needed. This checks
+* the ladder: skip the priority classes from the lowest, but never the highest, then decimate, then drop
+* escalate: a late step raises the level by one. Steps dispatched at a lower level, and steps
+  that were already reported late while in flight, do not raise it again.
+* relax: the level drops by one after relax_after consecutive fast steps. A step between
+  relax * budget and budget resets the count.
+* the decision of each step, and that steps are only dropped while the pipeline is full
+
+Run from the repository root:
+python tests_analysis/test_scheduling.py
+"""
+
+import sys
+sys.path.append(".")
+
+import timeit
+
+from analysis.task_fft import task_fft_kstar
+from analysis.task_spectral import task_cross_phase, task_coherence, task_bicoherence
+from analysis.pipeline import pipeline_step
+from analysis.scheduling import deadline_policy
+
+
+budget = 2.0
+params = task_fft_kstar(10_000, {"nfft": 1000, "window": "hann", "overlap": 0.5, "detrend": 1,
+                                 "fsample": 5e5, "full": 1}).get_fft_params()
+kwargs = {"ref_channels": ["L0101-0102"], "x_channels": ["L0201-0202"]}
+# Priorities 2, 1 (the default) and 0 (the default of the bicoherence)
+task_list = [task_cross_phase({"description": "cross_phase", "analysis": "cross_phase", "priority": 2, "kwargs": kwargs}, params),
+             task_coherence({"description": "coherence", "analysis": "coherence", "kwargs": kwargs}, params),
+             task_bicoherence({"description": "bicoherence", "analysis": "bicoherence", "kwargs": kwargs}, params)]
+
+
+def make_step(policy, s, pipe_full=False):
+    """Reads step s now and lets the policy decide."""
+    step = pipeline_step(s)
+    step.start("read")
+    step.stop("read")
+    return(step, policy.decide(step, pipe_full))
+
+
+def store(policy, step, latency):
+    """Stores the step with the given latency from the start of its read."""
+    step.timing["store"] = [step.timing["read"][0], step.timing["read"][0] + latency]
+    policy.observe(step)
+
+
+# 1) The ladder
+policy = deadline_policy({"budget": budget, "relax_after": 2}, task_list)
+assert(policy.ladder == [("skip", 0), ("skip", 1), ("decimate", 2), ("drop", None)])
+assert(deadline_policy({"budget": budget, "actions": ["skip", "drop"]}, task_list).ladder == [("skip", 0), ("skip", 1), ("drop", None)])
+assert(deadline_policy({"budget": budget, "decimate": 1}, task_list).ladder == [("skip", 0), ("skip", 1), ("drop", None)])
+assert(deadline_policy({"budget": budget}, task_list[:1]).ladder == [("decimate", 2), ("drop", None)])
+print("ladder: ok")
+
+# 2) Escalate, one level per late step that ran at the current level
+expected = [(["bicoherence"], 1, False), (["coherence", "bicoherence"], 1, False),
+            (["coherence", "bicoherence"], 2, False), (["coherence", "bicoherence"], 2, True)]
+for level in range(len(policy.ladder)):
+    step, decision = make_step(policy, level, pipe_full=True)
+    # Dispatched at the same level as an earlier late step, but stored later
+    step_same, _ = make_step(policy, 100 + level)
+    assert(decision["level"] == level)
+    store(policy, step, 1.5 * budget)
+    assert(policy.level == level + 1)
+    store(policy, step_same, 1.5 * budget)
+    assert(policy.level == level + 1)
+
+    _, decision = make_step(policy, 200 + level, pipe_full=True)
+    skipped, decimate, dropped = expected[level]
+    assert(decision["skipped"] == skipped)
+    assert(decision["decimate"] == decimate)
+    assert(decision["dropped"] == dropped)
+    assert(decision["latency"] is None)
+    assert(policy.decisions[level]["latency"] == 1.5 * budget)
+
+# The level does not go beyond the ladder. Steps are only dropped while the pipeline is full.
+step, _ = make_step(policy, 300)
+store(policy, step, 1.5 * budget)
+assert(policy.level == len(policy.ladder))
+assert(policy.may_drop())
+assert(not make_step(policy, 301, pipe_full=False)[1]["dropped"])
+# The highest priority class is never skipped
+assert("cross_phase" not in policy.decisions[301]["skipped"])
+print("escalate: ok")
+
+# 3) Relax after relax_after consecutive fast steps. A step close to the budget resets the count.
+level = policy.level
+latencies = [0.1, 0.8, 0.1, 0.1, 0.1, 0.1]
+levels = [level, level, level, level - 1, level - 1, level - 2]
+for s, (latency, expected_level) in enumerate(zip(latencies, levels)):
+    step, _ = make_step(policy, 400 + s)
+    store(policy, step, latency * budget)
+    assert(policy.level == expected_level)
+print("relax: ok")
+
+# 4) A step in flight after the deadline raises the level once, and not again when it is stored late
+policy = deadline_policy({"budget": budget}, task_list)
+step, _ = make_step(policy, 0)
+policy.check_in_flight([step])
+assert(policy.level == 0)
+step.timing["read"][0] = timeit.default_timer() - 1.5 * budget
+policy.check_in_flight([step])
+policy.check_in_flight([step])
+assert(policy.level == 1)
+assert(policy.decisions[0]["late"])
+store(policy, step, 2.0 * budget)
+assert(policy.level == 1)
+# A step that was not decided by the policy is ignored
+step = pipeline_step(1000)
+step.start("read")
+store(policy, step, 2.0 * budget)
+assert(policy.level == 1)
+assert(1000 not in policy.decisions)
+print("check_in_flight: ok")
+
+
+# End of file test_scheduling.py
@@ -0,0 +1,100 @@
+# Encoding: UTF-8 -*-
+
+"""Channel sharding of the data of a step, see analysis/sharding.py.
+
+A tile of channel pairs only receives the blocks of channels it needs. Its channel indices
+are remapped to the rows of the concatenation of these blocks (to_local in
+sharded_data.submit_pairs). This is checked for tiles that need non-adjacent blocks and the
+shorter last block, by picking the rows of the pairs on the workers and comparing them to
+the rows of the whole data. The transfer volume is counted for a set of made-up workers.
+
+Finally the FFT and the cross-power of a task on sharded data are compared to the
+unsharded path. The tasks run on a local thread_executor, which ignores the placement hints.
+
+Run from the repository root:
+python tests_analysis/test_sharding.py
+"""
+
+import sys
+sys.path.append(".")
+
+import numpy as np
+
+from analysis.sharding import channel_sharding, submit_pairs
+from analysis.task_fft import task_fft_kstar, stack_fft_blocks
+from analysis.task_spectral import task_cross_power
+from executors.local_executor import thread_executor
+
+
+def pick_rows(data, ch0, ch1):
+    """Returns the rows of the pairs. Runs on the workers."""
+    return(data[ch0], data[ch1])
+
+
+fs = 5e5
+num_ch = 40
+num_samples = 10_000
+block_size = 16
+
+rng = np.random.default_rng(5)
+data = rng.normal(size=(num_ch, num_samples))
+executor = thread_executor(max_workers=4)
+
+# Blocks 0-15, 16-31 and 32-39 on three workers
+workers = ["w0", "w1", "w2"]
+sharding = channel_sharding(num_ch, block_size, workers)
+assert(list(sharding.block_starts) == [0, 16, 32, 40])
+assert(sharding.block_workers == workers)
+
+# 1) Remapping of the channel indices
+bytes_per_channel = data[0].nbytes
+tiles = [(np.array([0, 3, 15]), np.array([33, 39, 32])),         # Blocks 0 and 2, not adjacent
+         (np.array([17, 35, 38, 39]), np.array([16, 20, 31, 39])),  # Blocks 1 and 2
+         (np.array([34]), np.array([36])),                         # The shorter last block only
+         (np.arange(num_ch), np.arange(num_ch)[::-1])]              # All blocks
+for ch0, ch1 in tiles:
+    data_shards = sharding.scatter(executor, data)
+    assert(data_shards.scatter_bytes == data.nbytes)
+    rows0, rows1 = submit_pairs(executor, pick_rows, data_shards, ch0, ch1).result()
+    assert(np.array_equal(rows0, data[ch0]))
+    assert(np.array_equal(rows1, data[ch1]))
+print("to_local remapping: ok")
+
+# 2) Transfer volume. The tile runs where most of its channels are, and the other blocks are moved there.
+data_shards = sharding.scatter(executor, data)
+submit_pairs(executor, pick_rows, data_shards, np.array([0, 1]), np.array([33, 34])).result()
+# Block 2 (8 channels) is moved to w0, which holds block 0 (16 channels)
+assert(data_shards.transfer_bytes == 8 * bytes_per_channel)
+assert(data_shards.replicas[2] == {"w0", "w2"})
+# w0 now holds a copy of block 2. Nothing is moved for the same blocks again.
+submit_pairs(executor, pick_rows, data_shards, np.array([2]), np.array([39])).result()
+assert(data_shards.transfer_bytes == 8 * bytes_per_channel)
+# A single worker holds all blocks
+single = channel_sharding(num_ch, block_size, ["local"])
+data_shards = single.scatter(executor, data)
+submit_pairs(executor, pick_rows, data_shards, np.arange(num_ch), np.arange(num_ch)).result()
+assert(data_shards.transfer_bytes == 0)
+print("transfer volume: ok")
+
+# 3) FFT and cross-power on sharded data match the unsharded path
+fft_params = {"nfft": 1000, "window": "hann", "overlap": 0.5, "detrend": 1, "fsample": fs, "full": 1, "block_size": block_size}
+task_config = {"description": "cross_power", "analysis": "cross_power",
+               "kwargs": {"ref_channels": ["L0101-0104"], "x_channels": ["L0501-0508"], "tile_size": 7}}
+my_fft = task_fft_kstar(num_samples, fft_params)
+
+data_future = executor.scatter(data, broadcast=True)
+fft_future = executor.submit(stack_fft_blocks, my_fft.do_fft(executor, data_future, num_ch))
+task = task_cross_power(task_config, my_fft.get_fft_params())
+task.calculate(executor, fft_future)
+ref = task.get_results()
+
+fft_shards = my_fft.do_fft(executor, sharding.scatter(executor, data), num_ch)
+assert(np.allclose(executor.submit(stack_fft_blocks, fft_shards.futures).result(), fft_future.result()))
+task.calculate(executor, fft_shards)
+assert(np.allclose(task.get_results(), ref))
+print("sharded FFT and cross-power: ok, {0:6.3f} MB moved between workers".format(fft_shards.transfer_bytes / 1e6))
+
+executor.close()
+
+
+# End of file test_sharding.py
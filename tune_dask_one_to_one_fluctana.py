@@ -0,0 +1,123 @@
+#-*- coding: UTF-8 -*-
+
+"""
+Tunes chunk size, channel-block size and pair-tile size of processor_dask_one_to_one_fluctana.py
+from measured throughput, and writes a configuration file with the recommended values.
+
+The analysis tasks, FFT parameters and the executor are taken from the configuration file of
+the processor. Each setting is measured on a synthetic stream, or on a few time steps read
+from the bp file with --recorded. See analysis/tuning.py for the measurement. As in the
+processor, only the channels that the tasks use are read and transformed.
+
+python tune_dask_one_to_one_fluctana.py --config config_one_to_one_fluctana.json \
+    --output config_tuned.json --chunk_sizes 5000 10000 20000 --block_sizes 8 16 32 64 --tile_sizes 0 256 1024
+
+A tile size of 0 computes all channel pairs of a task in a single tile.
+
+The chunk size of the stream is set by the data source, f.ex. create_ecei_bpfile.py --chunk_size.
+The processor reads it from the field "chunk_size" of the configuration file.
+"""
+
+import json
+import argparse
+
+import numpy as np
+
+from executors.factory import get_executor
+from executors.worker_setup import setup_workers
+from analysis.task_fft import task_fft_scipy, task_fft_kstar
+from analysis.task_spectral import task_cross_phase, task_cross_power, task_coherence, task_bicoherence, task_xspec, task_cross_correlation
+from analysis.tuning import synthetic_stream, recorded_stream, measure_steps, get_layout, tune, recommended_config
+
+
+# task_object_dict maps the string-value of the analysis field in the json file
+# to an object that defines an appropriate analysis function.
+task_object_dict = {"cross_phase": task_cross_phase,
+                    "cross_power": task_cross_power,
+                    "coherence": task_coherence,
+                    "bicoherence": task_bicoherence,
+                    "xspec": task_xspec,
+                    "cross_correlation": task_cross_correlation}
+
+fft_engine_dict = {"scipy": task_fft_scipy, "kstar": task_fft_kstar}
+
+
+parser = argparse.ArgumentParser(description="Tune chunk, block and tile size of the dask processor")
+parser.add_argument('--config', type=str, help='Lists the configuration file', default='config_one_to_one_fluctana.json')
+parser.add_argument('--output', type=str, help='Configuration file with the recommended values', default='config_tuned.json')
+parser.add_argument('--report', type=str, help='Stores all measurements in this file', default='tuning_report.json')
+parser.add_argument('--chunk_sizes', type=int, nargs='+', help='Candidate chunk sizes', default=[5_000, 10_000, 20_000, 50_000])
+parser.add_argument('--block_sizes', type=int, nargs='+', help='Candidate channel-block sizes of the FFT', default=[8, 16, 32, 64])
+parser.add_argument('--tile_sizes', type=int, nargs='+', help='Candidate pair-tile sizes. 0: all pairs in one tile', default=[0, 64, 256, 1024])
+parser.add_argument('--recorded', type=int, help='Use this many time steps from the bp file instead of synthetic data', default=0)
+parser.add_argument('--nsteps', type=int, help='Number of measured time steps per setting', default=3)
+args = parser.parse_args()
+
+with open(args.config, "r") as df:
+    cfg = json.load(df)
+    df.close()
+
+dask_client = get_executor(cfg.get("executor", {"type": "dask",
+                                                "scheduler_file": "/global/cscratch1/sd/rkube/scheduler.json"}))
+
+fft_params = dict(cfg["fft_params"])
+fft_params["fsample"] = cfg["ECEI_cfg"]["SampleRate"] * 1e3
+fft_params["precision"] = cfg.get("precision", "double")
+fft_class = fft_engine_dict[fft_params.get("engine", "scipy")]
+setup_workers(dask_client, fft_class(cfg.get("chunk_size", 10_000), fft_params).get_fft_params(), cfg.get("source_path", None))
+
+# The processor reads and transforms only the channels that the tasks use, see analysis/channels.py
+layout = get_layout(fft_class, fft_params, task_object_dict, cfg["task_list"], cfg.get("chunk_size", 10_000))
+print("Tuning with {0:d} channels: {1:s}".format(len(layout), layout.to_str()))
+
+if args.recorded > 0:
+    from readers.reader_one_to_one import reader_bpfile
+    reader = reader_bpfile(cfg["shotnr"], cfg["ECEI_cfg"], precision=fft_params["precision"])
+    reader.Open(cfg["datapath"])
+    steps = []
+    while len(steps) < args.recorded and reader.BeginStep():
+        # Get re-uses its buffers in later steps
+        steps.append(reader.Get(layout.channels).copy())
+        reader.EndStep()
+    get_chunk = recorded_stream(np.concatenate(steps, axis=1))
+    print("Tuning on {0:d} recorded time steps".format(len(steps)))
+else:
+    get_chunk = synthetic_stream(len(layout), fft_params["fsample"])
+    print("Tuning on a synthetic stream")
+
+
+def measure(chunk_size, block_size, tile_size):
+    """Measures a setting, see analysis/tuning.py"""
+    task_configs = [dict(task_config, kwargs=dict(task_config["kwargs"], tile_size=tile_size))
+                    for task_config in cfg["task_list"]]
+    return(measure_steps(dask_client, fft_class, dict(fft_params, block_size=block_size),
+                         task_object_dict, task_configs, get_chunk, chunk_size, args.nsteps, layout=layout))
+
+
+# Start from the values of the configuration file
+def candidates(current, values):
+    return([current] + [v for v in values if v != current])
+
+tile_sizes = [None if t == 0 else t for t in args.tile_sizes]
+current_tile = cfg["task_list"][0]["kwargs"].get("tile_size", None)
+budget = cfg["deadline"]["budget"] if "deadline" in cfg else None
+
+best, results = tune(measure,
+                     candidates(cfg.get("chunk_size", 10_000), args.chunk_sizes),
+                     candidates(fft_params.get("block_size", 32), args.block_sizes),
+                     candidates(current_tile, tile_sizes),
+                     budget=budget)
+
+print("Recommended: chunk_size = {0:d}, block_size = {1:d}, tile_size = {2:s}. Latency {3:6.4f}s, real-time factor {4:5.2f}".format(
+      best["chunk_size"], best["block_size"], str(best["tile_size"]), best["measurement"]["latency"],
+      best["measurement"]["realtime_factor"]))
+
+with open(args.output, "w") as df:
+    json.dump(recommended_config(cfg, best), df, indent=1)
+with open(args.report, "w") as df:
+    json.dump({"best": best, "budget": budget, "results": results}, df, indent=1)
+
+dask_client.close()
+
+
+# End of file tune_dask_one_to_one_fluctana.py.